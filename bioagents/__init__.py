@@ -1,19 +1,25 @@
-import uuid
+import time
 import logging
+import threading
+from copy import deepcopy
 from os import path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from indra.statements import Agent, Statement, stmts_from_json
-from indra.assemblers.html import HtmlAssembler
-from indra.util.statement_presentation import group_and_sort_statements, \
-    make_string_from_sort_key
 
 from bioagents.settings import IMAGE_DIR, TIMESTAMP_PICS
+from bioagents.metrics import registry as metrics_registry
+from bioagents.cache import LRUCache, digest
+from bioagents.artifacts import get_artifact_store
+from bioagents.provenance import ProvenanceReportBuilder
+from bioagents.logs import add_log_file, RateLimitedLogger
 from kqml.cl_json import CLJsonConverter
 
 logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger('Bioagents')
+rl_logger = RateLimitedLogger(logger)
 
 
 from indra.assemblers.english import EnglishAssembler
@@ -24,15 +30,186 @@ class BioagentException(Exception):
     pass
 
 
+class DeadlineExceeded(BioagentException):
+    """Raised when a request is not done before its deadline."""
+    pass
+
+
+class RequestContext(object):
+    """The context of the request being handled, carrying its deadline.
+
+    While a request is handled, its context is available on that thread from
+    `get_request_context`. Threads doing part of the work of a request can
+    enter its context too (`with context:`), so that they see its deadline.
+    Long running code should check the context cooperatively, by calling
+    `check` (which raises DeadlineExceeded) or `expired` between steps, and
+    by limiting the timeouts of its blocking calls with `get_timeout`. Where
+    it can, it should return the partial results it has when the deadline
+    passes.
+
+    Parameters
+    ----------
+    task : str or None
+        The task of the request.
+    timeout : float or None
+        The number of seconds the request may take. If None, there is no
+        deadline.
+    """
+    def __init__(self, task=None, timeout=None):
+        self.task = task
+        self.start_time = time.monotonic()
+        self.deadline = self.start_time + timeout \
+            if timeout is not None else None
+        self.cancelled = False
+
+    def remaining(self):
+        """Return the number of seconds left, or None if there's no deadline.
+        """
+        if self.cancelled:
+            return 0.0
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def expired(self):
+        """Return True if the deadline passed or the request was cancelled."""
+        return self.remaining() == 0.0
+
+    def check(self):
+        """Raise DeadlineExceeded if the deadline passed."""
+        if self.expired():
+            raise DeadlineExceeded('Deadline passed for task %s after %.1f '
+                                   'seconds.' % (self.task, time.monotonic() -
+                                                 self.start_time))
+
+    def cancel(self):
+        """Cancel the request, as if its deadline passed."""
+        self.cancelled = True
+
+    def get_timeout(self, default=None):
+        """Return a timeout for a blocking call that respects the deadline.
+
+        This is the smaller of `default` and the time remaining, or None if
+        neither is set.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        if default is None:
+            return remaining
+        return min(default, remaining)
+
+    def __enter__(self):
+        # A context may be entered on several threads at once (e.g. workers
+        # doing parts of the request), so the contexts it replaces are kept
+        # per thread.
+        prev_contexts = _request_state.__dict__.setdefault('prev_contexts',
+                                                           [])
+        prev_contexts.append(getattr(_request_state, 'context', None))
+        _request_state.context = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _request_state.context = _request_state.prev_contexts.pop()
+        return False
+
+
+_request_state = threading.local()
+
+
+def get_request_context():
+    """Return the context of the request handled by this thread.
+
+    If no request is being handled, a context without a deadline is returned.
+    """
+    context = getattr(_request_state, 'context', None)
+    if context is None:
+        return RequestContext()
+    return context
+
+
 class Bioagent(KQMLModule):
-    """Abstract class for bioagents."""
+    """Abstract class for bioagents.
+
+    By default requests are handled one at a time on the thread that reads
+    messages. Requests can instead be dispatched to worker pools, so that a
+    slow task does not hold up the others queued behind it:
+
+    task_workers : dict
+        A dict keyed by task name giving the number of worker threads that
+        may run that task concurrently. Each task listed gets its own pool.
+    default_workers : int or None
+        The number of worker threads shared by all tasks not listed in
+        `task_workers`. If None, those tasks are handled synchronously.
+
+    Both can be set as class attributes, passed as keyword arguments, or
+    given on the command line as `--workers 4` and
+    `--task-workers FIND-RELATIONS-FROM-LITERATURE=2,CHOOSE-SENSE=4`.
+
+    The latency, rate and failures of every task are recorded in
+    `bioagents.metrics.registry`. They are periodically written to the
+    file given by `metrics_file` (`--metrics-file`), as Prometheus text if
+    it ends with .prom, else as JSON, and served over HTTP on the port
+    given by `metrics_port` (`--metrics-port`).
+
+    Tasks whose reply depends only on the content of the request can be
+    listed in `cacheable_tasks`, a dict keyed by task name giving the number
+    of seconds a reply is kept (None to keep it until it is evicted). Up to
+    `response_cache_size` replies are kept, and a request with the same
+    content as a cached one is answered without calling its respond method.
+
+    Each request is handled within a RequestContext whose deadline is given
+    by `task_timeouts`, a dict keyed by task name giving seconds, or else by
+    `default_timeout` (`--request-timeout`). Agents give defaults in
+    `task_timeouts` for their long running tasks. A request that runs past
+    its deadline, without returning partial results, fails with reason
+    TIMEOUT.
+    """
     name = "Generic Bioagent (Should probably be overwritten)"
     tasks = []
+    task_workers = {}
+    default_workers = None
+    cacheable_tasks = {}
+    task_timeouts = {}
+    default_timeout = None
+    # Write the log file from a background thread (see bioagents.logs).
+    async_logging = True
+    response_cache_size = 512
     converter = CLJsonConverter(token_bools=True)
+    metrics = metrics_registry
+    # Agents and Statements decoded from CL-JSON, keyed by a digest of the
+    # KQML they were decoded from. Models are often sent again and again.
+    decode_cache = LRUCache(maxsize=256)
+    # The sorted groups of statements recently reported as provenance.
+    provenance_builder = ProvenanceReportBuilder()
 
     def __init__(self, **kwargs):
+        task_workers, default_workers = _get_worker_args(kwargs)
+        metrics_file = _pop_option(kwargs, 'metrics_file', '--metrics-file')
+        metrics_port = _pop_option(kwargs, 'metrics_port', '--metrics-port')
+        default_timeout = _pop_option(kwargs, 'request_timeout',
+                                      '--request-timeout')
+        if default_timeout is not None:
+            self.default_timeout = float(default_timeout)
+        if task_workers is None:
+            task_workers = self.task_workers
+        if default_workers is None:
+            default_workers = self.default_workers
+        # Replies may be sent from several worker threads at once, so writes
+        # to the output stream are serialized.
+        self._send_lock = threading.RLock()
+        self._worker_state = threading.local()
+        self.response_cache = LRUCache(maxsize=self.response_cache_size)
+        if self.cacheable_tasks:
+            self.metrics.register_cache('%s_responses' % self.name,
+                                        self.response_cache)
         super(Bioagent, self).__init__(name=self.name, **kwargs)
         self.my_log_file = self._add_log_file()
+        self._make_worker_pools(task_workers, default_workers)
+        if metrics_file:
+            self.metrics.start_periodic_dump(metrics_file)
+        if metrics_port:
+            self.metrics.serve(int(metrics_port))
         for task in self.tasks:
             self.subscribe_request(task)
 
@@ -41,20 +218,70 @@ class Bioagent(KQMLModule):
         logger.info("%s has started and is ready." % self.name)
         return
 
+    def _make_worker_pools(self, task_workers, default_workers):
+        """Create a pool of worker threads for each configured task."""
+        self._task_pools = {}
+        for task, num_workers in task_workers.items():
+            task = task.upper()
+            if task not in self.tasks:
+                logger.warning('Ignoring workers for unknown task %s.' % task)
+                continue
+            self._task_pools[task] = ThreadPoolExecutor(num_workers)
+        if default_workers:
+            self._default_pool = ThreadPoolExecutor(default_workers)
+        else:
+            self._default_pool = None
+        if self._task_pools or self._default_pool:
+            logger.info('%s dispatching tasks to worker pools: %s, '
+                        'others: %s.' % (self.name, task_workers,
+                                         default_workers))
+
+    def _get_task_pool(self, task):
+        """Return the worker pool for a task, or None to run it in place."""
+        # A request that is already running on a worker is handled in place.
+        if getattr(self._worker_state, 'in_worker', False):
+            return None
+        return self._task_pools.get(task, self._default_pool)
+
+    def shutdown_workers(self, wait=True):
+        """Stop accepting work on the worker pools and optionally wait."""
+        pools = list(self._task_pools.values())
+        if self._default_pool is not None:
+            pools.append(self._default_pool)
+        for pool in pools:
+            pool.shutdown(wait=wait)
+
     @classmethod
     def _add_log_file(cls):
         log_file_name = '%s.log' % cls.name
-        handler = logging.FileHandler(log_file_name)
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s: '
-                                      '%(name)s - %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        return log_file_name
+        return add_log_file(log_file_name, logger.name,
+                            use_queue=cls.async_logging)
+
+    @classmethod
+    def _decode_cached(cls, kind, cl_obj, decode):
+        """Decode CL-JSON using the decode cache, returning a fresh copy.
+
+        The result is deep copied on the way out so that callers are free to
+        modify what they get back.
+        """
+        try:
+            key = (kind, digest(cl_obj.to_string()))
+        except Exception:
+            return decode(cl_obj)
+        missing = object()
+        decoded = cls.decode_cache.get(key, missing)
+        if decoded is missing:
+            decoded = decode(cl_obj)
+            cls.decode_cache.put(key, decoded)
+        return deepcopy(decoded)
 
     @classmethod
     def get_agent(cls, cl_agent):
         """Get an agent from the kqml cl-json representation (KQMLList)."""
+        return cls._decode_cached('agent', cl_agent, cls._decode_agent)
+
+    @classmethod
+    def _decode_agent(cls, cl_agent):
         agent_json = cls.converter.cl_to_json(cl_agent)
         if isinstance(agent_json, list):
             return [ensure_agent_type(Agent._from_json(agj))
@@ -65,6 +292,11 @@ class Bioagent(KQMLModule):
     @classmethod
     def get_statement(cls, cl_statement):
         """Get an INDRA Statement from cl-json"""
+        return cls._decode_cached('statement', cl_statement,
+                                  cls._decode_statement)
+
+    @classmethod
+    def _decode_statement(cls, cl_statement):
         stmt_json = cls.converter.cl_to_json(cl_statement)
         if not stmt_json:
             return None
@@ -117,15 +349,41 @@ class Bioagent(KQMLModule):
             return self.reply_with_content(msg, reply_content)
 
         if task in self.tasks:
+            pool = self._get_task_pool(task)
+            if pool is not None:
+                logger.info("%s queueing task %s for a worker."
+                            % (self.name, task))
+                pool.submit(self._receive_request_in_worker, msg, content)
+                return
             reply_content = self._respond_to(task, content)
         else:
             logger.error('Could not perform task.')
             logger.error("Task %s not found in %s." %
                          (task, str(self.tasks)))
+            self.metrics.record_failure(self.name, task, 'UNKNOWN_TASK')
             reply_content = self.make_failure('UNKNOWN_TASK')
 
         return self.reply_with_content(msg, reply_content)
 
+    def _receive_request_in_worker(self, msg, content):
+        """Handle a request on a worker thread.
+
+        The (possibly overridden) `receive_request` is called again so that
+        any error handling a subclass wraps around it still applies; on the
+        worker it runs the task in place and replies with the content.
+        """
+        self._worker_state.in_worker = True
+        try:
+            self.receive_request(msg, content)
+        except Exception as e:
+            logger.error('Unhandled error in worker for %s.' % self.name)
+            logger.exception(e)
+            reply_content = self.make_failure('INTERNAL_FAILURE',
+                                              description=str(e))
+            self.reply_with_content(msg, reply_content)
+        finally:
+            self._worker_state.in_worker = False
+
     def _respond_to(self, task, content):
         """Get the method to responsd to the task indicated by task."""
         resp_name = "respond_" + task.replace('-', '_').lower()
@@ -136,16 +394,52 @@ class Bioagent(KQMLModule):
         except AttributeError:
             logger.error("Tried to execute unimplemented task.")
             logger.error("Did not find response method %s." % resp_name)
+            self.metrics.record_failure(self.name, task, 'INVALID_TASK')
             return self.make_failure('INVALID_TASK')
-        try:
-            reply_content = resp(content)
-            return reply_content
-        except BioagentException:
-            raise
-        except Exception as e:
-            logger.error('Could not perform response to %s' % task)
-            logger.exception(e)
-            return self.make_failure('INTERNAL_FAILURE', description=str(e))
+        timeout = self.task_timeouts.get(task, self.default_timeout)
+        with self.metrics.track(self.name, task) as record, \
+                RequestContext(task, timeout):
+            try:
+                reply_content = self._get_reply(task, content, resp, record)
+            except DeadlineExceeded as e:
+                logger.warning('%s timed out on task %s: %s'
+                               % (self.name, task, e))
+                reply_content = self.make_failure('TIMEOUT',
+                                                  description=str(e))
+            except BioagentException:
+                raise
+            except Exception as e:
+                logger.error('Could not perform response to %s' % task)
+                logger.exception(e)
+                reply_content = self.make_failure('INTERNAL_FAILURE',
+                                                  description=str(e))
+            record.set_reply(reply_content)
+        return reply_content
+
+    def _get_reply(self, task, content, resp, record=None):
+        """Return the reply of `resp` to the content of a task.
+
+        If the task is in `cacheable_tasks`, a reply to the same content is
+        taken from the response cache if there is one, and `resp` is not
+        called. Failures are not cached. Replies are cached as strings, and
+        parsed again on the way out, so that callers are free to modify what
+        they get back.
+        """
+        if task not in self.cacheable_tasks:
+            return resp(content)
+        key = (task, _normalize_content(content))
+        cached_reply = self.response_cache.get(key)
+        if cached_reply is not None:
+            logger.info('%s found a cached reply for task %s.'
+                        % (self.name, task))
+            if record is not None:
+                record.cache_hit()
+            return KQMLList.from_string(cached_reply)
+        reply_content = resp(content)
+        if reply_content.head().upper() != 'FAILURE':
+            self.response_cache.put(key, reply_content.to_string(),
+                                    ttl=self.cacheable_tasks[task])
+        return reply_content
 
     def reply_with_content(self, msg, reply_content):
         """A wrapper around the reply method from KQMLModule."""
@@ -154,6 +448,11 @@ class Bioagent(KQMLModule):
         self.reply(msg, reply_msg)
         return
 
+    def send(self, msg):
+        """Send a message, making sure writes from threads don't interleave."""
+        with self._send_lock:
+            return super(Bioagent, self).send(msg)
+
     def tell(self, content):
         """Send a tell message."""
         msg = KQMLPerformative('tell')
@@ -212,6 +511,7 @@ class Bioagent(KQMLModule):
     def _make_evidence_html(self, stmts, ev_counts=None, source_counts=None,
                             title='Results from the INDRA database'):
         "Make html from a set of statements."
+        from indra.assemblers.html import HtmlAssembler
         ha = HtmlAssembler(stmts, db_rest_url='db.indra.bio', title=title,
                            ev_totals=ev_counts, source_counts=source_counts)
         return ha.make_model()
@@ -242,47 +542,46 @@ class Bioagent(KQMLModule):
 
         Which should land in the cwc-integ directory. If the directory does not
         yet exist, it will be created.
+
+        Files are named by a digest of the html, so the same page is only
+        stored once, and they are written by a background thread (see
+        bioagents.artifacts). The link is returned without waiting for the
+        write to finish.
         """
-        # Get the provenance location.
-        from os import environ, mkdir
+        store = self._get_provenance_store()
+        if store is None:
+            return None
+        return store.put(html, content_type='text/html', ext='html')
+
+    def _stash_evidence_html_later(self, key, render):
+        """Return a link to html that is made by `render` in the background.
+
+        The html is stored as by `_stash_evidence_html`, but `render` is only
+        called if nothing was stored for the same key before, and not on the
+        thread handling the request.
+        """
+        store = self._get_provenance_store()
+        if store is None:
+            return None
+        return store.put_deferred(key, render, content_type='text/html',
+                                  ext='html')
+
+    def _get_provenance_store(self):
+        """Get the artifact store for the PROVENANCE_LOCATION."""
+        from os import environ
 
         loc = environ.get('PROVENANCE_LOCATION')
         if loc is None:
             this_dir = path.dirname(path.abspath(__file__))
             rel = path.join(*([this_dir] + 3*[path.pardir] + ['provenance']))
             loc = 'file:' + path.abspath(rel)
-        logger.info("Using provenance location: \"%s\"" % loc)
-
-        # Save the file.
-        method = loc.split(':')[0]
-        fname = '%s.html' % uuid.uuid4()
-        if method == 'file':
-            prov_path = loc.split(':')[1]
-            if not path.exists(prov_path):
-                mkdir(prov_path)
-            fpath = path.join(prov_path, fname)
-            with open(fpath, 'w') as f:
-                f.write(html)
-            link = fpath
-        elif method == 's3':
-            bucket = loc.split(':')[1]
-            prefix = loc.split(':')[2]
-
-            # Get a connection to s3.
-            import boto3
-            from botocore import UNSIGNED
-            from botocore.client import Config
-            s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-
-            key = prefix + fname
-            link = 'https://s3.amazonaws.com/%s/%s' % (bucket, key)
-            s3.put_object(Bucket=bucket, Key=key, Body=html.encode('utf-8'),
-                          ContentType='text/html')
-        else:
+        rl_logger.info('Using provenance location: "%s"', loc)
+
+        store = get_artifact_store(loc)
+        if store is None:
             logger.error('Invalid PROVENANCE_LOCATION: "%s". HTML not saved.'
                          % loc)
-            link = None
-        return link
+        return store
 
     def say(self, message):
         """Say something to the user."""
@@ -300,28 +599,21 @@ class Bioagent(KQMLModule):
         def href(ref, text):
             return '<a href=%s target="_blank">%s</a>' % (ref, text)
 
-        # Build the list of relevant statements and count their prevalence.
-        sorted_groups = group_and_sort_statements(stmt_list,
-                                                  ev_totals=ev_counts,
-                                                  source_counts=source_counts)
-
-        # Build the html.
-        lines = []
-        for group in sorted_groups[:limit]:
-            if source_counts is None:
-                key, verb, stmts = group
-            else:
-                key, verb, stmts, arg_counts, group_source_counts = group
-            count = key[2]
-            line = '<li>%s %s</li>' % (make_string_from_sort_key(key, verb),
-                                       '(%d)' % count)
-            lines.append(line)
-
-        # Build the overall html.
-        list_html = '<ul>%s</ul>' % ('\n'.join(lines))
-        html = self._make_evidence_html(stmt_list, ev_counts=ev_counts,
-                                        source_counts=source_counts, **kwargs)
-        link = self._stash_evidence_html(html)
+        # Build the list of the top groups of statements. The groups are
+        # cached, so reporting on the same statements again is cheap.
+        key = self.provenance_builder.get_key(stmt_list, ev_counts,
+                                              source_counts)
+        list_html = self.provenance_builder.make_summary_html(
+            stmt_list, limit=limit, ev_counts=ev_counts,
+            source_counts=source_counts, key=key)
+
+        # The html of the full list is made in the background.
+        def render():
+            return self._make_evidence_html(stmt_list, ev_counts=ev_counts,
+                                            source_counts=source_counts,
+                                            **kwargs)
+        html_key = '%s:%s' % (key, sorted(kwargs.items()))
+        link = self._stash_evidence_html_later(html_key, render)
         if link is None:
             link_html = 'I could not generate the full list.'
         elif link.startswith('http'):
@@ -332,6 +624,68 @@ class Bioagent(KQMLModule):
         return list_html + '\n' + link_html
 
 
+metrics_registry.register_cache('cljson_decode', Bioagent.decode_cache)
+metrics_registry.register_cache('provenance_groups',
+                                Bioagent.provenance_builder.groups)
+
+
+def _normalize_content(content):
+    """Return a key for the content of a request.
+
+    Keyword arguments are sorted, and their names lower cased, so that
+    requests that differ only in the order of their arguments get the same
+    key.
+    """
+    items = content.data[1:]
+    positional = []
+    keywords = []
+    idx = 0
+    while idx < len(items):
+        item = items[idx]
+        item_str = item.to_string()
+        if item_str.startswith(':') and idx + 1 < len(items):
+            keywords.append((item_str.lower(), items[idx + 1].to_string()))
+            idx += 2
+        else:
+            positional.append(item_str)
+            idx += 1
+    key = ' '.join([content.head().upper()] + positional +
+                   ['%s %s' % kw for kw in sorted(keywords)])
+    return digest(key)
+
+
+def _pop_option(kwargs, name, flag):
+    """Pop an option given as a keyword argument or command line flag.
+
+    The flag and its value are removed from `argv` so that they are not
+    passed on to KQMLModule. The command line takes precedence.
+    """
+    value = kwargs.pop(name, None)
+    argv = kwargs.get('argv')
+    if argv and flag in argv:
+        argv = list(argv)
+        idx = argv.index(flag)
+        value = argv[idx + 1]
+        del argv[idx:idx + 2]
+        kwargs['argv'] = argv
+    return value
+
+
+def _get_worker_args(kwargs):
+    """Pop the worker pool settings from kwargs and command line arguments."""
+    task_workers = _pop_option(kwargs, 'task_workers', '--task-workers')
+    if isinstance(task_workers, str):
+        task_workers_str = task_workers
+        task_workers = {}
+        for entry in task_workers_str.split(','):
+            task, num_workers = entry.split('=')
+            task_workers[task.strip().upper()] = int(num_workers)
+    default_workers = _pop_option(kwargs, 'default_workers', '--workers')
+    if default_workers is not None:
+        default_workers = int(default_workers)
+    return task_workers, default_workers
+
+
 def get_img_path(img_name):
     """Get a full path for the given image name.
 
@@ -0,0 +1,270 @@
+"""Stores for the artifacts (e.g. provenance HTML pages) made by the agents.
+
+Artifacts are named by a digest of their content (or of a key identifying
+content that is rendered later), so an artifact that has already been stored
+is not written again, and the link to an artifact can be returned before it
+is written. The writes themselves are done by a background thread, off the
+path of the request being handled.
+
+The store to use is given by a location string of the form
+
+    file:/path/to/directory
+    s3:bucket:prefix
+
+(see `Bioagent._stash_evidence_html`), and `get_artifact_store` returns one
+shared store per location.
+"""
+__all__ = ['ArtifactStore', 'LocalArtifactStore', 'S3ArtifactStore',
+           'get_artifact_store']
+
+import os
+import queue
+import atexit
+import logging
+import threading
+
+from bioagents.cache import LRUCache, digest
+
+logger = logging.getLogger('Bioagents')
+
+
+class ArtifactStore(object):
+    """Base class of the artifact stores, which writes in the background.
+
+    Parameters
+    ----------
+    max_pending : int
+        The maximum number of writes waiting in the queue. When the queue is
+        full, `put` blocks until there is room.
+    max_known : int
+        The maximum number of names of stored artifacts remembered, so they
+        are not queued again. Beyond it, the least recently used are
+        forgotten, and `exists` is checked again before writing them.
+    """
+    def __init__(self, max_pending=1000, max_known=10000):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stored = LRUCache(maxsize=max_known)
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def get_link(self, name):
+        """Return the link at which an artifact with this name is found."""
+        raise NotImplementedError()
+
+    def exists(self, name):
+        """Return True if an artifact with this name was stored earlier."""
+        return False
+
+    def write(self, name, body, content_type):
+        """Write an artifact to the backend. Called from the writer thread."""
+        raise NotImplementedError()
+
+    def put(self, body, content_type='text/html', ext='html'):
+        """Store an artifact in the background, returning its link at once.
+
+        Parameters
+        ----------
+        body : str
+            The content of the artifact.
+        content_type : str
+            The MIME type of the content.
+        ext : str
+            The extension of the name of the artifact.
+
+        Returns
+        -------
+        link : str
+            The link at which the artifact will be found.
+        """
+        name = '%s.%s' % (digest(body), ext)
+        return self._enqueue(name, body, content_type)
+
+    def put_deferred(self, key, render, content_type='text/html', ext='html'):
+        """Store an artifact rendered later, returning its link at once.
+
+        This is used when making the content is itself expensive: `render`
+        is only called by the writer thread, and only if no artifact with
+        the same key was stored before.
+
+        Parameters
+        ----------
+        key : str
+            A string identifying the content, from which the name of the
+            artifact is made. Calls with the same key must render the same
+            content.
+        render : callable
+            A function taking no arguments and returning the content.
+        content_type : str
+            The MIME type of the content.
+        ext : str
+            The extension of the name of the artifact.
+
+        Returns
+        -------
+        link : str
+            The link at which the artifact will be found.
+        """
+        name = '%s.%s' % (digest(key), ext)
+        return self._enqueue(name, render, content_type)
+
+    def _enqueue(self, name, body, content_type):
+        with self._lock:
+            is_new = self._stored.get(name) is None
+            self._stored.put(name, True)
+        if is_new:
+            self._start_writer()
+            self._queue.put((name, body, content_type))
+        else:
+            logger.debug('Artifact %s is already stored.' % name)
+        return self.get_link(name)
+
+    def flush(self):
+        """Wait until all the queued writes are done."""
+        self._queue.join()
+
+    def _start_writer(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop,
+                                                daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            name, body, content_type = self._queue.get()
+            try:
+                if not self.exists(name):
+                    if callable(body):
+                        body = body()
+                    self.write(name, body, content_type)
+            except Exception as e:
+                logger.error('Could not store artifact %s: %s' % (name, e))
+                # Let a later put of the same content try again.
+                self._stored.discard(name)
+            finally:
+                self._queue.task_done()
+
+
+class LocalArtifactStore(ArtifactStore):
+    """Store artifacts as files in a local directory.
+
+    Parameters
+    ----------
+    directory : str
+        The directory in which files are written, created if needed.
+    """
+    def __init__(self, directory, **kwargs):
+        super(LocalArtifactStore, self).__init__(**kwargs)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_link(self, name):
+        return os.path.join(self.directory, name)
+
+    def exists(self, name):
+        return os.path.exists(self.get_link(name))
+
+    def write(self, name, body, content_type):
+        fpath = self.get_link(name)
+        # Write to a temporary file first so a partial file is never linked.
+        tmp_fpath = '%s.%d.tmp' % (fpath, threading.get_ident())
+        with open(tmp_fpath, 'w') as fh:
+            fh.write(body)
+        os.replace(tmp_fpath, fpath)
+
+
+class S3ArtifactStore(ArtifactStore):
+    """Store artifacts as objects on S3, using a single client.
+
+    Parameters
+    ----------
+    bucket : str
+        The bucket in which objects are put.
+    prefix : str
+        A prefix of the keys of the objects.
+    endpoint_url : str or None
+        The URL of an S3 compatible service to use instead of AWS.
+    signed : bool
+        If True, requests are signed with the AWS credentials found by
+        boto3. Otherwise they are sent anonymously.
+    """
+    def __init__(self, bucket, prefix='', endpoint_url=None, signed=False,
+                 **kwargs):
+        super(S3ArtifactStore, self).__init__(**kwargs)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.signed = signed
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            if self.signed:
+                self._client = boto3.client('s3',
+                                            endpoint_url=self.endpoint_url)
+                return self._client
+            from botocore import UNSIGNED
+            from botocore.client import Config
+            self._client = boto3.client(
+                's3', endpoint_url=self.endpoint_url,
+                config=Config(signature_version=UNSIGNED))
+        return self._client
+
+    def get_link(self, name):
+        base_url = self.endpoint_url.rstrip('/') if self.endpoint_url \
+            else 'https://s3.amazonaws.com'
+        return '%s/%s/%s%s' % (base_url, self.bucket, self.prefix, name)
+
+    def exists(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + name)
+        except ClientError as e:
+            # A missing object gives a 404. Objects that can't be read
+            # anonymously give a 403, and are written again.
+            logger.debug('Artifact %s not found on S3: %s' % (name, e))
+            return False
+        return True
+
+    def write(self, name, body, content_type):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + name,
+                               Body=body.encode('utf-8'),
+                               ContentType=content_type)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_artifact_store(location, signed=False):
+    """Return the shared artifact store for a location string.
+
+    If `signed` is True, the requests of S3 stores are signed with the AWS
+    credentials. Returns None if the location is not valid.
+    """
+    key = (location, signed)
+    with _stores_lock:
+        if key in _stores:
+            return _stores[key]
+        parts = location.split(':')
+        if parts[0] == 'file' and len(parts) >= 2:
+            store = LocalArtifactStore(':'.join(parts[1:]))
+        elif parts[0] == 's3' and len(parts) >= 3:
+            store = S3ArtifactStore(parts[1], parts[2],
+                                    endpoint_url=os.environ.get(
+                                        'PROVENANCE_S3_ENDPOINT_URL'),
+                                    signed=signed)
+        else:
+            return None
+        _stores[key] = store
+        return store
+
+
+@atexit.register
+def _flush_stores():
+    for store in list(_stores.values()):
+        store.flush()
@@ -2,6 +2,7 @@ import sys
 import json
 import logging
 from bioagents import Bioagent
+from bioagents.startup import profile_startup
 from indra.statements import stmts_from_json
 from indra.assemblers.english import EnglishAssembler
 from kqml import KQMLList, KQMLPerformative, KQMLString
@@ -15,40 +16,37 @@ logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
 class BioNLG_Module(Bioagent):
     name = 'BioNLG'
     tasks = ['INDRA-TO-NL']
+    cacheable_tasks = {'INDRA-TO-NL': None}
 
     def receive_request(self, msg, content):
         """Handle request messages and respond.
 
-        If a "request" message is received, decode the task and the content
-        and call the appropriate function to prepare the response. A
-        reply_content message is then sent back.
+        Requests without a valid task get an error reply. The others are
+        handled by `Bioagent.receive_request`, so they go through the worker
+        pools, the request deadlines and the response cache like those of
+        the other agents.
         """
         try:
-            content = msg.get('content')
-            task_str = content.head().upper()
+            task_str = msg.get('content').head().upper()
             logger.info(task_str)
         except Exception as e:
             logger.error('Could not get task string from request.')
             logger.error(e)
             return self.error_reply(msg, 'Invalid task')
+        if task_str not in self.tasks:
+            return self.error_reply(msg, 'Unknown task ' + task_str)
+        return super(BioNLG_Module, self).receive_request(msg, content)
+
+    def respond_indra_to_nl(self, content):
+        """Return response content to build-model request."""
         try:
-            if task_str == 'INDRA-TO-NL':
-                reply_content = self.respond_indra_to_nl(content)
-            else:
-                return self.error_reply(msg, 'Unknown task ' + task_str)
+            stmts_cl_json = content.get('statements')
+            stmts = self.get_statement(stmts_cl_json)
+            txts = assemble_english(stmts)
         except Exception as e:
             logger.error('Failed to perform task.')
             logger.error(e)
-            reply_content = KQMLList('FAILURE')
-            reply_content.set('reason', 'NL_GENERATION_ERROR')
-
-        return self.reply_with_content(msg, reply_content)
-
-    def respond_indra_to_nl(self, content):
-        """Return response content to build-model request."""
-        stmts_cl_json = content.get('statements')
-        stmts = self.get_statement(stmts_cl_json)
-        txts = assemble_english(stmts)
+            return self.make_failure('NL_GENERATION_ERROR')
         txts_kqml = [KQMLString(txt) for txt in txts]
         txts_list = KQMLList(txts_kqml)
         reply = KQMLList('OK')
@@ -68,4 +66,7 @@ def assemble_english(stmts):
 
 
 if __name__ == "__main__":
-    BioNLG_Module(argv=sys.argv[1:])
+    if '--profile-startup' in sys.argv:
+        profile_startup(BioNLG_Module)
+    else:
+        BioNLG_Module(argv=sys.argv[1:])
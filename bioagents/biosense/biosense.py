@@ -1,26 +1,20 @@
 import logging
-from indra import __path__ as _indra_path
 from indra.databases import uniprot_client
-from indra.util import read_unicode_csv
 from indra.tools import expand_families
-from indra.preassembler.hierarchy_manager import hierarchies
-from indra.preassembler.grounding_mapper import default_grounding_map as gm
+from bioagents.startup import LazyComponent
+from bioagents.biosense.entity_types import EntityTypeIndex, \
+    get_category_mask
 
 
 logger = logging.getLogger('BioSense')
-_indra_path = _indra_path[0]
 
 
 class BioSense(object):
     """Python API for biosense agent"""
-    __slots__ = ['_kinase_list', '_tf_list', '_phosphatase_list',
-                 '_fplx_synonyms']
+    __slots__ = ['_entity_types']
 
     def __init__(self):
-        self._kinase_list = _read_kinases()
-        self._tf_list = _read_tfs()
-        self._phosphatase_list = _read_phosphatases()
-        self._fplx_synonyms = _make_fplx_synonyms()
+        self._entity_types = entity_type_index.load()
 
     def choose_sense_category(self, agent, category):
         """Determine if an agent belongs to a particular category
@@ -50,22 +44,14 @@ class BioSense(object):
         reg_cat = category.lower().replace('-', ' ')
         reg_cat = reg_cat.replace('W::', '').replace('w::', '')
         logger.info("Regularized category to \"{}\".".format(reg_cat))
-        if reg_cat in ['kinase', 'kinase activity']:
-            output = agent.name in self._kinase_list
-        elif reg_cat == 'transcription factor':
-            output = agent.name in self._tf_list
-        elif reg_cat == 'phosphatase':
-            output = agent.name in self._phosphatase_list
-        elif reg_cat == 'enzyme':
-            output = (agent.name in self._phosphatase_list or
-                      agent.name in self._kinase_list)
-        else:
+        mask = get_category_mask(reg_cat)
+        if mask is None:
             logger.info("Regularized category %s not recognized: options "
                         "are %s." % (reg_cat, ['kinase', 'kinase activity',
                                                'enzyme', 'transcription factor',
                                                'phosphatase']))
             raise UnknownCategoryError('category not recognized')
-        return output
+        return self._entity_types.is_category(agent, mask)
 
     def choose_sense_is_member(self, agent, collection):
         """Determine if an agent is a member of a collection
@@ -90,6 +76,7 @@ class BioSense(object):
         if 'FPLX' not in collection.db_refs:
             raise CollectionNotFamilyOrComplexError(
                 '%s is not a family or complex' % collection)
+        from indra.preassembler.hierarchy_manager import hierarchies
         return agent.isa(collection, hierarchies)
 
     def choose_sense_what_member(self, collection):
@@ -139,7 +126,7 @@ class BioSense(object):
         if up_id:
             synonyms = uniprot_client.get_synonyms(up_id)
         elif fplx_id:
-            synonyms = self._fplx_synonyms.get(fplx_id, [])
+            synonyms = fplx_synonyms.load().get(fplx_id, [])
         else:
             raise SynonymsUnknownError('We don\'t provide synonyms for '
                                        'this type of agent.')
@@ -149,6 +136,7 @@ class BioSense(object):
 def _get_members(agent):
     if 'FPLX' not in agent.db_refs:
         return None
+    from indra.preassembler.hierarchy_manager import hierarchies
     dbname, dbid = 'FPLX', agent.db_refs['FPLX']
     eh = hierarchies['entity']
     uri = eh.get_uri(dbname, dbid)
@@ -158,30 +146,9 @@ def _get_members(agent):
     return children_agents
 
 
-def _read_phosphatases():
-    p_table = read_unicode_csv(_indra_path +
-                               '/resources/phosphatases.tsv', delimiter='\t')
-    # First column is phosphatase names
-    # Second column is HGNC ids
-    p_names = [row[0] for row in p_table]
-    return p_names
-
-
-def _read_kinases():
-    kinase_table = read_unicode_csv(_indra_path + '/resources/kinases.tsv',
-                                    delimiter='\t')
-    gene_names = [lin[1] for lin in list(kinase_table)[1:]]
-    return gene_names
-
-
-def _read_tfs():
-    tf_table = read_unicode_csv(_indra_path +
-                                '/resources/transcription_factors.csv')
-    gene_names = [lin[1] for lin in list(tf_table)[1:]]
-    return gene_names
-
-
 def _make_fplx_synonyms():
+    from indra.preassembler.grounding_mapper import \
+        default_grounding_map as gm
     fplx_synonyms = {}
     for txt, db_refs in gm.items():
         if not db_refs:
@@ -195,6 +162,13 @@ def _make_fplx_synonyms():
     return fplx_synonyms
 
 
+# These resources are shared with the other agents (e.g. the MSA uses them to
+# filter by entity type), and are only read the first time they are needed.
+entity_type_index = LazyComponent('biosense.entity_types',
+                                  EntityTypeIndex.load)
+fplx_synonyms = LazyComponent('biosense.fplx_synonyms', _make_fplx_synonyms)
+
+
 class InvalidAgentError(ValueError):
     """raised if agent not recognized"""
     pass
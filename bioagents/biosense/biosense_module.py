@@ -3,6 +3,7 @@ import logging
 import indra
 from indra.databases import uniprot_client, get_identifiers_url
 from bioagents import Bioagent, add_agent_type
+from bioagents.startup import profile_startup
 from kqml import  KQMLString
 from .biosense import BioSense
 from .biosense import UnknownCategoryError, SynonymsUnknownError
@@ -29,6 +30,7 @@ class BioSense_Module(Bioagent):
     tasks = ['CHOOSE-SENSE', 'CHOOSE-SENSE-CATEGORY',
              'CHOOSE-SENSE-IS-MEMBER', 'CHOOSE-SENSE-WHAT-MEMBER',
              'GET-SYNONYMS', 'GET-INDRA-REPRESENTATION']
+    cacheable_tasks = {'CHOOSE-SENSE-CATEGORY': None, 'GET-SYNONYMS': None}
 
     def respond_get_indra_representation(self, content):
         """Return the INDRA CL-JSON corresponding to the given content."""
@@ -203,4 +205,7 @@ class BioSense_Module(Bioagent):
 
 
 if __name__ == "__main__":
-    BioSense_Module(argv=sys.argv[1:])
+    if '--profile-startup' in sys.argv:
+        profile_startup(BioSense_Module)
+    else:
+        BioSense_Module(argv=sys.argv[1:])
@@ -0,0 +1,175 @@
+"""An index of the kinases, phosphatases and transcription factors.
+
+BioSense and the MSA classify agents by these types of entity. The index
+gives the categories of each gene as bits of an int, looked up by the name of
+an agent, so classifying an agent takes a dict lookup, and a batch of agents
+can be classified in one call. As with the name lists the index replaced, an
+agent is classified by its name only, not by its grounding.
+
+The index is built from the tables of kinases, phosphatases and
+transcription factors of INDRA, and stored in resources/entity_types.tsv,
+with a digest of the tables it was built from. It is rebuilt when the
+package is built (see setup.py), or by running
+
+    python bioagents/biosense/entity_types.py
+
+If the stored index is missing, or was built from other tables, it is built
+when it is first needed instead. Other versions of INDRA with the same
+tables, e.g. installed from git, use the stored index.
+
+This module only depends on INDRA, so that it can be run at build time.
+"""
+__all__ = ['EntityTypeIndex', 'KINASE', 'PHOSPHATASE', 'TF',
+           'get_category_mask']
+
+import os
+import hashlib
+import logging
+
+logger = logging.getLogger('BioSense')
+
+
+INDEX_PATH = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'resources',
+    'entity_types.tsv'))
+
+# The version of the format of the stored index.
+INDEX_VERSION = 3
+
+# The tables of INDRA the index is built from.
+_source_tables = ['kinases.tsv', 'phosphatases.tsv',
+                  'transcription_factors.csv']
+
+KINASE = 1
+PHOSPHATASE = 2
+TF = 4
+
+# The categories of BioSense and the entity types of the MSA, as bits.
+_category_masks = {'kinase': KINASE,
+                   'kinase activity': KINASE,
+                   'phosphatase': PHOSPHATASE,
+                   'transcription factor': TF,
+                   'TF': TF,
+                   'enzyme': KINASE | PHOSPHATASE}
+
+
+def get_category_mask(category):
+    """Return the bits of a category, or None if it is not known."""
+    return _category_masks.get(category)
+
+
+class EntityTypeIndex(object):
+    """The categories of genes, by name.
+
+    Parameters
+    ----------
+    by_name : dict
+        The categories of genes (as bits) by name.
+    """
+    def __init__(self, by_name):
+        self.by_name = by_name
+
+    def get_categories(self, agent):
+        """Return the categories of an agent, as bits."""
+        return self.by_name.get(agent.name, 0)
+
+    def is_category(self, agent, mask):
+        """Return True if an agent is in any of the categories of `mask`."""
+        return bool(self.get_categories(agent) & mask)
+
+    def classify(self, agents, mask):
+        """Return whether each of a batch of agents is in the categories.
+
+        Agents with the same name are only looked up once.
+        """
+        by_name = {}
+        matches = []
+        for agent in agents:
+            match = by_name.get(agent.name)
+            if match is None:
+                match = self.is_category(agent, mask)
+                by_name[agent.name] = match
+            matches.append(match)
+        return matches
+
+    def get_names(self, mask):
+        """Return the names of the genes in the categories of `mask`."""
+        return sorted(name for name, categories in self.by_name.items()
+                      if categories & mask)
+
+    @classmethod
+    def from_tables(cls):
+        """Build the index from the tables of INDRA."""
+        from indra import __path__ as indra_path
+        from indra.util import read_unicode_csv
+        resources = os.path.join(indra_path[0], 'resources')
+        by_name = {}
+
+        def add(name, category):
+            by_name[name] = by_name.get(name, 0) | category
+
+        # The second column has the gene names.
+        rows = read_unicode_csv(os.path.join(resources, 'kinases.tsv'),
+                                delimiter='\t')
+        for row in list(rows)[1:]:
+            add(row[1], KINASE)
+        # The first column has the gene names.
+        rows = read_unicode_csv(os.path.join(resources, 'phosphatases.tsv'),
+                                delimiter='\t')
+        for row in rows:
+            add(row[0], PHOSPHATASE)
+        # The second column has the gene names.
+        rows = read_unicode_csv(os.path.join(resources,
+                                             'transcription_factors.csv'))
+        for row in list(rows)[1:]:
+            add(row[1], TF)
+        return cls(by_name)
+
+    def save(self, fname=INDEX_PATH):
+        """Store the index in a TSV file."""
+        with open(fname, 'w') as fh:
+            fh.write(_get_header())
+            for name, categories in sorted(self.by_name.items()):
+                fh.write('%s\t%d\n' % (name, categories))
+        return fname
+
+    @classmethod
+    def load(cls, fname=INDEX_PATH):
+        """Return the stored index.
+
+        The index is built instead if it was not stored, or was stored in
+        another format or from other tables.
+        """
+        try:
+            header = _get_header()
+            with open(fname, 'r') as fh:
+                if fh.readline() != header:
+                    logger.info('The entity type index in %s is out of '
+                                'date, building it.' % fname)
+                    return cls.from_tables()
+                by_name = {}
+                for line in fh:
+                    name, categories = line.rstrip('\n').split('\t')
+                    by_name[name] = int(categories)
+        except (IOError, ValueError) as e:
+            logger.info('Could not load the entity type index from %s (%s), '
+                        'building it.' % (fname, e))
+            return cls.from_tables()
+        return cls(by_name)
+
+
+def _get_header():
+    """Return the header of the stored index, with a digest of its tables."""
+    from indra import __path__ as indra_path
+    resources = os.path.join(indra_path[0], 'resources')
+    tables_digest = hashlib.sha1()
+    for table in _source_tables:
+        with open(os.path.join(resources, table), 'rb') as fh:
+            tables_digest.update(fh.read())
+    return '# version=%d tables=%s\n' % (INDEX_VERSION,
+                                         tables_digest.hexdigest())
+
+
+if __name__ == '__main__':
+    print('Wrote the entity type index to %s.'
+          % EntityTypeIndex.from_tables().save())
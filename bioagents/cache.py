@@ -0,0 +1,128 @@
+"""Bounded, thread safe caches used by the bioagents."""
+__all__ = ['LRUCache', 'digest']
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread safe least-recently-used cache that counts its hits.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of entries kept. When a new entry is added to a
+        full cache, the least recently used entry is evicted.
+    ttl : float or None
+        The default number of seconds after which an entry expires. If None,
+        entries do not expire.
+    max_weight : float or None
+        If given, least recently used entries are also evicted while the
+        total weight of the entries is above this.
+    get_weight : callable or None
+        A function returning the weight of a value (e.g. its size), used
+        with `max_weight`. By default each entry weighs 1.
+    """
+    def __init__(self, maxsize=128, ttl=None, max_weight=None,
+                 get_weight=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.get_weight = get_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _weigh(self, value):
+        return self.get_weight(value) if self.get_weight is not None else 1
+
+    def _evict(self, key):
+        value, _ = self._data.pop(key)
+        self.weight -= self._weigh(value)
+
+    def get(self, key, default=None):
+        """Return the value cached for key, or `default` if there is none."""
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.monotonic():
+                self._evict(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        """Cache a value, evicting the least recently used entry if full.
+
+        If `ttl` is given, the entry expires after that many seconds instead
+        of after the default `ttl` of the cache.
+        """
+        if self.maxsize <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        weight = self._weigh(value)
+        if self.max_weight is not None and weight > self.max_weight:
+            return
+        with self._lock:
+            if key in self._data:
+                self._evict(key)
+            self._data[key] = (value, expires)
+            self.weight += weight
+            while len(self._data) > self.maxsize or \
+                    (self.max_weight is not None and
+                     self.weight > self.max_weight):
+                self._evict(next(iter(self._data)))
+
+    def discard(self, key):
+        """Remove an entry, if it is cached."""
+        with self._lock:
+            if key in self._data:
+                self._evict(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._data:
+                return False
+            expires = self._data[key][1]
+            return expires is None or expires > time.monotonic()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups that were hits, or None if none were made.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def stats(self):
+        """Return a dict summarizing the use of the cache."""
+        return {'size': len(self._data), 'maxsize': self.maxsize,
+                'weight': self.weight, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate}
+
+
+def digest(text):
+    """Return a short, stable digest of a string, for use as a cache key."""
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
@@ -11,7 +11,8 @@ from itertools import groupby
 
 from indra.sources.indra_db_rest import get_statements
 from indra.databases import cbio_client, hgnc_client
-from bioagents import BioagentException
+from bioagents import BioagentException, get_request_context
+from bioagents.startup import LazyMapping
 from indra.statements import Agent, MutCondition, InvalidResidueError
 
 logger = logging.getLogger('DTDA')
@@ -43,7 +44,7 @@ def _make_cbio_efo_map():
     return cbio_efo_map
 
 
-cbio_efo_map = _make_cbio_efo_map()
+cbio_efo_map = LazyMapping('dtda.cbio_efo_map', _make_cbio_efo_map)
 
 
 class DTDA(object):
@@ -258,7 +259,15 @@ class DTDA(object):
         logger.info("Found %d studies and a gene_list of %d elements."
                     % (len(study_ids), len(gene_list)))
         mut_patt = re.compile("([A-Z]+)(\d+)([A-Z]+)")
+        context = get_request_context()
         for study_id in study_ids:
+            # If the deadline passed, we return the statistics of the studies
+            # done so far.
+            if mutation_dict and context.expired():
+                logger.warning('Deadline passed, returning the mutation '
+                               'statistics found so far.')
+                break
+            context.check()
             try:
                 num_case += cbio_client.get_num_sequenced(study_id)
             except Exception as e:
@@ -5,6 +5,7 @@ from indra.statements import Agent
 from kqml import KQMLList, KQMLString
 from .dtda import DTDA, DrugNotFoundException, DiseaseNotFoundException
 from bioagents import Bioagent
+from bioagents.startup import profile_startup
 from indra.databases import hgnc_client
 
 
@@ -21,6 +22,12 @@ class DTDA_Module(Bioagent):
     tasks = ['IS-DRUG-TARGET', 'FIND-TARGET-DRUG', 'FIND-DRUG-TARGETS',
              'FIND-DISEASE-TARGETS', 'FIND-TREATMENT', 'GET-ALL-DRUGS',
              'GET-ALL-DISEASES', 'GET-ALL-GENE-TARGETS']
+    # The targets of drugs come from the database, so they are refreshed
+    # after an hour; the list of drugs is fixed when the DTDA starts.
+    cacheable_tasks = {'FIND-DRUG-TARGETS': 3600, 'GET-ALL-DRUGS': None}
+    # The mutation statistics of the studies looked up before the deadline
+    # are used.
+    task_timeouts = {'FIND-DISEASE-TARGETS': 120, 'FIND-TREATMENT': 120}
 
     def __init__(self, **kwargs):
         # Instantiate a singleton DTDA agent
@@ -231,4 +238,7 @@ class DTDA_Module(Bioagent):
 
 
 if __name__ == "__main__":
-    DTDA_Module(argv=sys.argv[1:])
+    if '--profile-startup' in sys.argv:
+        profile_startup(DTDA_Module)
+    else:
+        DTDA_Module(argv=sys.argv[1:])
@@ -0,0 +1,131 @@
+"""Logging helpers for the bioagents.
+
+Log files are written by a background thread: records are put on a queue by
+a QueueHandler, and a QueueListener writes them to the file, so that disk
+I/O never happens on the thread handling a request. Each log file is set up
+once per process, however many agents share it.
+
+Log sites on hot paths can use a RateLimitedLogger, which emits a given
+message at most once per interval and reports how many were suppressed.
+"""
+__all__ = ['add_log_file', 'stop_log_files', 'RateLimitedLogger']
+
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s: %(name)s - %(message)s'
+
+
+_log_files = {}
+_log_files_lock = threading.Lock()
+
+
+def add_log_file(fname, logger_name='Bioagents', use_queue=True):
+    """Write the records of a logger to a file, from a background thread.
+
+    Calling this again with the same file and logger does nothing, so agents
+    sharing a process don't write each record more than once.
+
+    Parameters
+    ----------
+    fname : str
+        The path of the log file.
+    logger_name : str
+        The name of the logger whose records are written.
+    use_queue : bool
+        If True (the default), records are written by a QueueListener
+        thread. If False, they are written synchronously.
+
+    Returns
+    -------
+    fname : str
+        The path of the log file.
+    """
+    key = (fname, logger_name)
+    with _log_files_lock:
+        if key in _log_files:
+            return fname
+        file_handler = logging.FileHandler(fname)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        if use_queue:
+            log_queue = queue.Queue(-1)
+            handler = QueueHandler(log_queue)
+            listener = QueueListener(log_queue, file_handler,
+                                     respect_handler_level=True)
+            listener.start()
+        else:
+            handler = file_handler
+            listener = None
+        handler.setLevel(logging.DEBUG)
+        logging.getLogger(logger_name).addHandler(handler)
+        _log_files[key] = (handler, listener)
+    return fname
+
+
+@atexit.register
+def stop_log_files():
+    """Write out the queued records and stop the background writers."""
+    with _log_files_lock:
+        for handler, listener in _log_files.values():
+            if listener is not None:
+                listener.stop()
+                for file_handler in listener.handlers:
+                    file_handler.close()
+            else:
+                handler.close()
+        _log_files.clear()
+
+
+class RateLimitedLogger(object):
+    """Wraps a logger, emitting each message at most once per interval.
+
+    Messages are told apart by their format string (or an explicit `key`),
+    so messages should be logged with arguments, e.g.
+    `rl_logger.info('Sim time percentage: %d', pct)`, rather than formatted
+    beforehand. When a message is emitted after others like it were
+    suppressed, the number suppressed is added to it.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        The logger to emit messages with.
+    interval : float
+        The minimum number of seconds between two messages with the same key.
+    """
+    def __init__(self, logger, interval=5.0):
+        self.logger = logger
+        self.interval = interval
+        self._last = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def log(self, level, msg, *args, **kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        key = kwargs.pop('key', msg)
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+            self._last[key] = now
+            num_suppressed = self._suppressed.pop(key, 0)
+        if num_suppressed:
+            msg = '%s (%d similar messages suppressed)' % (msg, num_suppressed)
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
@@ -0,0 +1,397 @@
+"""Per-task request metrics for bioagents.
+
+Every request a Bioagent handles is recorded in a process-wide registry,
+keyed by agent name and task. For each task the registry keeps a latency
+histogram, recent latency quantiles, request rates, the number of requests
+in flight, the number answered from the response cache and the failure
+reasons returned with `make_failure`.
+
+The registry can be written out as JSON or as Prometheus text, either to a
+local file or served over HTTP, for instance:
+
+    registry.dump('metrics.prom')
+    registry.serve(9100)
+"""
+__all__ = ['MetricsRegistry', 'TaskMetrics', 'registry']
+
+import os
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from collections import deque, Counter
+
+logger = logging.getLogger('Bioagents')
+
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 15.0, 30.0, 60.0, 120.0)
+
+# The quantiles reported for recent requests.
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class TaskMetrics(object):
+    """Metrics collected for the requests of one task of one agent.
+
+    Parameters
+    ----------
+    agent : str
+        The name of the agent.
+    task : str
+        The name of the task, e.g. BUILD-MODEL.
+    buckets : tuple[float]
+        The upper bounds of the latency histogram buckets, in seconds.
+    window : int
+        The number of most recent requests used to compute quantiles and
+        the recent request rate.
+    """
+    def __init__(self, agent, task, buckets=DEFAULT_BUCKETS, window=1000):
+        self.agent = agent
+        self.task = task
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total_time = 0.0
+        self.in_flight = 0
+        self.cache_hits = 0
+        self.failures = Counter()
+        self._recent = deque(maxlen=window)
+        self._created = time.time()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Record the start of a request, returning its start time."""
+        with self._lock:
+            self.in_flight += 1
+        return time.time()
+
+    def finish(self, start_time, reason=None, cached=False):
+        """Record the end of a request started at `start_time`.
+
+        If `reason` is given, the request is counted as a failure with that
+        reason. If `cached` is True, the request was answered from the
+        response cache.
+        """
+        end_time = time.time()
+        duration = end_time - start_time
+        with self._lock:
+            self.in_flight -= 1
+            self.count += 1
+            self.total_time += duration
+            self.bucket_counts[bisect_left(self.buckets, duration)] += 1
+            self._recent.append((end_time, duration))
+            if cached:
+                self.cache_hits += 1
+            if reason is not None:
+                self.failures[reason] += 1
+        return duration
+
+    def get_quantiles(self):
+        """Return a dict of latency quantiles over the recent requests."""
+        with self._lock:
+            durations = sorted(d for _, d in self._recent)
+        if not durations:
+            return {q: None for q in QUANTILES}
+        return {q: durations[min(int(q * len(durations)), len(durations) - 1)]
+                for q in QUANTILES}
+
+    def get_rate(self):
+        """Return the number of requests per second over the recent window."""
+        with self._lock:
+            if not self._recent:
+                return 0.0
+            start = self._recent[0][0]
+            if len(self._recent) < self._recent.maxlen:
+                start = self._created
+            num = len(self._recent)
+        elapsed = time.time() - start
+        return num / elapsed if elapsed > 0 else 0.0
+
+    def to_json(self):
+        quantiles = self.get_quantiles()
+        rate = self.get_rate()
+        with self._lock:
+            num_failed = sum(self.failures.values())
+            return {
+                'agent': self.agent,
+                'task': self.task,
+                'count': self.count,
+                'in_flight': self.in_flight,
+                'cache_hits': self.cache_hits,
+                'total_time': self.total_time,
+                'mean_time': self.total_time / self.count
+                if self.count else None,
+                'p50': quantiles[0.5],
+                'p95': quantiles[0.95],
+                'p99': quantiles[0.99],
+                'rate': rate,
+                'error_rate': num_failed / self.count if self.count else 0.0,
+                'failures': dict(self.failures),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'],
+                                    self.bucket_counts)),
+                }
+
+
+class _RequestRecord(object):
+    """The record of a single request, used by `MetricsRegistry.track`."""
+    def __init__(self):
+        self.reason = None
+        self.cached = False
+
+    def fail(self, reason):
+        self.reason = reason
+
+    def cache_hit(self):
+        """Note that the reply was taken from the response cache."""
+        self.cached = True
+
+    def set_reply(self, reply_content):
+        """Note the failure reason if the reply content is a failure."""
+        try:
+            if reply_content.head().upper() == 'FAILURE':
+                reason = reply_content.gets('reason')
+                self.reason = reason if reason else 'UNKNOWN'
+        except Exception:
+            pass
+
+
+class MetricsRegistry(object):
+    """A thread safe collection of the TaskMetrics in a process."""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._tasks = {}
+        self._caches = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._dump_thread = None
+
+    def get(self, agent, task):
+        """Get the TaskMetrics for an agent and task, creating it if needed."""
+        key = (agent, task)
+        with self._lock:
+            if key not in self._tasks:
+                self._tasks[key] = TaskMetrics(agent, task, self.buckets)
+            return self._tasks[key]
+
+    def track(self, agent, task):
+        """Return a context manager recording one request for the task.
+
+        Within the context, the failure reason of the request can be set with
+        `record.fail(reason)` or taken from the reply with
+        `record.set_reply(reply_content)`, and a reply from the response cache
+        noted with `record.cache_hit()`. An exception leaving the context is
+        counted as a failure with the name of the exception as reason.
+        """
+        return _Tracker(self.get(agent, task))
+
+    def record_failure(self, agent, task, reason):
+        """Record a request that failed before a response was attempted."""
+        task_metrics = self.get(agent, task)
+        task_metrics.finish(task_metrics.start(), reason)
+
+    def register_cache(self, name, cache):
+        """Include the statistics of a cache (see bioagents.cache) in reports.
+        """
+        with self._lock:
+            self._caches[name] = cache
+
+    def reset(self):
+        with self._lock:
+            self._tasks = {}
+
+    def to_json(self):
+        with self._lock:
+            tasks = list(self._tasks.values())
+            caches = sorted(self._caches.items())
+        return {'time': time.time(),
+                'tasks': [tm.to_json() for tm in tasks],
+                'caches': {name: cache.stats() for name, cache in caches}}
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            tasks = list(self._tasks.values())
+            caches = sorted(self._caches.items())
+        lines = []
+
+        def add_header(name, mtype, help_txt):
+            lines.append('# HELP %s %s' % (name, help_txt))
+            lines.append('# TYPE %s %s' % (name, mtype))
+
+        def labels(tm, **extra):
+            lbls = [('agent', tm.agent), ('task', tm.task)] + \
+                sorted(extra.items())
+            return '{%s}' % ','.join('%s="%s"' % (k, _escape(v))
+                                     for k, v in lbls)
+
+        name = 'bioagent_request_duration_seconds'
+        add_header(name, 'histogram', 'Time taken to respond to a request.')
+        for tm in tasks:
+            with tm._lock:
+                cumulative = 0
+                for ub, cnt in zip(list(tm.buckets) + ['+Inf'],
+                                   tm.bucket_counts):
+                    cumulative += cnt
+                    lines.append('%s_bucket%s %d'
+                                 % (name, labels(tm, le=ub), cumulative))
+                lines.append('%s_sum%s %f' % (name, labels(tm),
+                                              tm.total_time))
+                lines.append('%s_count%s %d' % (name, labels(tm), tm.count))
+
+        name = 'bioagent_request_duration_quantile_seconds'
+        add_header(name, 'gauge', 'Latency quantiles of recent requests.')
+        for tm in tasks:
+            for q, val in sorted(tm.get_quantiles().items()):
+                if val is not None:
+                    lines.append('%s%s %f' % (name, labels(tm, quantile=q),
+                                              val))
+
+        name = 'bioagent_requests_per_second'
+        add_header(name, 'gauge', 'Rate of recent requests.')
+        for tm in tasks:
+            lines.append('%s%s %f' % (name, labels(tm), tm.get_rate()))
+
+        name = 'bioagent_requests_in_flight'
+        add_header(name, 'gauge', 'Requests currently being handled.')
+        for tm in tasks:
+            lines.append('%s%s %d' % (name, labels(tm), tm.in_flight))
+
+        name = 'bioagent_response_cache_hits_total'
+        add_header(name, 'counter', 'Requests answered from the response '
+                   'cache.')
+        for tm in tasks:
+            lines.append('%s%s %d' % (name, labels(tm), tm.cache_hits))
+
+        name = 'bioagent_request_failures_total'
+        add_header(name, 'counter', 'Failed requests by failure reason.')
+        for tm in tasks:
+            with tm._lock:
+                failures = sorted(tm.failures.items())
+            for reason, cnt in failures:
+                lines.append('%s%s %d' % (name, labels(tm, reason=reason),
+                                          cnt))
+
+        cache_stats = [(cname, cache.stats()) for cname, cache in caches]
+        for stat, mtype, help_txt in [('hits', 'counter', 'Cache hits.'),
+                                      ('misses', 'counter', 'Cache misses.'),
+                                      ('size', 'gauge', 'Cache entries.')]:
+            name = 'bioagent_cache_%s' % stat
+            add_header(name, mtype, help_txt)
+            for cname, stats in cache_stats:
+                lines.append('%s{cache="%s"} %d' % (name, _escape(cname),
+                                                    stats[stat]))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, fname, fmt=None):
+        """Write the metrics to a file.
+
+        Parameters
+        ----------
+        fname : str
+            The path of the file to write.
+        fmt : 'json', 'prometheus' or None
+            The format of the output. If None, files ending in .prom or .txt
+            are written as Prometheus text, others as JSON.
+        """
+        if fmt is None:
+            fmt = 'prometheus' if fname.endswith(('.prom', '.txt')) \
+                else 'json'
+        if fmt == 'prometheus':
+            out = self.to_prometheus()
+        elif fmt == 'json':
+            out = json.dumps(self.to_json(), indent=1)
+        else:
+            raise ValueError('Unknown metrics format: %s' % fmt)
+        # Write to a temporary file first so readers never see a partial dump.
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'w') as fh:
+            fh.write(out)
+        os.replace(tmp_fname, fname)
+        return fname
+
+    def start_periodic_dump(self, fname, interval=10, fmt=None):
+        """Dump the metrics to a file every `interval` seconds in a thread."""
+        if self._dump_thread is not None:
+            return
+
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(fname, fmt)
+                except Exception as e:
+                    logger.warning('Could not dump metrics to %s: %s'
+                                   % (fname, e))
+
+        self._dump_thread = threading.Thread(target=dump_loop, daemon=True)
+        self._dump_thread.start()
+        logger.info('Dumping metrics to %s every %s seconds.'
+                    % (fname, interval))
+
+    def serve(self, port, host='localhost'):
+        """Serve the metrics over HTTP from a background thread.
+
+        Prometheus text is served at /metrics and JSON at /metrics.json.
+        """
+        if self._server is not None:
+            return self._server
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        metrics_registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics.json'):
+                    body = json.dumps(metrics_registry.to_json())
+                    ctype = 'application/json'
+                elif self.path.startswith('/metrics'):
+                    body = metrics_registry.to_prometheus()
+                    ctype = 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer((host, port), MetricsHandler)
+        th = threading.Thread(target=self._server.serve_forever, daemon=True)
+        th.start()
+        logger.info('Serving metrics at http://%s:%d/metrics'
+                    % (host, self._server.server_port))
+        return self._server
+
+
+class _Tracker(object):
+    def __init__(self, task_metrics):
+        self.task_metrics = task_metrics
+        self.record = _RequestRecord()
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = self.task_metrics.start()
+        return self.record
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and self.record.reason is None:
+            self.record.fail(exc_type.__name__)
+        self.task_metrics.finish(self.start_time, self.record.reason,
+                                 self.record.cached)
+        return False
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+# The registry shared by all the agents in a process.
+registry = MetricsRegistry()
@@ -5,14 +5,12 @@ import random
 import logging
 from threading import Thread
 
-import pysb.export
-
 from indra.databases import hgnc_client
 from indra.assemblers.english import EnglishAssembler
 from indra.sources.trips.processor import TripsProcessor
 from indra.preassembler.hierarchy_manager import hierarchies
-from indra.statements import stmts_to_json, Complex, SelfModification,\
-    ActiveForm
+from indra.statements import stmts_to_json, Agent, Complex, \
+    SelfModification, ActiveForm
 from indra import has_config
 
 from kqml import KQMLPerformative, KQMLList, KQMLString
@@ -22,6 +20,7 @@ logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
 logger = logging.getLogger('MRA')
 
 from bioagents import Bioagent, BioagentException
+from bioagents.startup import profile_startup
 from .mra import MRA
 
 
@@ -466,25 +465,28 @@ class MRA_Module(Bioagent):
 
         def send_support():
             for_what = 'the mechanism you added'
-            for stmt in stmts:
-                try:
-                    idp = _get_matching_stmts(stmt)
-                    matched = idp.statements
-                    logger.info("Found %d statements supporting %s"
-                                % (len(matched), stmt))
-                except Exception as e:
+            # The supporting statements are looked for all at once.
+            try:
+                supports = _get_supporting_stmts(stmts)
+            except Exception as e:
+                logger.error("Got exception while looking for support.")
+                logger.exception(e)
+                supports = [e] * len(stmts)
+            for stmt, support in zip(stmts, supports):
+                if isinstance(support, Exception):
                     logger.error("Got exception while looking for support for "
                                  "%s" % stmt)
-                    logger.exception(e)
+                    logger.exception(support)
                     self.send_null_provenance(stmt, for_what,
                                               'due to an internal error')
                     continue
+                matched, ev_totals, source_counts = support
+                logger.info("Found %d statements supporting %s"
+                            % (len(matched), stmt))
                 if matched:
-                    ev_totals = {int(k): v for k, v in
-                                 idp.get_ev_counts().items()}
                     self.send_provenance_for_stmts(matched, for_what,
                         ev_counts=ev_totals,
-                        source_counts=idp.get_source_counts())
+                        source_counts=source_counts)
                 else:
                     self.send_null_provenance(stmt, for_what)
 
@@ -549,6 +551,7 @@ def get_target(target_str):
 
 
 def encode_pysb_model(pysb_model):
+    import pysb.export
     model_str = pysb.export.export(pysb_model, 'pysb_flat')
     model_str = str(model_str.strip())
     return model_str
@@ -633,7 +636,87 @@ def _get_matching_stmts(stmt_ref):
     return get_statements(stmt_type=stmt_type, **kwargs)
 
 
+def _get_ref_agent(agent):
+    """Return an agent grounded only to the ref of an agent for the db web
+    api, so that the MSA queries the same ref as `_get_matching_stmts`."""
+    dbi, dbn = _get_agent_ref(agent).rsplit('@', 1)
+    return Agent(agent.name, db_refs={dbn: dbi})
+
+
+def _get_support_query(stmt_ref):
+    """Return the MSA query for statements matching a statement, or None if
+    the MSA can't make the same query as `_get_matching_stmts`."""
+    agents = stmt_ref.agent_list()
+    if None in agents:
+        # The MSA would query the statements to or from the other agent,
+        # leaving out those with a missing subject or object.
+        return None
+    verb = stmt_ref.__class__.__name__
+    if isinstance(stmt_ref, Complex):
+        # The MSA queries the Complexes of two agents by both agents, like
+        # `_get_matching_stmts`, but has no query for those of more agents.
+        if len(agents) != 2:
+            return None
+        return {'agents': [_get_ref_agent(ag) for ag in agents],
+                'verb': verb}
+    # The other statements about one agent (e.g. ActiveForm) are queried by
+    # agent, which the MSA only does for Complexes.
+    if isinstance(stmt_ref, (SelfModification, ActiveForm)) or \
+            len(agents) != 2:
+        return None
+    return {'subject': _get_ref_agent(agents[0]),
+            'object': _get_ref_agent(agents[1]), 'verb': verb}
+
+
+def _get_supporting_stmts(stmts):
+    """Look for the statements matching each of a list of statements.
+
+    The queries are run as a batch by the MSA. Statements for which the MSA
+    can't make a query are looked up with `_get_matching_stmts`. If the
+    INDRA DB can't be queried, no statements are found.
+
+    Returns
+    -------
+    supports : list
+        For each statement, the matching statements, their evidence totals
+        and their source counts, or the exception raised looking for them.
+    """
+    if not CAN_CHECK_STATEMENTS:
+        return [([], {}, {}) for _ in stmts]
+    from bioagents.msa.msa import MSA
+    queries = [_get_support_query(stmt) for stmt in stmts]
+    batch_idx = [idx for idx, query in enumerate(queries) if query]
+    finders = MSA().find_mechanisms_batch([queries[idx] for idx in batch_idx],
+                                          ev_limit=2, persist=False)
+    found = dict(zip(batch_idx, finders))
+    supports = []
+    for idx, stmt in enumerate(stmts):
+        try:
+            if idx in found:
+                finder = found[idx]
+                if isinstance(finder, Exception):
+                    raise finder
+                matched = finder.get_statements()
+                if matched is None:
+                    raise BioagentException('Timed out looking for '
+                                            'statements.')
+                supports.append((matched, finder.get_ev_totals(),
+                                 finder.get_source_counts()))
+            else:
+                idp = _get_matching_stmts(stmt)
+                supports.append((idp.statements,
+                                 {int(k): v for k, v in
+                                  idp.get_ev_counts().items()},
+                                 idp.get_source_counts()))
+        except Exception as e:
+            supports.append(e)
+    return supports
+
+
 _resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/../resources/'
 
 if __name__ == "__main__":
-    MRA_Module(argv=sys.argv[1:])
+    if '--profile-startup' in sys.argv:
+        profile_startup(MRA_Module)
+    else:
+        MRA_Module(argv=sys.argv[1:])
@@ -5,17 +5,17 @@ import json
 import copy
 import logging
 import collections
-from matplotlib import cm
-from matplotlib import colors
 
 from indra.statements import *
 from indra.sources.indra_db_rest import get_statements
 from indra.tools.expand_families import Expander
 from indra.preassembler.hierarchy_manager import hierarchies
 from indra.databases import context_client
+from bioagents.logs import RateLimitedLogger
 
 
 logger = logging.getLogger('sbgn_colorizer')
+rl_logger = RateLimitedLogger(logger)
 
 # How a node should be colorized
 Style = collections.namedtuple('Style', ['border_color', 'fill_color'])
@@ -185,7 +185,7 @@ class SbgnColorizer(object):
         color: str
             The hex color string for the chosen stroke color
         """
-        logger.info('Getting mutation status of proteins')
+        rl_logger.info('Getting mutation status of proteins')
         mut_statuses = self.get_mutations(gene_name, cell_line)
         assert len(mut_statuses.keys()) == 1, mut_statuses
 
@@ -238,8 +238,8 @@ class SbgnColorizer(object):
 
             # Compute mean expression level
             expression_levels = []
-            logger.info('Getting expression status of proteins: %s' %
-                        str(gene_names))
+            rl_logger.info('Getting expression status of proteins: %s',
+                           str(gene_names))
             l = self.get_expression(gene_names, cell_line)
             for line in l:
                 for element in l[line]:
@@ -279,6 +279,8 @@ class SbgnColorizer(object):
                 agent_to_score[agent] = (level - min_level) / level_span
 
         # Map scores to colors and assign colors to labels
+        from matplotlib import cm
+        from matplotlib import colors
         agent_to_color = {}
         for agent, score in agent_to_score.items():
             if 'HGNC' not in agent.db_refs and 'FPLX' not in agent.db_refs:
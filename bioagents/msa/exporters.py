@@ -0,0 +1,214 @@
+"""Export the statements found by the MSA to files, in several formats.
+
+The statements are written to the file in chunks as they are serialized, so
+the whole output is never held in memory, however many statements there
+are. The formats are:
+
+    tsv     a line per statement, with the text and PMID of its first
+            evidence
+    jsonl   a line per statement with its JSON (JSON Lines)
+    json    a JSON list of the statements, compact unless an indent is
+            given
+    pickle  a series of pickled lists of statements, one per chunk, read
+            back with `load_pickled_statements`
+
+Any of them can be gzipped. Exports written to a path are written to a
+temporary file first, so concurrent exports never see each other's partial
+files, and `get_export_fname` gives unique file names to callers that don't
+need a particular one.
+"""
+__all__ = ['EXPORT_FORMATS', 'export_statements', 'get_export_fname',
+           'load_pickled_statements']
+
+import io
+import os
+import gzip
+import json
+import pickle
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger('MSA')
+
+
+def _iter_tsv(stmts):
+    for stmt in stmts:
+        if not stmt.evidence:
+            logger.warning('Statement %s without evidence' % stmt.uuid)
+            txt = ''
+            pmid = ''
+        else:
+            txt = stmt.evidence[0].text if stmt.evidence[0].text else ''
+            pmid = stmt.evidence[0].pmid if stmt.evidence[0].pmid else ''
+        yield '%s\t%s\t%s\n' % (stmt, txt, pmid)
+
+
+def _iter_jsonl(stmts):
+    for stmt in stmts:
+        yield json.dumps(stmt.to_json(), separators=(',', ':')) + '\n'
+
+
+def _iter_json(stmts, indent=None):
+    if indent is None:
+        yield '['
+        for idx, stmt in enumerate(stmts):
+            yield (',' if idx else '') + json.dumps(stmt.to_json(),
+                                                    separators=(',', ':'))
+        yield ']'
+        return
+    # The same output as json.dumps of the whole list with this indent, each
+    # statement being indented by one more level.
+    pad = ' ' * indent
+    empty = True
+    for stmt in stmts:
+        yield ('[\n' if empty else ',\n') + pad + \
+            json.dumps(stmt.to_json(), indent=indent).replace('\n', '\n' + pad)
+        empty = False
+    yield '[]' if empty else '\n]'
+
+
+# The text formats, and the file extension of each format.
+_text_formats = {'tsv': _iter_tsv, 'jsonl': _iter_jsonl, 'json': _iter_json}
+EXPORT_FORMATS = {'tsv': '.tsv', 'jsonl': '.jsonl', 'json': '.json',
+                  'pickle': '.pkl'}
+
+
+def _write_text(stmts, fmt, fh, chunk_size, indent):
+    if fmt == 'json':
+        lines = _iter_json(stmts, indent)
+    else:
+        lines = _text_formats[fmt](stmts)
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            fh.write(''.join(chunk))
+            chunk = []
+    if chunk:
+        fh.write(''.join(chunk))
+
+
+def _write_pickle(stmts, fh, chunk_size):
+    # A pickler holds its whole output until it is done, so each chunk is
+    # pickled on its own.
+    chunk = []
+    for stmt in stmts:
+        chunk.append(stmt)
+        if len(chunk) >= chunk_size:
+            pickle.dump(chunk, fh, protocol=4)
+            chunk = []
+    if chunk:
+        pickle.dump(chunk, fh, protocol=4)
+
+
+def _write_to_stream(stmts, fmt, fh, compress, chunk_size, indent):
+    is_text_stream = isinstance(fh, io.TextIOBase)
+    if fmt == 'pickle' or compress:
+        if is_text_stream:
+            raise ValueError('A binary file is needed to export %s%s.'
+                             % (fmt, ' compressed' if compress else ''))
+        if compress:
+            fh = gzip.GzipFile(fileobj=fh, mode='wb')
+        try:
+            if fmt == 'pickle':
+                _write_pickle(stmts, fh, chunk_size)
+            else:
+                text_fh = io.TextIOWrapper(fh, encoding='utf-8')
+                _write_text(stmts, fmt, text_fh, chunk_size, indent)
+                text_fh.flush()
+                # The underlying file is left open for the caller.
+                text_fh.detach()
+        finally:
+            if compress:
+                fh.close()
+        return
+    if is_text_stream:
+        _write_text(stmts, fmt, fh, chunk_size, indent)
+        return
+    text_fh = io.TextIOWrapper(fh, encoding='utf-8')
+    _write_text(stmts, fmt, text_fh, chunk_size, indent)
+    text_fh.flush()
+    text_fh.detach()
+
+
+def export_statements(stmts, dest, fmt='jsonl', compress=None,
+                      chunk_size=100, indent=None):
+    """Write statements to a file, streaming them in chunks.
+
+    Parameters
+    ----------
+    stmts : iterable[indra.statements.Statement]
+        The statements to export.
+    dest : str or file-like
+        The path of the file to write, or an open file. Text formats can be
+        written to text or binary files, pickles and compressed exports only
+        to binary files. An open file is left open.
+    fmt : str
+        One of 'tsv', 'jsonl', 'json' or 'pickle'.
+    compress : bool or None
+        If True, the output is gzipped. If None, it is gzipped if `dest` is a
+        path ending in '.gz'.
+    chunk_size : int
+        The number of statements serialized before they are written.
+    indent : int or None
+        The indent of the 'json' format, as in `json.dumps`. If None, the
+        JSON is compact.
+
+    Returns
+    -------
+    dest : str or file-like
+        The path or file written to.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format: %s' % fmt)
+    if not isinstance(dest, str):
+        _write_to_stream(stmts, fmt, dest, bool(compress), chunk_size,
+                         indent)
+        return dest
+
+    if compress is None:
+        compress = dest.endswith('.gz')
+    # Write to a temporary file first so that no one reads a partial export,
+    # and exports to the same path at once don't mix.
+    tmp_fname = '%s.%d.%d.tmp' % (dest, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_fname, 'wb') as fh:
+            _write_to_stream(stmts, fmt, fh, compress, chunk_size, indent)
+        os.replace(tmp_fname, dest)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+    return dest
+
+
+def load_pickled_statements(src):
+    """Return the statements of a pickle export, from a path or open file.
+
+    A pickle export is a series of pickled chunks of statements, so a single
+    `pickle.load` only gives the first chunk. A path ending in '.gz' is
+    read gzipped.
+    """
+    if isinstance(src, str):
+        opener = gzip.open if src.endswith('.gz') else open
+        with opener(src, 'rb') as fh:
+            return load_pickled_statements(fh)
+    stmts = []
+    while True:
+        try:
+            stmts += pickle.load(src)
+        except EOFError:
+            return stmts
+
+
+def get_export_fname(fmt, compress=False, directory=None):
+    """Return the name of a new, empty file for an export.
+
+    The file is made in `directory`, or the temporary directory by default,
+    with a unique name, so concurrent exports don't overwrite each other.
+    """
+    suffix = EXPORT_FORMATS.get(fmt, '.' + fmt) + ('.gz' if compress else '')
+    fd, fname = tempfile.mkstemp(prefix='indrabot_', suffix=suffix,
+                                 dir=directory)
+    os.close(fd)
+    return fname
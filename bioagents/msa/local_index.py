@@ -0,0 +1,221 @@
+"""A local, on-disk index of statements answering the queries of the MSA.
+
+The MSA normally gets statements from the INDRA DB web API. When that is
+not available (or too slow, e.g. for demos and tests run offline), the same
+queries can be answered from a SQLite index built from a dump of
+statements, such as the pickles written by scripts/make_db_ndex.py:
+
+    python scripts/make_statement_index.py index.db /pmc/data/db_ndex/*.pkl
+
+and pointed to by the MSA_STATEMENT_INDEX configuration value (see
+`bioagents.msa.msa.get_statement_backend`).
+
+The index stores the JSON of each statement with a limited number of
+evidences, together with its total evidence count and its counts per
+source, so that the evidence and source counts of the finders are the same
+as those given by the web API. The agents of each statement are stored by
+role and by each of their groundings, as keys of the form 'id@NS', which
+are the keys made by StatementQuery.
+"""
+__all__ = ['LocalStatementIndex', 'LocalIndexProcessor']
+
+import json
+import sqlite3
+import logging
+import threading
+from collections import Counter
+
+from indra.statements import stmts_from_json, get_statement_by_name, \
+    get_all_descendants, Complex, SelfModification, ActiveForm, \
+    Translocation, Conversion
+
+from bioagents.msa.query_cache import StatementResult
+
+logger = logging.getLogger('MSA')
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS statements (
+    hash INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    json TEXT NOT NULL,
+    ev_count INTEGER NOT NULL,
+    source_counts TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS agents (
+    hash INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    key TEXT NOT NULL
+);
+"""
+
+_INDICES = """
+CREATE INDEX IF NOT EXISTS agents_key ON agents (key, role, hash);
+CREATE INDEX IF NOT EXISTS statements_type ON statements (type);
+"""
+
+
+def get_agent_roles(stmt):
+    """Return the (role, agent) pairs of a statement, as in the INDRA DB."""
+    agents = stmt.agent_list()
+    if isinstance(stmt, (Complex, SelfModification, ActiveForm,
+                         Translocation, Conversion)) or len(agents) != 2:
+        return [('OTHER', ag) for ag in agents if ag is not None]
+    return [(role, ag) for role, ag in zip(('SUBJECT', 'OBJECT'), agents)
+            if ag is not None]
+
+
+def get_agent_keys(agent):
+    """Return the query keys ('id@NS') of all the groundings of an agent.
+
+    The name of the agent is included as TEXT, which is what queries for
+    agents without a usable grounding look for.
+    """
+    keys = {'%s@%s' % (dbi, dbn) for dbn, dbi in agent.db_refs.items()
+            if dbi and not isinstance(dbi, (list, dict))}
+    keys.add('%s@TEXT' % agent.name)
+    return keys
+
+
+class LocalStatementIndex(object):
+    """A SQLite index of statements, queried like the INDRA DB web API.
+
+    An instance can be used in place of `indra.sources.indra_db_rest` as the
+    backend of the statement finders, through its `get_statements` method.
+
+    Parameters
+    ----------
+    path : str
+        The path of the SQLite database, created if it doesn't exist.
+    ev_limit : int
+        The maximum number of evidences stored for each statement by
+        `add_statements`. The total count of evidence is kept regardless.
+    """
+    def __init__(self, path, ev_limit=10):
+        self.path = path
+        self.ev_limit = ev_limit
+        # SQLite connections can't be shared between threads, and requests
+        # are handled by several threads, so each gets its own.
+        self._local = threading.local()
+        self._get_conn().executescript(_SCHEMA)
+
+    def _get_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def add_statements(self, stmts):
+        """Add statements to the index.
+
+        Statements with the same hash are merged: their evidence counts and
+        source counts are added up.
+        """
+        conn = self._get_conn()
+        with conn:
+            for stmt in stmts:
+                stmt_hash = stmt.get_hash(shallow=True)
+                source_counts = Counter(ev.source_api for ev in stmt.evidence)
+                row = conn.execute('SELECT ev_count, source_counts '
+                                   'FROM statements WHERE hash = ?',
+                                   (stmt_hash,)).fetchone()
+                if row is not None:
+                    ev_count = row[0] + len(stmt.evidence)
+                    source_counts.update(json.loads(row[1]))
+                    conn.execute('UPDATE statements SET ev_count = ?, '
+                                 'source_counts = ? WHERE hash = ?',
+                                 (ev_count, json.dumps(source_counts),
+                                  stmt_hash))
+                    continue
+                stmt_json = stmt.to_json()
+                if 'evidence' in stmt_json:
+                    stmt_json['evidence'] = \
+                        stmt_json['evidence'][:self.ev_limit]
+                conn.execute('INSERT INTO statements VALUES (?, ?, ?, ?, ?)',
+                             (stmt_hash, type(stmt).__name__,
+                              json.dumps(stmt_json), len(stmt.evidence),
+                              json.dumps(source_counts)))
+                conn.executemany('INSERT INTO agents VALUES (?, ?, ?)',
+                                 {(stmt_hash, role, key)
+                                  for role, ag in get_agent_roles(stmt)
+                                  for key in get_agent_keys(ag)})
+            conn.executescript(_INDICES)
+
+    def count(self):
+        """Return the number of statements in the index."""
+        return self._get_conn().execute(
+            'SELECT COUNT(*) FROM statements').fetchone()[0]
+
+    def get_statements(self, subject=None, object=None, agents=None,
+                       stmt_type=None, use_exact_type=False, max_stmts=None,
+                       ev_limit=None, **kwargs):
+        """Return a processor with the statements matching a query.
+
+        The parameters are those of `indra_db_rest.get_statements`; others
+        given to it (e.g. persist, timeout, best_first) are accepted and
+        ignored. The statements are sorted by evidence count, most first.
+
+        Returns
+        -------
+        processor : LocalIndexProcessor
+            The statements found and their evidence and source counts.
+        """
+        constraints = []
+        if subject is not None:
+            constraints.append((subject, 'SUBJECT'))
+        if object is not None:
+            constraints.append((object, 'OBJECT'))
+        for key in (agents or []):
+            if key is not None:
+                constraints.append((key, None))
+        if not constraints:
+            raise ValueError('At least one agent must be given.')
+
+        subqueries = []
+        params = []
+        for key, role in constraints:
+            if role is None:
+                subqueries.append('SELECT hash FROM agents WHERE key = ?')
+                params.append(key)
+            else:
+                subqueries.append('SELECT hash FROM agents '
+                                  'WHERE key = ? AND role = ?')
+                params += [key, role]
+        sql = ('SELECT json, ev_count, source_counts FROM statements '
+               'WHERE hash IN (%s)' % ' INTERSECT '.join(subqueries))
+
+        if stmt_type is not None:
+            stmt_class = get_statement_by_name(stmt_type)
+            types = [stmt_class.__name__]
+            if not use_exact_type:
+                types += [cls.__name__
+                          for cls in get_all_descendants(stmt_class)]
+            sql += ' AND type IN (%s)' % ', '.join('?' for _ in types)
+            params += types
+
+        sql += ' ORDER BY ev_count DESC, hash'
+        if max_stmts is not None:
+            sql += ' LIMIT ?'
+            params.append(max_stmts)
+
+        rows = self._get_conn().execute(sql, params).fetchall()
+        stmts = stmts_from_json([json.loads(row[0]) for row in rows])
+        ev_counts = {}
+        source_counts = {}
+        for stmt, (_, ev_count, stmt_source_counts) in zip(stmts, rows):
+            if ev_limit is not None:
+                stmt.evidence = stmt.evidence[:ev_limit]
+            stmt_hash = stmt.get_hash(shallow=True)
+            ev_counts[stmt_hash] = ev_count
+            source_counts[stmt_hash] = json.loads(stmt_source_counts)
+        logger.info('Found %d statements in the local index.' % len(stmts))
+        return LocalIndexProcessor(stmts, ev_counts, source_counts)
+
+
+class LocalIndexProcessor(StatementResult):
+    """The result of a query of the local index.
+
+    All the statements are loaded when it is made, so it is never working in
+    the background.
+    """
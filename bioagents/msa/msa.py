@@ -1,58 +1,76 @@
+import io
 import re
-import json
-import uuid
-import pickle
+import time
 import logging
+from copy import copy
+from types import MappingProxyType
+import numpy
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from collections import defaultdict
 
 from indra.util.statement_presentation import group_and_sort_statements, \
     make_stmt_from_sort_key, stmt_to_english
-from bioagents.biosense.biosense import _read_kinases, _read_phosphatases, \
-    _read_tfs
+from bioagents.biosense.biosense import entity_type_index
+from bioagents.biosense.entity_types import get_category_mask
+from bioagents.startup import LazyComponent, LazyMapping
+from bioagents import get_request_context, DeadlineExceeded
+from bioagents.logs import RateLimitedLogger
+from bioagents.artifacts import get_artifact_store
+from bioagents.metrics import registry as metrics_registry
+from bioagents.msa.query_cache import QueryCache, StatementResult
+from bioagents.msa.result_set import StatementSet
+from bioagents.msa.exporters import export_statements, get_export_fname
+from bioagents.msa.verbs import load_verb_map
 from indra import get_config
-from indra.statements import Statement, stmts_to_json, Agent, \
-    get_all_descendants
+from indra.statements import Agent
 from indra.sources import indra_db_rest as idbr
 
-from indra.assemblers.html import HtmlAssembler
-from indra.assemblers.graph import GraphAssembler
 from indra.assemblers.english.assembler import english_join, \
-    statement_base_verb, statement_present_verb, statement_passive_verb
+    statement_base_verb
 
 logger = logging.getLogger('MSA')
+rl_logger = RateLimitedLogger(logger)
 
 
-def _build_verb_map():
-    # We first get all statement types
-    stmts = get_all_descendants(Statement)
-    verb_map = {}
-    # These are statement types that aren't binary and therefore don't need
-    # to be included in the verb map
-    non_binary = ('hasactivity', 'activeform', 'selfmodification',
-                  'autophosphorylation', 'transphosphorylation',
-                  'event', 'unresolved', 'association', 'complex')
-    for stmt in stmts:
-        # Get the class name
-        name = stmt.__name__
-        if name.lower() in non_binary:
-            continue
-        # Get the base verb form of the statement, e.g., "phosphorylate"
-        base_verb = statement_base_verb(name.lower())
-        verb_map[base_verb] = {'stmt': name, 'type': 'base'}
-        # Get the present form of the statement, e.g., "inhibits"
-        present_verb = statement_present_verb(name.lower())
-        verb_map[present_verb] = {'stmt': name, 'type': 'present'}
-        # Get the passive / state form of the statement, e.g., "activated"
-        passive_verb = statement_passive_verb(name.lower())
-        verb_map[passive_verb] = {'stmt': name, 'type': 'passive'}
-    return verb_map
-
-
-verb_map = _build_verb_map()
+# The verbs mapped to statement types, stored ahead of time (see
+# bioagents.msa.verbs).
+verb_map = LazyMapping('msa.verb_map', load_verb_map)
 
 
 DB_REST_URL = get_config('INDRA_DB_REST_URL')
+STATEMENT_INDEX = get_config('MSA_STATEMENT_INDEX')
+RESULTS_LOCATION = get_config('MSA_RESULTS_LOCATION') or \
+    's3:indrabot-results:'
+
+
+def _load_statement_backend():
+    if STATEMENT_INDEX:
+        from bioagents.msa.local_index import LocalStatementIndex
+        logger.info('Using the local statement index at %s.'
+                    % STATEMENT_INDEX)
+        return LocalStatementIndex(STATEMENT_INDEX)
+    return idbr
+
+
+_statement_backend = LazyComponent('msa.statement_backend',
+                                   _load_statement_backend)
+
+
+def get_statement_backend():
+    """Return the backend answering the statement queries of the finders.
+
+    This is the local statement index given by MSA_STATEMENT_INDEX if set
+    (see `bioagents.msa.local_index`), and the INDRA DB web API otherwise.
+    Either has a `get_statements` function taking the arguments of
+    `indra_db_rest.get_statements`.
+    """
+    return _statement_backend.load()
+
+
+# The results of recent statement queries, shared by all the finders.
+query_cache = QueryCache()
+metrics_registry.register_cache('msa_queries', query_cache.results)
 
 
 class EntityError(ValueError):
@@ -159,12 +177,59 @@ class StatementQuery(object):
         return dbi, dbn
 
 
+class AgentFilter(object):
+    """Keeps the statements in which one of the filter agents takes part.
+
+    A statement is kept if any of its agents, other than the queried
+    entities, has the preferred grounding of one of the `filter_agents` of
+    the query. The groundings are worked out once, and looked up in a set,
+    so the cost is linear in the number of statements.
+
+    Parameters
+    ----------
+    query : StatementQuery
+        The query, whose `filter_agents` and entities are used.
+    """
+    def __init__(self, query):
+        self.query_entities = list(query.entities.values())
+        self.groundings = defaultdict(set)
+        for filter_agent in query.filter_agents:
+            dbi, dbn = query.get_agent_grounding(filter_agent)
+            self.groundings[dbn].add(dbi)
+
+    def matches(self, stmt):
+        """Return True if the statement involves one of the filter agents."""
+        for agent in StatementFinder.get_other_agents_for_stmt(
+                stmt, self.query_entities):
+            if agent is None:
+                continue
+            for dbn, dbis in self.groundings.items():
+                if agent.db_refs.get(dbn) in dbis:
+                    return True
+        return False
+
+    def filter(self, stmts):
+        """Return the statements involving one of the filter agents."""
+        return [stmt for stmt in stmts if self.matches(stmt)]
+
+    def iter_filter(self, stmt_batches):
+        """Filter batches of statements as they come, e.g. while streaming.
+        """
+        for stmts in stmt_batches:
+            yield self.filter(stmts)
+
+
 class StatementFinder(object):
+    # The fraction of the statements received, which is only less than 1 for
+    # the snapshots of finders made while statements are still coming in.
+    completeness = 1.0
+
     def __init__(self, *args, **kwargs):
         self._block_default = kwargs.pop('block_default', True)
         self.query = self._regularize_input(*args, **kwargs)
         self._processor = self._make_processor()
         self._statements = None
+        self._stats = None
         self._sample = []
         return
 
@@ -175,22 +240,15 @@ class StatementFinder(object):
     def _make_processor(self):
         """Create an instance a indra_db_rest processor.
 
-        This method makes use of the `query` attribute.
+        This method makes use of the `query` attribute. Identical queries
+        made earlier or still running are answered by the `query_cache`.
         """
-        if not self.query.verb:
-            processor = \
-                idbr.get_statements(subject=self.query.subj_key,
-                                    object=self.query.obj_key,
-                                    agents=self.query.agent_keys,
-                                    **self.query.settings)
-        else:
-            processor = \
-                idbr.get_statements(subject=self.query.subj_key,
-                                    object=self.query.obj_key,
-                                    agents=self.query.agent_keys,
-                                    stmt_type=self.query.stmt_type,
-                                    **self.query.settings)
-        return processor
+        params = dict(subject=self.query.subj_key, object=self.query.obj_key,
+                      agents=self.query.agent_keys, **self.query.settings)
+        if self.query.verb:
+            params['stmt_type'] = self.query.stmt_type
+        return query_cache.get_processor(
+            params, get_statement_backend().get_statements)
 
     def _filter_stmts(self, stmts):
         """This is an internal function that is applied to filter statements.
@@ -207,38 +265,21 @@ class StatementFinder(object):
         if not self.query.filter_agents:
             return stmts
 
-        filtered_stmts = []
-        logger.info('Starting agent filter with %d statements' % len(stmts))
-        for stmt in stmts:
-
-            # Look for any of the agents we are filtering to
-            for filter_agent in self.query.filter_agents:
-
-                # Get the prefered grounding
-                dbi, dbn = self.query.get_agent_grounding(filter_agent)
-
-                # Look for a match in any of the statements' agents.
-                for agent in self.get_other_agents_for_stmt(stmt,
-                                        list(self.query.entities.values())):
-                    if agent is None:
-                        continue
-
-                    if agent.db_refs.get(dbn) == dbi:
-                        filtered_stmts.append(stmt)
-                        break  # found one.
-                else:
-                    continue  # keep looking
-                break  # found one.
-
-        logger.info('Finished agent filter with %d statements' %
-                    len(filtered_stmts))
+        rl_logger.info('Starting agent filter with %d statements', len(stmts))
+        filtered_stmts = AgentFilter(self.query).filter(stmts)
+        rl_logger.info('Finished agent filter with %d statements',
+                       len(filtered_stmts))
 
         return filtered_stmts
 
     def get_statements(self, block=None, timeout=10):
-        """Get the full list of statements if available."""
+        """Get the statements if available, as a read only StatementSet.
+
+        If the statements are not ready within `timeout` seconds, or before
+        the deadline of the request being handled, None is returned.
+        """
         if self._statements is not None:
-            return self._statements[:]
+            return self._statements
 
         if block is None:
             # This is True by default.
@@ -246,16 +287,91 @@ class StatementFinder(object):
 
         if self._processor.is_working():
             if block:
+                timeout = get_request_context().get_timeout(timeout)
                 self._processor.wait_until_done(timeout)
                 if self._processor.is_working():
                     return None
             else:
                 return None
 
-        self._statements = self._filter_stmts(self._processor.statements[:])
-        self._statements = self._filter_stmts_for_agents(self._statements)
+        # The statements of a cached result are only kept while used, so
+        # they are held until the set refers to them.
+        all_stmts = self._processor.statements
+        stmts = self._filter_stmts(all_stmts[:])
+        stmts = self._filter_stmts_for_agents(stmts)
+        self._statements = StatementSet.from_statements(stmts, self._processor)
+        # The finder keeps the compact result of the query rather than its
+        # processor, so the processor's copies of the statements are freed.
+        result = getattr(self._processor, 'result', None)
+        if result is not None:
+            self._processor = result
+
+        return self._statements
+
+    def get_snapshot(self):
+        """Return a finder over the statements received so far.
 
-        return self._statements[:]
+        If all the statements were received, this is the finder itself.
+        Otherwise it is a copy whose statements are those of the pages
+        received when it was made, so that its methods (e.g.
+        `get_other_agents` and `describe`) give a partial answer at once.
+        Its `completeness` is an estimate of the fraction of the statements
+        received, or None if there is no way of telling.
+        """
+        if self.get_statements(block=False) is not None:
+            return self
+        received = self._processor.get_received_statements()
+        snapshot = copy(self)
+        snapshot._statements = StatementSet.from_statements(
+            self._filter_stmts_for_agents(self._filter_stmts(received[:])),
+            self._processor)
+        snapshot._stats = None
+        snapshot.completeness = self._estimate_completeness(len(received))
+        return snapshot
+
+    def _estimate_completeness(self, num_received):
+        """Estimate the fraction of the statements received while working.
+
+        The total number of statements is not known until they are all
+        received, so this is the fraction of the maximum number of
+        statements of the query, below 1. Without a maximum, it is None.
+        """
+        max_stmts = self.query.settings.get('max_stmts')
+        if not max_stmts:
+            return None
+        return min(num_received / max_stmts, 0.99)
+
+    def iter_snapshots(self, interval=0.5, timeout=None):
+        """Yield snapshots of the finder as the statements come in.
+
+        A snapshot (see `get_snapshot`) is yielded whenever more statements
+        were received, ending with the finder itself once they all are, or
+        when `timeout` seconds or the deadline of the request have passed.
+
+        Parameters
+        ----------
+        interval : float
+            The number of seconds between checks for new statements.
+        timeout : float or None
+            The number of seconds after which no more snapshots are made.
+        """
+        timeout = get_request_context().get_timeout(timeout)
+        end = time.monotonic() + timeout if timeout is not None else None
+        num_yielded = None
+        while True:
+            snapshot = self.get_snapshot()
+            num_stmts = len(snapshot._statements)
+            if snapshot is self or num_stmts != num_yielded:
+                yield snapshot
+                num_yielded = num_stmts
+            if snapshot is self:
+                return
+            wait_time = interval
+            if end is not None:
+                wait_time = min(wait_time, end - time.monotonic())
+                if wait_time <= 0:
+                    return
+            self._processor.wait_until_done(wait_time)
 
     def get_fixed_agents(self):
         """Get a dict of the agents that were used as inputs, keyed by role."""
@@ -300,33 +416,59 @@ class StatementFinder(object):
             query_entities &= set(self.query.get_agent_grounding(e)
                                   for e in entities)
 
-        # Build up a dict of groundings, counting how often they occur.
-        counts = defaultdict(lambda: 0)
-        oa_dict = defaultdict(list)
-        ev_totals = self.get_ev_totals()
-        stmts = self.get_statements(block)
-        if not stmts:
+        stmt_set = self.get_statements(block)
+        if not stmt_set:
             return None
-        for stmt in stmts:
-            other_agents = self.get_other_agents_for_stmt(stmt, query_entities,
-                                                          other_role)
-            for ag in other_agents:
-                gr = self.query.get_agent_grounding(ag)
-                counts[gr] += ev_totals.get(stmt.get_hash(), 0)
-                oa_dict[gr].append(ag)
-
-        def get_aggregate_agent(agents, dbi, dbn):
-            agent = Agent(agents[0].name, db_refs={dbn: dbi})
-            return agent
-
-        # Create a list of groundings sorted with the most frequent first.
-        # We add t itself as a second element to the tuple to make sure the
-        # sort is deterministic, and take -counts so that we don't need to
-        # reverse the sort.
-        sorted_groundings = \
-            list(sorted(counts.keys(), key=lambda t: (-counts[t], t)))
-        other_agents = [get_aggregate_agent(oa_dict[gr], *gr) for gr in
-                        sorted_groundings]
+
+        # Make one row for each other agent of each statement, giving the
+        # index of its grounding and the evidence of the statement. The
+        # grounding of agents with the same name and db_refs is only worked
+        # out once.
+        groundings = []
+        grounding_idx = {}
+        names = []
+        agent_idx = {}
+        row_groundings = []
+        row_weights = []
+        for stmt, ev_count in zip(stmt_set, stmt_set.ev_counts.tolist()):
+            ev_total = max(ev_count, 0)
+            for ag in self.get_other_agents_for_stmt(stmt, query_entities,
+                                                     other_role):
+                if ag is None:
+                    continue
+                try:
+                    ag_key = (ag.name, tuple(ag.db_refs.items()))
+                    idx = agent_idx.get(ag_key)
+                except TypeError:
+                    ag_key = idx = None
+                if idx is None:
+                    gr = self.query.get_agent_grounding(ag)
+                    idx = grounding_idx.get(gr)
+                    if idx is None:
+                        idx = len(groundings)
+                        grounding_idx[gr] = idx
+                        groundings.append(gr)
+                        names.append(ag.name)
+                    if ag_key is not None:
+                        agent_idx[ag_key] = idx
+                row_groundings.append(idx)
+                row_weights.append(ev_total)
+
+        # Sum the evidence of each grounding, and sort the groundings with
+        # the most frequent first. Ties are broken by the grounding itself,
+        # to make sure the order is deterministic.
+        counts = numpy.bincount(numpy.array(row_groundings, dtype=int),
+                                weights=numpy.array(row_weights, dtype=float),
+                                minlength=len(groundings))
+        tie_ranks = numpy.empty(len(groundings), dtype=int)
+        tie_ranks[sorted(range(len(groundings)),
+                         key=groundings.__getitem__)] = \
+            numpy.arange(len(groundings))
+        order = numpy.lexsort((tie_ranks, -counts))
+
+        other_agents = [Agent(names[idx], db_refs={groundings[idx][1]:
+                                                   groundings[idx][0]})
+                        for idx in order]
         return other_agents
 
     @staticmethod
@@ -376,18 +518,45 @@ class StatementFinder(object):
 
         return other_agents
 
-    def get_ev_totals(self):
-        """Get a dictionary of evidence total counts from the processor."""
+    def _get_stats(self, block=False):
+        """Return the counts of the statements, computed once.
+
+        The evidence totals and source counts of each statement, and the
+        evidence total of each type of statement, are computed in a single
+        pass over the statements once they are available, and shared by the
+        methods using them. None is returned if the statements are not
+        available yet.
+        """
+        if self._stats is not None:
+            return self._stats
+
         # Getting statements applies any filters, so the counts are consistent
         # with those filters.
-        stmts = self.get_statements(block=False)
-        return {stmt.get_hash(): self._processor.get_ev_count(stmt)
-                for stmt in stmts}
+        stmt_set = self.get_statements(block=block)
+        if stmt_set is None:
+            return None
+        self._stats = {'ev_totals': stmt_set.get_ev_totals(),
+                       'source_counts': stmt_set.get_source_counts(),
+                       'type_totals': stmt_set.get_type_totals()}
+        return self._stats
+
+    def get_ev_totals(self):
+        """Get a dictionary of evidence total counts from the processor.
+
+        The dictionary is shared by later calls, and must not be changed. It
+        is empty if the statements are not available yet.
+        """
+        stats = self._get_stats()
+        return stats['ev_totals'] if stats is not None else {}
 
     def get_source_counts(self):
-        stmts = self.get_statements(block=False)
-        return {stmt.get_hash(): self._processor.get_source_count(stmt)
-                for stmt in stmts}
+        """Get a dictionary of the source counts of each statement.
+
+        The dictionary is shared by later calls, and must not be changed. It
+        is empty if the statements are not available yet.
+        """
+        stats = self._get_stats()
+        return stats['source_counts'] if stats is not None else {}
 
     def get_sample(self):
         """Get the sample of statements retrieved by the first query."""
@@ -429,17 +598,9 @@ class StatementFinder(object):
 
     def get_stmt_types(self):
         """Return the sorted set of types found in the body of statements."""
-        stmts = self.get_statements()
-        evs = self.get_ev_totals()
-        # We count the evidence for each type of statement
-        counts = {}
-        for stmt in stmts:
-            stmt_type = stmt.__class__.__name__.lower()
-            ev = evs.get(stmt.get_hash(), 0)
-            if stmt_type in counts:
-                counts[stmt_type] += ev
-            else:
-                counts[stmt_type] = ev
+        # The evidence for each type of statement is counted with the other
+        # statistics.
+        counts = self._get_stats(block=True)['type_totals']
         # We finally sort by decreasing evidence count
         sorted_stmt_types = [k for k, v in sorted(counts.items(),
                                                   key=lambda x: x[1],
@@ -470,72 +631,88 @@ class StatementFinder(object):
         return list_html
 
     def get_html(self):
-        """Get html for these statements."""
-        logger.info('Generating HTML')
-        import boto3
+        """Get a link to html for these statements.
+
+        The html is made and stored at the MSA_RESULTS_LOCATION (see
+        `bioagents.artifacts`), by default the indrabot-results bucket on S3,
+        in the background. The link is returned before it is stored.
+        """
+        stmt_set = self.get_statements()
         ev_totals = self.get_ev_totals()
         source_counts = self.get_source_counts()
-        html_assembler = HtmlAssembler(self.get_statements(),
-                                       ev_totals=ev_totals,
-                                       source_counts=source_counts,
-                                       db_rest_url=DB_REST_URL)
-        html = html_assembler.make_model()
-        s3 = boto3.client('s3')
-        bucket = 'indrabot-results'
-        key = '%s.html' % uuid.uuid4()
-        link = 'https://s3.amazonaws.com/%s/%s' % (bucket, key)
-        logger.info('Uploading to S3')
-        s3.put_object(Bucket=bucket, Key=key, Body=html.encode('utf-8'),
-                      ContentType='text/html')
-        return link
+        store = get_artifact_store(RESULTS_LOCATION, signed=True)
+        if store is None:
+            raise ValueError('Invalid MSA_RESULTS_LOCATION: %s'
+                             % RESULTS_LOCATION)
+
+        def render():
+            from indra.assemblers.html import HtmlAssembler
+            logger.info('Generating HTML')
+            html_assembler = HtmlAssembler(stmt_set.to_list(),
+                                           ev_totals=ev_totals,
+                                           source_counts=source_counts,
+                                           db_rest_url=DB_REST_URL)
+            return html_assembler.make_model()
+
+        # The page is identified by its statements and their evidence counts.
+        key = 'msa-html:' + ','.join('%d:%s' % (h, ev_totals.get(h))
+                                     for h in stmt_set.hashes.tolist())
+        return store.put_deferred(key, render, content_type='text/html',
+                                  ext='html')
+
+    def export(self, dest, fmt='jsonl', compress=None, indent=None):
+        """Write the statements to a path or file, in chunks.
+
+        See `bioagents.msa.exporters.export_statements` for the formats.
+        """
+        return export_statements(self.get_statements(), dest, fmt,
+                                 compress=compress, indent=indent)
 
     def get_tsv(self):
         """Get a string of the tsv for these statements."""
-        msg = ''
-        for stmt in self.get_statements():
-            if not stmt.evidence:
-                logger.warning('Statement %s without evidence' % stmt.uuid)
-                txt = ''
-                pmid = ''
-            else:
-                txt = stmt.evidence[0].text if stmt.evidence[0].text else ''
-                pmid = stmt.evidence[0].pmid if stmt.evidence[0].pmid else ''
-            line = '%s\t%s\t%s\n' % (stmt, txt, pmid)
-            msg += line
-        return msg
+        out = io.StringIO()
+        self.export(out, 'tsv')
+        return out.getvalue()
 
-    def get_pickle(self):
-        """Generate a pickle file, and return the file name."""
-        fname = 'indrabot.pkl'
-        with open(fname, 'wb') as fh:
-            pickle.dump(self.get_statements(), fh)
-        return fname
+    def get_pickle(self, fname=None):
+        """Generate a pickle file, and return the file name.
+
+        If no file name is given, a new file with a unique name is made in
+        the temporary directory. The statements are pickled in chunks, read
+        them back with `bioagents.msa.exporters.load_pickled_statements`.
+        """
+        if fname is None:
+            fname = get_export_fname('pickle')
+        return self.export(fname, 'pickle')
 
-    def get_pdf_graph(self):
+    def get_pdf_graph(self, fname=None):
         """Save a graph made with GraphAssembler as pdf, return file name."""
-        fname = 'indrabot.pdf'
+        from indra.assemblers.graph import GraphAssembler
+        if fname is None:
+            fname = get_export_fname('pdf')
         ga = GraphAssembler(self.get_statements())
         ga.make_model()
         ga.save_pdf(fname)
         return fname
 
     def get_json(self):
-        """Generate statement jsons and return the json bytes."""
-        msg = json.dumps(stmts_to_json(self.get_statements()), indent=1)
-        return msg
+        """Generate statement jsons and return the json string."""
+        out = io.StringIO()
+        self.export(out, 'json', indent=1)
+        return out.getvalue()
 
     def filter_other_agent_type(self, stmts, ent_type, other_role=None):
         query_entities = set(self.query.entities.values())
+        other_agents = [self.get_other_agents_for_stmt(
+                            stmt, query_entities=query_entities,
+                            other_role=other_role)
+                        for stmt in stmts]
+        # The other agents of all the statements are classified at once.
+        matches = iter(entity_type_filter.classify(
+            [agent for agents in other_agents for agent in agents], ent_type))
         stmts_out = []
-        for stmt in stmts:
-            other_agents = \
-                self.get_other_agents_for_stmt(stmt,
-                                               query_entities=query_entities,
-                                               other_role=other_role)
-
-            matches = [entity_type_filter.is_ent_type(agent, ent_type)
-                       for agent in other_agents]
-            if all(matches):
+        for stmt, agents in zip(stmts, other_agents):
+            if all([next(matches) for _ in agents]):
                 stmts_out.append(stmt)
         return stmts_out
 
@@ -660,11 +837,11 @@ class BinaryDirected(StatementFinder):
 
 
 class BinaryUndirected(StatementFinder):
-    def _regularize_input(self, entity1, entity2, **params):
+    def _regularize_input(self, entity1, entity2, verb=None, **params):
         if 'filter_agents' in params.keys():
             logger.warning("Parameter `filter_agents` is not meaningful for "
                            "Binary queries.")
-        return StatementQuery(None, None, [entity1, entity2], None, None,
+        return StatementQuery(None, None, [entity1, entity2], verb, None,
                               params)
 
     def summarize(self):
@@ -845,6 +1022,8 @@ class ComplexOneSide(StatementFinder):
 class _Commons(StatementFinder):
     _role = NotImplemented
     _name = NotImplemented
+    _max_workers = 5
+    _max_stmts_limit = 1600
 
     def __init__(self, *args, **kwargs):
         assert self._role in ['SUBJECT', 'OBJECT', 'OTHER']
@@ -873,11 +1052,18 @@ class _Commons(StatementFinder):
         Given N entities, the odds of finding common neighbors among them all
         decrease rapidly as N increases. Thus, if N is 100, you will likely run
         out of common neighbors after only a few queries. This implementation
-        takes advantage of that fact, thus preventing hangs in essentially
-        trivial cases with large N.
+        takes advantage of that fact: the queries for the entities are run
+        concurrently, the agents held in common by the results received so
+        far are kept track of, and the queries still outstanding are given up
+        on as soon as there are none.
+
+        Unless `max_stmts` is given, it is raised and the queries that hit
+        it are run again if nothing is found in common, so that a low cap
+        doesn't hide the common neighbors of well studied entities.
         """
         # Prep the settings with some defaults.
         kwargs = self.query.settings.copy()
+        adapt_max_stmts = 'max_stmts' not in kwargs.keys()
         if 'max_stmts' not in kwargs.keys():
             kwargs['max_stmts'] = 100
         if 'ev_limit' not in kwargs.keys():
@@ -885,55 +1071,158 @@ class _Commons(StatementFinder):
         if 'persist' not in kwargs.keys():
             kwargs['persist'] = False
 
-        # Run multiple queries, building up a single processor and a dict of
-        # agents held in common.
+        queries = [(ag, ag_key) for ag, ag_key
+                   in zip(self.query.agents, self.query.agent_keys)
+                   if ag_key is not None]
+        results = {}
+        while True:
+            self._run_queries(queries, kwargs, results)
+            self.commons = self._get_commons(queries, results)
+            if self.commons or not adapt_max_stmts \
+                    or kwargs['max_stmts'] >= self._max_stmts_limit:
+                break
+            truncated = [idx for idx, (processor, _) in results.items()
+                         if len(processor.statements) >= kwargs['max_stmts']]
+            # What non-truncated results don't have in common is final.
+            if not truncated:
+                break
+            kwargs['max_stmts'] = min(4 * kwargs['max_stmts'],
+                                      self._max_stmts_limit)
+            logger.info('Nothing found in common, querying again with '
+                        'max_stmts=%d.' % kwargs['max_stmts'])
+            for idx in truncated:
+                del results[idx]
+
+        # Build a single processor from the results, in the order of the
+        # query so that the result doesn't depend on timing.
         processor = None
-        for ag, ag_key in zip(self.query.agents, self.query.agent_keys):
-            if ag_key is None:
+        for idx in sorted(results.keys()):
+            if processor is None:
+                processor = StatementResult.from_processor(results[idx][0])
+            else:
+                processor.merge_results(results[idx][0])
+        if processor is not None:
+            self.commons = self._compact_commons(self.commons, processor)
+        return processor
+
+    def _run_queries(self, queries, kwargs, results):
+        """Run the queries without results concurrently, adding to results.
+
+        This returns early if the results received have no agents in common.
+        """
+        context = get_request_context()
+        context.check()
+        backend = get_statement_backend()
+        common_ids = None
+        for _, others in results.values():
+            common_ids = set(others) if common_ids is None \
+                else common_ids & set(others)
+        todo = [idx for idx in range(len(queries)) if idx not in results]
+        if not todo or common_ids == set():
+            return
+
+        executor = ThreadPoolExecutor(
+            max_workers=min(self._max_workers, len(todo)))
+        pending = set()
+        try:
+            futures = {}
+            for idx in todo:
+                query_kwargs = kwargs.copy()
+                query_kwargs[self._role.lower()] = queries[idx][1]
+                future = executor.submit(self._run_query, backend,
+                                         query_kwargs, context)
+                futures[future] = idx
+            pending = set(futures.keys())
+            while pending:
+                done, pending = wait(pending, timeout=context.remaining(),
+                                     return_when=FIRST_COMPLETED)
+                # We can't find what is held in common by only some of the
+                # agents, so if the deadline passes, we fail.
+                context.check()
+                for future in done:
+                    processor = future.result()
+                    others = self._get_others(processor)
+                    results[futures[future]] = (processor, others)
+                    common_ids = set(others) if common_ids is None \
+                        else common_ids & set(others)
+                # If there's nothing left in common, it won't get better.
+                if not common_ids:
+                    if pending:
+                        logger.info('Nothing in common, giving up on %d '
+                                    'queries.' % len(pending))
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _run_query(backend, kwargs, context):
+        processor = query_cache.get_processor(kwargs, backend.get_statements)
+        processor.wait_until_done(context.get_timeout())
+        if isinstance(processor, StatementResult):
+            # The statements of a cached result are kept while the commons
+            # are worked out, rather than made from their JSON each time.
+            processor = StatementResult.from_processor(processor)
+        return processor
+
+    def _get_others(self, processor):
+        """Return the statements of a processor, keyed by other agent name."""
+        others = {}
+        for other_ag, stmt in self._iter_stmts(processor.statements):
+            if other_ag is None or 'HGNC' not in other_ag.db_refs.keys():
                 continue
+            others.setdefault(other_ag.name, []).append(stmt)
+        return others
 
-            # Make another query.
-            kwargs[self._role.lower()] = ag_key
-            new_processor = idbr.get_statements(**kwargs)
-            new_processor.wait_until_done()
+    @staticmethod
+    def _get_commons(queries, results):
+        """Return the agents held in common by the results of all queries.
 
-            # Look for new agents.
-            for other_ag, stmt in self._iter_stmts(new_processor.statements):
-                if other_ag is None or 'HGNC' not in other_ag.db_refs.keys():
-                    continue
-                other_id = other_ag.name
-
-                # If this is the first pass, init the dict.
-                if processor is None and other_id not in self.commons.keys():
-                    self.commons[other_id] = {ag.name: [stmt]}
-                # Otherwise we can only add to the sub-dicts and their lists.
-                elif other_id in self.commons.keys():
-                    if ag.name not in self.commons[other_id].keys():
-                        self.commons[other_id][ag.name] = []
-                    self.commons[other_id][ag.name].append(stmt)
-
-            # If this isn't the first time around, remove all entries that
-            # didn't find match this time around.
-            if processor is None:
-                processor = new_processor
+        The result is a dict of the statements involving each common agent,
+        keyed by the name of the query agent.
+        """
+        if len(results) < len(queries):
+            return {}
+        commons = None
+        for idx, (ag, _) in enumerate(queries):
+            others = results[idx][1]
+            if commons is None:
+                commons = {other_id: {ag.name: list(stmts)}
+                           for other_id, stmts in others.items()}
             else:
-                self.commons = {other_id: data
-                                for other_id, data in self.commons.items()
-                                if ag.name in data.keys()}
-                processor.merge_results(new_processor)
-
-            # If there's nothing left in common, it won't get better.
-            if not self.commons:
+                commons = {other_id: data
+                           for other_id, data in commons.items()
+                           if other_id in others}
+                for other_id, data in commons.items():
+                    data.setdefault(ag.name, []).extend(others[other_id])
+            if not commons:
                 break
+        return commons or {}
 
-        return processor
+    @staticmethod
+    def _compact_commons(commons, processor):
+        """Replace the lists of statements in the commons by StatementSets.
+
+        The statements are looked up by hash among those of the merged
+        processor, so the sets all refer to its list of statements.
+        """
+        stmt_set = StatementSet.from_statements(processor.statements,
+                                                processor)
+        index = stmt_set.get_index()
+        return {other_id: {name: stmt_set.take([index[stmt.get_hash()]
+                                                for stmt in stmts])
+                           for name, stmts in data.items()}
+                for other_id, data in commons.items()}
 
     def get_statements(self, block=None, timeout=10):
         if self._statements is None:
-            self._statements = [s for data in self.commons.values()
-                                for s_list in data.values()
-                                for s in s_list]
-        self._statements = self._filter_stmts_for_agents(self._statements)
+            stmts = [s for data in self.commons.values()
+                     for stmt_set in data.values()
+                     for s in stmt_set]
+            stmts = self._filter_stmts_for_agents(stmts)
+            self._statements = StatementSet.from_statements(stmts,
+                                                            self._processor)
         return self._statements
 
     def get_common_entities(self):
@@ -974,11 +1263,21 @@ def un_camel(name):
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
+# The finders of the MSA by method name, i.e. the public descendants of
+# StatementFinder by their name in snake_case. Finder classes that are not
+# meant to be used directly have names starting with an underscore.
+finder_classes = MappingProxyType({
+    un_camel(cls.__name__): cls
+    for cls in [Neighborhood, Activeforms, PhosActiveforms, BinaryDirected,
+                BinaryUndirected, FromSource, ToTarget, ComplexOneSide,
+                CommonUpstreams, CommonDownstreams]})
+
+
 class MSA(object):
     """This is a class that organizes and manages mechanism searches.
 
-    Many methods are automatically generated from the children of
-    StatementFinder. This include:
+    Each of the finders in `finder_classes` can be used as a method of the
+    MSA:
 
         find_neighborhood(entity)
         find_activeforms(entity)
@@ -988,40 +1287,34 @@ class MSA(object):
         find_from_source(subject, verb)
         find_to_target(object, verb)
         find_complex_one_side(entity)
+        find_common_upstreams(*entities)
+        find_common_downstreams(*entities)
 
     In addition, a more general capability, which attempts to map automatically
     given the input is defined:
 
         find_mechanism_from_input(subject, object, agents, verb)
+
+    and many such queries can be run at once with:
+
+        find_mechanisms_batch(queries)
     """
-    def __init__(self):
-        self.__option_dict = {}
-        for cls in get_all_descendants(StatementFinder):
-            if cls.__name__.startswith('_'):
-                continue
-            self.__option_dict[un_camel(cls.__name__)] = cls
-        return
+    find_neighborhood = Neighborhood
+    find_activeforms = Activeforms
+    find_phos_activeforms = PhosActiveforms
+    find_binary_directed = BinaryDirected
+    find_binary_undirected = BinaryUndirected
+    find_from_source = FromSource
+    find_to_target = ToTarget
+    find_complex_one_side = ComplexOneSide
+    find_common_upstreams = CommonUpstreams
+    find_common_downstreams = CommonDownstreams
 
     def find_mechanisms(self, method, *args, **kwargs):
-        if method in self.__option_dict.keys():
-            FinderClass = self.__option_dict[method]
-            finder = FinderClass(*args, **kwargs)
-            return finder
-        else:
+        FinderClass = finder_classes.get(method)
+        if FinderClass is None:
             raise ValueError("No method: %s." % method)
-
-    def __getattribute__(self, item):
-        """Automatically generate functions from the above."""
-        prefix = 'find_'
-        if item.startswith(prefix):
-            key = item[len(prefix):]
-            if key in self.__option_dict.keys():
-                FinderClass = self.__option_dict[key]
-                return FinderClass
-            else:
-                return super(MSA, self).__getattribute__(item)
-        else:
-            return super(MSA, self).__getattribute__(item)
+        return FinderClass(*args, **kwargs)
 
     def find_mechanism_from_input(self, subject=None, object=None, agents=None,
                                   verb=None, **params):
@@ -1062,37 +1355,150 @@ class MSA(object):
             return self.find_binary_directed(subject, object, verb, **params)
         elif not subject and not object and agents:
             logger.info("Choosing find_binary_undirected.")
-            return self.find_binary_undirected(agents[0], agents[1], verb,
-                                               **params)
+            return self.find_binary_undirected(agents[0], agents[1],
+                                               verb=verb, **params)
         else:
             logger.error("Could not find a valid endpoint given arguments.")
             raise ValueError("Invalid combination of entity arguments: "
                              "subject=%s, object=%s, agents=%s."
                              % (subject, object, agents))
 
+    def find_mechanisms_batch(self, queries, max_workers=4, **params):
+        """Run many queries like find_mechanism_from_input concurrently.
+
+        Identical queries are only run once. Queries about the same
+        entities with different verbs are grouped. If the queries persist or
+        have a max_stmts, the statements about the entities are got once,
+        and if that gets all of them (see `QueryCache`), each verb is
+        answered from them without another query. The queries are run
+        within the context of the request, and stop at its deadline.
+
+        Parameters
+        ----------
+        queries : list[dict]
+            The queries, each a dict with any of the keys subject, object,
+            agents and verb, as taken by find_mechanism_from_input.
+        max_workers : int
+            The maximum number of queries run at the same time.
+        **params
+            Other parameters used for all the queries, e.g. ev_limit.
+
+        Returns
+        -------
+        finders : list
+            The finder answering each query, in the order of the queries.
+            If a query failed (or the deadline of the request passed), the
+            exception raised is given instead.
+        """
+        # Work out the unique queries, and group them by entities.
+        unique_idx = {}
+        query_idx = []
+        groups = {}
+        for query in queries:
+            key = _get_batch_key(query)
+            if key not in unique_idx:
+                unique_idx[key] = len(unique_idx)
+                groups.setdefault(key[:3], []).append(unique_idx[key])
+            query_idx.append(unique_idx[key])
+        unique_queries = [None] * len(unique_idx)
+        for query, idx in zip(queries, query_idx):
+            unique_queries[idx] = query
+        logger.info('Running %d unique queries out of %d, in %d groups.'
+                    % (len(unique_queries), len(queries), len(groups)))
+
+        results = [None] * len(unique_queries)
+
+        # Only a complete result for all types of statement can answer the
+        # queries for each type (see `QueryCache`), and without persisting
+        # or a max_stmts, a query only gets its first page.
+        share_groups = params.get('max_stmts') is not None or \
+            params.get('persist', True)
+        context = get_request_context()
+
+        def get_params(query):
+            query_params = dict(query, **params)
+            # Queries return by the deadline, and keep getting statements in
+            # the background.
+            if 'timeout' not in query_params and \
+                    context.remaining() is not None:
+                query_params['timeout'] = context.remaining()
+            return query_params
+
+        def run_group(idxs):
+            # The queries are run within the context of the request, so that
+            # they stop at its deadline.
+            with context:
+                verbs = {unique_queries[idx].get('verb') for idx in idxs}
+                if share_groups and len(verbs) > 1 and 'Complex' not in verbs:
+                    # Get the statements of all types first, to share them.
+                    entities = {k: v for k, v
+                                in unique_queries[idxs[0]].items()
+                                if k != 'verb'}
+                    try:
+                        self.find_mechanism_from_input(
+                            **get_params(entities)).get_statements()
+                    except Exception as e:
+                        logger.info('Could not get statements shared by a '
+                                    'group of queries: %s' % e)
+                for idx in idxs:
+                    if context.expired():
+                        break
+                    try:
+                        results[idx] = self.find_mechanism_from_input(
+                            **get_params(unique_queries[idx]))
+                    except Exception as e:
+                        results[idx] = e
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers,
+                                                             len(groups))))
+        futures = []
+        try:
+            for idxs in groups.values():
+                futures.append(executor.submit(run_group, idxs))
+            _, not_done = wait(futures, timeout=context.remaining())
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+        if not_done:
+            logger.warning('%d groups of queries were not done before the '
+                           'deadline.' % len(not_done))
+        return [results[idx] if results[idx] is not None
+                else DeadlineExceeded('The query was not done in time.')
+                for idx in query_idx]
+
+
+def _get_batch_key(query):
+    """Return a hashable key identifying a query of a batch."""
+    def agent_key(agent):
+        if agent is None:
+            return None
+        return (agent.name, tuple(sorted((k, str(v))
+                                         for k, v in agent.db_refs.items())))
+    return (agent_key(query.get('subject')), agent_key(query.get('object')),
+            tuple(agent_key(ag) for ag in (query.get('agents') or [])),
+            query.get('verb'))
+
 
 class EntityTypeFilter(object):
-    def __init__(self):
-        self.tfs = _read_tfs()
-        self.phosphatases = _read_phosphatases()
-        self.kinases = _read_kinases()
+    @property
+    def entity_types(self):
+        return entity_type_index.load()
 
     def is_ent_type(self, agent, ent_type):
+        return self.classify([agent], ent_type)[0]
+
+    def classify(self, agents, ent_type):
+        """Return whether each of a batch of agents is of an entity type."""
         if ent_type in ('gene', 'protein'):
-            return set(agent.db_refs.keys()) & {'UP', 'HGNC', 'FPLX'}
-        elif ent_type in ('transcription factor', 'TF'):
-            return agent.name in self.tfs
-        elif ent_type == 'kinase':
-            return agent.name in self.kinases
-        elif ent_type == 'phosphatase':
-            return agent.name in self.phosphatases
-        elif ent_type == 'enzyme':
-            return (agent.name in self.phosphatases or
-                    agent.name in self.kinases)
+            return [bool(set(agent.db_refs.keys()) & {'UP', 'HGNC', 'FPLX'})
+                    for agent in agents]
+        mask = get_category_mask(ent_type)
+        if mask is not None:
+            return self.entity_types.classify(agents, mask)
         # By default we just return True here, implying not filtering
         # out the agent
-        else:
-            return True
+        return [True] * len(agents)
 
 
 entity_type_filter = EntityTypeFilter()
@@ -13,20 +13,27 @@ logger = logging.getLogger('MSA-module')
 from kqml import KQMLPerformative, KQMLList
 
 from indra import has_config
-from indra.assemblers.sbgn import SBGNAssembler
-from indra.tools import assemble_corpus as ac
 
 from bioagents.msa.msa import MSA, EntityError
-from bioagents import Bioagent
+from bioagents.msa.prefetch import Prefetcher
+from bioagents import Bioagent, _pop_option
+from bioagents.startup import LazyComponent, profile_startup
+from bioagents.metrics import registry as metrics_registry
 
 if has_config('INDRA_DB_REST_URL') and has_config('INDRA_DB_REST_API_KEY'):
-    from indra.sources.indra_db_rest import IndraDBRestAPIError, \
-                                            get_statements_for_paper
+    from indra.sources.indra_db_rest import IndraDBRestAPIError
+    from bioagents.msa.paper_models import PaperModelService
 
     CAN_CHECK_STATEMENTS = True
+    CAN_GET_PAPER_MODELS = True
+elif has_config('MSA_STATEMENT_INDEX'):
+    logger.info("Using a local statement index. Cannot get paper models.")
+    CAN_CHECK_STATEMENTS = True
+    CAN_GET_PAPER_MODELS = False
 else:
     logger.warning("Database web api not specified. Cannot get background.")
     CAN_CHECK_STATEMENTS = False
+    CAN_GET_PAPER_MODELS = False
 
 
 def _read_signor_afs():
@@ -43,6 +50,18 @@ def _read_signor_afs():
     return signor_afs
 
 
+_signor_afs = LazyComponent('msa.signor_active_forms', _read_signor_afs)
+
+
+def _make_paper_model_service():
+    service = PaperModelService()
+    metrics_registry.register_cache('msa_paper_models', service.cache)
+    return service
+
+
+_paper_models = LazyComponent('msa.paper_models', _make_paper_model_service)
+
+
 DUMP_LIMIT = 100
 
 
@@ -55,13 +74,71 @@ class MSA_Module(Bioagent):
     tasks = ['PHOSPHORYLATION-ACTIVATING', 'FIND-RELATIONS-FROM-LITERATURE',
              'GET-PAPER-MODEL', 'CONFIRM-RELATION-FROM-LITERATURE',
              'GET-COMMON']
-    signor_afs = _read_signor_afs()
+    # The statements are waited for up to the deadline of the request.
+    task_timeouts = {'PHOSPHORYLATION-ACTIVATING': 60,
+                     'FIND-RELATIONS-FROM-LITERATURE': 30,
+                     'GET-PAPER-MODEL': 60,
+                     'CONFIRM-RELATION-FROM-LITERATURE': 30,
+                     'GET-COMMON': 60}
+
+    @property
+    def signor_afs(self):
+        return _signor_afs.load()
+
+    @property
+    def paper_models(self):
+        return _paper_models.load()
 
     def __init__(self, *args, **kwargs):
         self.msa = MSA()
+        # The number of follow-up queries prefetched at once, if any, e.g.
+        # with --prefetch 2.
+        prefetch = _pop_option(kwargs, 'prefetch', '--prefetch')
+        if prefetch and int(prefetch) > 0 and CAN_CHECK_STATEMENTS:
+            self.prefetcher = Prefetcher(self.msa,
+                                         max_concurrent=int(prefetch))
+        else:
+            self.prefetcher = None
         super(MSA_Module, self).__init__(*args, **kwargs)
         return
 
+    def _respond_to(self, task, content):
+        # Prefetches wait while a request is handled, and those scheduled
+        # before it are dropped.
+        if self.prefetcher is None:
+            return super(MSA_Module, self)._respond_to(task, content)
+        self.prefetcher.begin_request()
+        try:
+            return super(MSA_Module, self)._respond_to(task, content)
+        finally:
+            self.prefetcher.end_request()
+
+    def _prefetch_follow_ups(self, *agents, skip=()):
+        """Prefetch the queries of likely follow-up requests on agents.
+
+        These are the queries of FIND-RELATIONS-FROM-LITERATURE with only a
+        source or a target, of PHOSPHORYLATION-ACTIVATING, and of the
+        neighborhood of each agent. The kinds of query in `skip` (e.g. that
+        of the request being handled) are left out.
+        """
+        if self.prefetcher is None:
+            return
+        # PHOSPHORYLATION-ACTIVATING filters the active forms of the agent by
+        # site, so the query is the same whatever the site.
+        follow_ups = [('from_source', (None,), {'ev_limit': 3,
+                                                'persist': False}),
+                      ('to_target', (None,), {'ev_limit': 3,
+                                              'persist': False}),
+                      ('activeforms', (), {}),
+                      ('neighborhood', (), {'ev_limit': 3, 'persist': False,
+                                            'priority': 1})]
+        for agent in agents:
+            if agent is None:
+                continue
+            for method, args, params in follow_ups:
+                if method not in skip:
+                    self.prefetcher.schedule(method, agent, *args, **params)
+
     def respond_get_common(self, content):
         """Find the common up/down streams of a protein."""
         # TODO: This entire function could be part of the MSA.
@@ -131,6 +208,7 @@ class MSA_Module(Bioagent):
             return self.make_failure('MISSING_TARGET')
         agent = self.get_agent(target_cljson)
         logger.debug('Found agent (target): %s.' % agent.name)
+        self._prefetch_follow_ups(agent, skip={'activeforms'})
         site = content.gets('site')
         if site is None:
             residue = None
@@ -203,31 +281,46 @@ class MSA_Module(Bioagent):
         """Find statements matching some subject, verb, object information."""
         try:
             subj, obj, stmt_type = self._get_query_info(content)
+            # The finder returns at once, and the pages of statements are
+            # received in the background.
             finder = \
                 self.msa.find_mechanism_from_input(subj, obj, None, stmt_type,
                                                    ev_limit=3, persist=False,
-                                                   timeout=5)
+                                                   timeout=0)
             self._send_provenance_async(finder,
                                         'finding statements that match')
+            # A request with only a source or a target, and any type, makes
+            # the same query as that follow-up.
+            skip = set()
+            if stmt_type is None and not obj:
+                skip.add('from_source')
+            if stmt_type is None and not subj:
+                skip.add('to_target')
+            self._prefetch_follow_ups(subj, obj, skip=skip)
         except MSALookupError as mle:
             return self.make_failure(mle.args[0])
 
-        stmts = finder.get_statements(timeout=15)
-        if stmts is None:
+        # If not all the statements come in time, we answer with the pages
+        # that did; the full results are sent as provenance once they are in.
+        finder.get_statements(block=True, timeout=20)
+        snapshot = finder.get_snapshot()
+        stmts = snapshot.get_statements()
+        resp = KQMLPerformative('SUCCESS')
+        if not stmts and snapshot is not finder:
             # Calling this success may be a bit ambitious.
-            resp = KQMLPerformative('SUCCESS')
             resp.set('status', 'WORKING')
             resp.set('entities-found', 'nil')
-            resp.set('num-relations-found', '0')
-            resp.set('dump-limit', str(DUMP_LIMIT))
-            return resp
-
-        agents = finder.get_other_agents()
-        self.say(finder.describe(include_negative=False))
-        resp = KQMLPerformative('SUCCESS')
-        resp.set('status', 'FINISHED')
-        resp.set('entities-found', self.make_cljson(agents))
+        else:
+            agents = snapshot.get_other_agents()
+            self.say(snapshot.describe(include_negative=False))
+            resp.set('status',
+                     'FINISHED' if snapshot is finder else 'WORKING')
+            resp.set('entities-found', self.make_cljson(agents))
         resp.set('num-relations-found', str(len(stmts)))
+        # The fraction of the statements received is only known if the
+        # query has a maximum number of statements.
+        if snapshot.completeness is not None:
+            resp.set('completeness', '%.2f' % snapshot.completeness)
         resp.set('dump-limit', str(DUMP_LIMIT))
         return resp
 
@@ -235,12 +328,15 @@ class MSA_Module(Bioagent):
         """Confirm a protein-protein interaction given subject, object, verb"""
         try:
             subj, obj, stmt_type = self._get_query_info(content)
+            # The finder returns at once, and the statements are waited for
+            # below, until the deadline of the request at the latest.
             finder = \
                 self.msa.find_mechanism_from_input(subj, obj, None, stmt_type,
                                                    ev_limit=5, persist=False,
-                                                   timeout=5)
+                                                   timeout=0)
             self._send_provenance_async(finder,
                 'confirming that some statements match')
+            self._prefetch_follow_ups(subj, obj)
         except MSALookupError as mle:
             return self.make_failure(mle.args[0])
         stmts = finder.get_statements(timeout=20)
@@ -257,6 +353,11 @@ class MSA_Module(Bioagent):
 
     def respond_get_paper_model(self, content):
         """Get and display the model from a paper, indicated by pmid."""
+        if not CAN_GET_PAPER_MODELS:
+            return self.make_failure(
+                'NO_KNOWLEDGE_ACCESS',
+                'Cannot access the database through the web api.'
+                )
         pmid_raw = content.gets('pmid')
         prefix = 'PMID-'
         if pmid_raw.startswith(prefix) and pmid_raw[len(prefix):].isdigit():
@@ -264,8 +365,7 @@ class MSA_Module(Bioagent):
         else:
             return self.make_failure('BAD_INPUT')
         try:
-            stmts = get_statements_for_paper([('pmid', pmid)],
-                                             simple_response=True)
+            model = self.paper_models.get_model(pmid)
         except IndraDBRestAPIError as e:
             if e.status_code == 404 and 'Invalid or unavailable' in e.reason:
                 logger.error("Could not find pmid: %s" % e.reason)
@@ -273,17 +373,13 @@ class MSA_Module(Bioagent):
             else:
                 raise e
 
-        if not stmts:
+        if not model['stmts']:
             resp = KQMLPerformative('SUCCESS')
             resp.set('relations-found', 0)
             return resp
-        stmts = ac.map_grounding(stmts)
-        stmts = ac.map_sequence(stmts)
-        unique_stmts = ac.run_preassembly(stmts, return_toplevel=True)
-        diagrams = _make_diagrams(stmts)
-        self.send_display_model(diagrams)
+        self.send_display_model(model['diagrams'])
         resp = KQMLPerformative('SUCCESS')
-        resp.set('relations-found', len(unique_stmts))
+        resp.set('relations-found', len(model['stmts']))
         resp.set('dump-limit', str(DUMP_LIMIT))
         return resp
 
@@ -304,7 +400,11 @@ class MSA_Module(Bioagent):
     def _send_display_stmts(self, finder, nl_question):
         try:
             logger.debug("Waiting for statements to finish...")
-            stmts = finder.get_statements(block=True)
+            stmts = finder.get_statements(block=True, timeout=30)
+            if stmts is None:
+                logger.warning('The statements did not come in time to send '
+                               'them as provenance.')
+                return
             start_time = datetime.now()
             logger.info('Sending display statements.')
             self.send_provenance_for_stmts(stmts, nl_question,
@@ -318,21 +418,6 @@ class MSA_Module(Bioagent):
             raise
 
 
-def _make_sbgn(stmts):
-    sa = SBGNAssembler()
-    sa.add_statements(stmts)
-    sa.make_model()
-    sbgn_str = sa.print_model()
-    logger.info(sbgn_str)
-    return sbgn_str
-
-
-def _make_diagrams(stmts):
-    sbgn = _make_sbgn(stmts)
-    diagrams = {'sbgn': sbgn.decode('utf-8')}
-    return diagrams
-
-
 def _get_agent_if_present(content, key):
     obj_clj = content.get(key)
     if obj_clj is None:
@@ -342,4 +427,7 @@ def _get_agent_if_present(content, key):
 
 
 if __name__ == "__main__":
-    MSA_Module(argv=sys.argv[1:])
+    if '--profile-startup' in sys.argv:
+        profile_startup(MSA_Module)
+    else:
+        MSA_Module(argv=sys.argv[1:])
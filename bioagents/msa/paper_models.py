@@ -0,0 +1,272 @@
+"""Assemble the models of papers for GET-PAPER-MODEL, caching them on disk.
+
+The model of a paper is made from the statements the INDRA DB has for it:
+their grounding and sequences are mapped, they are preassembled, and an SBGN
+diagram is made of them. This takes seconds of CPU for a large paper, and
+the same papers are asked for again and again (e.g. in demos), so the
+models are kept on disk, one file per PMID, and the least recently used are
+removed beyond a maximum number. The grounding and sequence mapping of the
+statements of large papers is done in chunks by a pool of processes.
+
+The models of a list of papers can be made ahead of time with
+
+    python scripts/precompute_paper_models.py 18388193 25043203 ...
+"""
+__all__ = ['PaperModelCache', 'PaperModelService',
+           'map_grounding_and_sequence']
+
+import os
+import glob
+import pickle
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from indra import get_config
+
+from bioagents.cache import digest
+
+logger = logging.getLogger('MSA')
+
+
+def get_default_cache_dir():
+    """Return the MSA_PAPER_MODEL_CACHE directory, or one in the home."""
+    return get_config('MSA_PAPER_MODEL_CACHE') or \
+        os.path.join(os.path.expanduser('~'), '.bioagents', 'paper_models')
+
+
+class PaperModelCache(object):
+    """Paper models stored on disk, one file per PMID.
+
+    Parameters
+    ----------
+    directory : str
+        The directory in which the models are stored, created if needed.
+    max_entries : int
+        The maximum number of models kept. The least recently used are
+        removed beyond it.
+    """
+    def __init__(self, directory, max_entries=500):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _get_fname(self, pmid):
+        return os.path.join(self.directory,
+                            'paper_%s.pkl' % digest(str(pmid)))
+
+    def get(self, pmid):
+        """Return the model stored for a PMID, or None if there is none."""
+        model = self._load(pmid)
+        if model is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return model
+
+    def _load(self, pmid):
+        fname = self._get_fname(pmid)
+        try:
+            with open(fname, 'rb') as fh:
+                model = pickle.load(fh)
+            # The time of last use is that of last modification.
+            os.utime(fname)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning('Could not load the model of PMID %s: %s'
+                           % (pmid, e))
+            return None
+        return model
+
+    def put(self, pmid, model):
+        """Store the model of a PMID, removing the least recently used."""
+        os.makedirs(self.directory, exist_ok=True)
+        fname = self._get_fname(pmid)
+        # Write to a temporary file first so a partial model is never read.
+        tmp_fname = '%s.%d.%d.tmp' % (fname, os.getpid(),
+                                      threading.get_ident())
+        with open(tmp_fname, 'wb') as fh:
+            pickle.dump(model, fh)
+        os.replace(tmp_fname, fname)
+        self._evict()
+
+    def _get_fnames(self):
+        return glob.glob(os.path.join(self.directory, 'paper_*.pkl'))
+
+    def _evict(self):
+        with self._lock:
+            fnames = self._get_fnames()
+            if len(fnames) <= self.max_entries:
+                return
+            mtimes = []
+            for fname in fnames:
+                try:
+                    mtimes.append((os.path.getmtime(fname), fname))
+                except FileNotFoundError:
+                    pass
+            for _, fname in sorted(mtimes)[:len(mtimes) - self.max_entries]:
+                try:
+                    os.remove(fname)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            for fname in self._get_fnames():
+                os.remove(fname)
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._get_fnames())
+
+    def stats(self):
+        """Return a dict summarizing the use of the cache."""
+        lookups = self.hits + self.misses
+        return {'size': len(self), 'maxsize': self.max_entries,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None}
+
+
+def map_grounding_and_sequence(stmts):
+    """Map the grounding and the sequence of statements."""
+    from indra.tools import assemble_corpus as ac
+    stmts = ac.map_grounding(stmts)
+    stmts = ac.map_sequence(stmts)
+    return stmts
+
+
+def _make_sbgn(stmts):
+    from indra.assemblers.sbgn import SBGNAssembler
+    sa = SBGNAssembler()
+    sa.add_statements(stmts)
+    sa.make_model()
+    sbgn_str = sa.print_model()
+    logger.info(sbgn_str)
+    return sbgn_str
+
+
+def _make_diagrams(stmts):
+    sbgn = _make_sbgn(stmts)
+    diagrams = {'sbgn': sbgn.decode('utf-8')}
+    return diagrams
+
+
+class PaperModelService(object):
+    """Make the models of papers, caching them by PMID.
+
+    A model is a dict with the PMID ('pmid'), the preassembled statements of
+    the paper ('stmts') and its diagrams by type ('diagrams').
+
+    Parameters
+    ----------
+    get_statements : callable
+        A function taking a PMID and returning the statements of the paper,
+        by default using `indra_db_rest.get_statements_for_paper`. Errors it
+        raises are raised by `get_model`.
+    cache_dir : str or None
+        The directory of the cache of models. By default that given by the
+        MSA_PAPER_MODEL_CACHE configuration, or ~/.bioagents/paper_models.
+    max_entries : int
+        The maximum number of models cached.
+    num_procs : int or None
+        The number of processes mapping statements. By default the number
+        of CPUs. If 1, statements are mapped in the calling thread.
+    chunk_size : int
+        The number of statements mapped by a process at once. Papers with
+        fewer statements are mapped in the calling thread.
+    map_function : callable
+        The function mapping a list of statements, run in the processes.
+    """
+    def __init__(self, get_statements=None, cache_dir=None, max_entries=500,
+                 num_procs=None, chunk_size=100,
+                 map_function=map_grounding_and_sequence):
+        self._get_statements = get_statements or _get_paper_statements
+        self.cache = PaperModelCache(cache_dir or get_default_cache_dir(),
+                                     max_entries=max_entries)
+        self.num_procs = num_procs or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.map_function = map_function
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pmid_locks = {}
+
+    def get_model(self, pmid):
+        """Return the model of a paper, made if it isn't cached.
+
+        Concurrent calls for the same PMID make the model only once.
+        """
+        model = self.cache.get(pmid)
+        if model is not None:
+            return model
+        with self._lock:
+            pmid_lock = self._pmid_locks.setdefault(pmid, threading.Lock())
+        with pmid_lock:
+            # It may have been made while waiting for the lock.
+            model = self.cache._load(pmid)
+            if model is None:
+                model = self._make_model(pmid)
+                self.cache.put(pmid, model)
+        with self._lock:
+            self._pmid_locks.pop(pmid, None)
+        return model
+
+    def precompute(self, pmids):
+        """Make and cache the models of papers ahead of time.
+
+        Returns a dict with the number of statements in the model of each
+        PMID, or the error raised when making it.
+        """
+        results = {}
+        for pmid in pmids:
+            try:
+                results[pmid] = len(self.get_model(pmid)['stmts'])
+            except Exception as e:
+                logger.error('Could not make the model of PMID %s: %s'
+                             % (pmid, e))
+                results[pmid] = e
+        return results
+
+    def _make_model(self, pmid):
+        stmts = self._get_statements(pmid)
+        if not stmts:
+            return {'pmid': pmid, 'stmts': [], 'diagrams': {}}
+        from indra.tools import assemble_corpus as ac
+        stmts = self.map_stmts(stmts)
+        unique_stmts = ac.run_preassembly(stmts, return_toplevel=True)
+        return {'pmid': pmid, 'stmts': unique_stmts,
+                'diagrams': _make_diagrams(stmts)}
+
+    def map_stmts(self, stmts):
+        """Map statements with the `map_function`, in chunks if many."""
+        if self.num_procs <= 1 or len(stmts) <= self.chunk_size:
+            return self.map_function(stmts)
+        chunks = [stmts[idx:idx + self.chunk_size]
+                  for idx in range(0, len(stmts), self.chunk_size)]
+        logger.info('Mapping %d statements in %d chunks.'
+                    % (len(stmts), len(chunks)))
+        mapped = []
+        for chunk in self._get_pool().map(self.map_function, chunks):
+            mapped += chunk
+        return mapped
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.num_procs)
+            return self._pool
+
+    def shutdown(self):
+        """Stop the processes mapping statements."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def _get_paper_statements(pmid):
+    from indra.sources.indra_db_rest import get_statements_for_paper
+    return get_statements_for_paper([('pmid', pmid)], simple_response=True)
@@ -0,0 +1,146 @@
+"""Speculative prefetching of the likely follow-up queries of the MSA.
+
+Dialogues are predictable: after finding the relations of an entity, users
+often ask what it affects, what affects it, which of its forms are active, or
+about its neighborhood. The Prefetcher runs such queries in the background
+while the agent is idle, so that their results are in the `query_cache` when
+the follow-up request comes in.
+
+Prefetches have a lower priority than real requests: none is started while
+a request is being handled, and those waiting are dropped when a request
+comes in. A prefetch already sent can't be stopped, but the Prefetcher
+stops waiting for it; if a request makes the same query meanwhile, it shares
+the running query rather than making its own.
+"""
+__all__ = ['Prefetcher']
+
+import time
+import logging
+import itertools
+import threading
+from queue import PriorityQueue, Empty
+
+logger = logging.getLogger('MSA')
+
+
+class Prefetcher(object):
+    """Run low-priority statement queries in background threads.
+
+    Parameters
+    ----------
+    msa : bioagents.msa.msa.MSA
+        The MSA whose finders are used to make the queries.
+    max_concurrent : int
+        The maximum number of prefetches running at once.
+    max_pending : int
+        The maximum number of prefetches waiting to run. Those scheduled
+        when this many are waiting are dropped.
+    timeout : float
+        The number of seconds a prefetch is waited for before it is given up
+        on.
+    """
+    def __init__(self, msa, max_concurrent=2, max_pending=16, timeout=30):
+        self.msa = msa
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._queue = PriorityQueue()
+        self._seq = itertools.count()
+        self._generation = 0
+        self._num_requests = 0
+        self._scheduled = set()
+        self._workers = []
+        self._idle = threading.Condition()
+        self.stats = {'scheduled': 0, 'done': 0, 'cancelled': 0, 'failed': 0}
+
+    def schedule(self, method, *args, **params):
+        """Schedule a prefetch of the statements found by an MSA method.
+
+        The arguments are those of `MSA.find_mechanisms`, and a `priority`
+        keyword argument may be given: prefetches with a lower priority are
+        run first. A prefetch identical to one already scheduled since the
+        last request came in is ignored.
+        """
+        priority = params.pop('priority', 0)
+        key = (method, repr(args), repr(sorted(params.items())))
+        with self._idle:
+            if key in self._scheduled or \
+                    self._queue.qsize() >= self.max_pending:
+                return False
+            self._scheduled.add(key)
+            self._queue.put((priority, next(self._seq), self._generation,
+                             method, args, params))
+            self.stats['scheduled'] += 1
+            if len(self._workers) < self.max_concurrent:
+                worker = threading.Thread(target=self._run_prefetches,
+                                          name='msa-prefetch-%d'
+                                          % len(self._workers))
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+        return True
+
+    def cancel(self):
+        """Drop the waiting prefetches, and stop waiting for running ones."""
+        with self._idle:
+            self._generation += 1
+            self._scheduled.clear()
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except Empty:
+                    break
+                self.stats['cancelled'] += 1
+
+    def begin_request(self):
+        """Note that a request came in, cancelling the prefetches."""
+        self.cancel()
+        with self._idle:
+            self._num_requests += 1
+
+    def end_request(self):
+        """Note that a request was handled, letting prefetches run again."""
+        with self._idle:
+            self._num_requests -= 1
+            self._idle.notify_all()
+
+    def _is_current(self, generation):
+        return generation == self._generation
+
+    def _count(self, outcome):
+        # Prefetches end on the worker threads, and are cancelled on the
+        # thread handling requests.
+        with self._idle:
+            self.stats[outcome] += 1
+
+    def _run_prefetches(self):
+        while True:
+            priority, _, generation, method, args, params = self._queue.get()
+            with self._idle:
+                while self._num_requests and self._is_current(generation):
+                    self._idle.wait()
+                if not self._is_current(generation):
+                    continue
+            self._prefetch(generation, method, args, params)
+
+    def _prefetch(self, generation, method, args, params):
+        logger.debug('Prefetching %s for %s.' % (method, args))
+        # With no timeout, making the finder doesn't wait for the query, so
+        # that the wait below can be cut short.
+        params = dict(params, timeout=0)
+        try:
+            finder = self.msa.find_mechanisms(method, *args, **params)
+            deadline = time.monotonic() + self.timeout
+            # The statements are waited for in short steps, so that a
+            # cancelled prefetch isn't waited for much longer.
+            while self._is_current(generation) \
+                    and time.monotonic() < deadline:
+                if finder.get_statements(block=True, timeout=0.5) is not None:
+                    self._count('done')
+                    return
+        except Exception as e:
+            logger.info('Failed to prefetch %s for %s: %s'
+                        % (method, args, e))
+            self._count('failed')
+            return
+        self._count('cancelled')
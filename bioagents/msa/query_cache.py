@@ -0,0 +1,400 @@
+"""A process-wide cache of the results of the statement queries of the MSA.
+
+Dialogues often ask about the same mechanism several times in a row (e.g.
+CONFIRM-RELATION followed by FIND-RELATIONS on the same pair of entities),
+and each statement finder used to start a new query of the INDRA DB. The
+QueryCache keeps the finished results of recent queries, with their
+evidence and source counts, keyed by the parameters of the query (other
+than its timeout). Concurrent identical queries share the processor of the
+first one while it is running, so only one query is made. A query for a
+type of statement is answered from the cached result of the same query for
+all types, if that result is known to be complete.
+
+The cached results are compact: once a result is cached, it only keeps the
+JSON of its statements (a fraction of the memory of the Statement objects)
+with their hashes and types. The Statements are made from the JSON when a
+finder uses the result, and shared by all the finders using it until the
+last of them is done, so that a cached result costs little memory while no
+one uses it.
+"""
+__all__ = ['StatementResult', 'QueryCache', 'get_query_key']
+
+import json
+import time
+import weakref
+import logging
+import threading
+
+from indra.statements import get_statement_by_name, get_all_descendants, \
+    stmts_from_json
+
+from bioagents.cache import LRUCache
+
+logger = logging.getLogger('MSA')
+
+
+class _StatementList(list):
+    """A list of statements, which can be referred to weakly."""
+
+
+class StatementResult(object):
+    """The finished result of a statement query.
+
+    This has the interface of the indra_db_rest processors used by the
+    statement finders. All the statements are loaded when it is made, so it
+    is never working in the background. Once made `compact`, it keeps the
+    JSON of its statements rather than the statements, and can't be changed.
+
+    Parameters
+    ----------
+    statements : list[indra.statements.Statement]
+        The statements found.
+    ev_counts : dict
+        The total evidence count of each statement, keyed by hash.
+    source_counts : dict
+        The evidence count per source of each statement, keyed by hash.
+    complete : bool
+        True if these are known to be all the statements matching the query,
+        i.e. the result was not cut short by `max_stmts` or paging.
+    """
+    def __init__(self, statements, ev_counts, source_counts, complete=False):
+        self.complete = complete
+        self._ev_counts = ev_counts
+        self._source_counts = source_counts
+        # The shallow hash and type name of each statement, and once the
+        # result is compact, its JSON.
+        self.hashes = [stmt.get_hash(shallow=True) for stmt in statements]
+        self.type_names = [type(stmt).__name__ for stmt in statements]
+        self._stmt_jsons = None
+        self._statements = _StatementList(statements)
+        self._statements_ref = None
+        self._lock = threading.Lock()
+
+    @property
+    def statements(self):
+        """The list of statements, which must not be changed.
+
+        The statements of a compact result are made from their JSON if no
+        one is using them already.
+        """
+        if self._statements is not None:
+            return self._statements
+        with self._lock:
+            statements = self._statements_ref() \
+                if self._statements_ref is not None else None
+            if statements is None:
+                statements = _StatementList(stmts_from_json(
+                    [json.loads(stmt_json) for stmt_json in self._stmt_jsons]))
+                self._statements_ref = weakref.ref(statements)
+        return statements
+
+    @property
+    def statements_sample(self):
+        return self.statements
+
+    def compact(self):
+        """Keep the JSON of the statements rather than the statements.
+
+        The statements are kept for as long as anyone uses them, and are made
+        again from their JSON when needed after that.
+        """
+        with self._lock:
+            if self._statements is None:
+                return
+            self._stmt_jsons = [json.dumps(stmt.to_json(),
+                                           separators=(',', ':'))
+                                for stmt in self._statements]
+            self._statements_ref = weakref.ref(self._statements)
+            self._statements = None
+
+    @classmethod
+    def from_processor(cls, processor):
+        """Make a result from the statements and counts of a processor."""
+        result = cls([], {}, {})
+        result.merge_results(processor)
+        return result
+
+    def get_subset(self, indices):
+        """Return a result of the statements at some indices, with counts.
+
+        The subset of a compact result is compact, and its statements are
+        only made when used.
+        """
+        hashes = [self.hashes[idx] for idx in indices]
+        ev_counts = {h: self._ev_counts.get(h) for h in hashes}
+        source_counts = {h: self._source_counts.get(h) for h in hashes}
+        if self._statements is not None:
+            return StatementResult([self._statements[idx] for idx in indices],
+                                   ev_counts, source_counts,
+                                   complete=self.complete)
+        subset = StatementResult([], ev_counts, source_counts,
+                                 complete=self.complete)
+        subset.compact()
+        subset.hashes = hashes
+        subset.type_names = [self.type_names[idx] for idx in indices]
+        subset._stmt_jsons = [self._stmt_jsons[idx] for idx in indices]
+        return subset
+
+    def is_working(self):
+        return False
+
+    def wait_until_done(self, timeout=None):
+        return True
+
+    def get_received_statements(self):
+        """Return the statements received so far, i.e. all of them."""
+        return self.statements
+
+    def get_ev_count(self, stmt):
+        """Get the total evidence count for a statement."""
+        return self._ev_counts.get(stmt.get_hash(shallow=True))
+
+    def get_source_count(self, stmt):
+        """Get the source counts for a statement."""
+        return self._source_counts.get(stmt.get_hash(shallow=True))
+
+    def merge_results(self, other_processor):
+        """Add the statements of another processor to this one."""
+        if self._statements is None:
+            raise TypeError('A compact result must not be changed.')
+        for stmt in other_processor.statements:
+            stmt_hash = stmt.get_hash(shallow=True)
+            if stmt_hash in self._ev_counts:
+                continue
+            self._statements.append(stmt)
+            self.hashes.append(stmt_hash)
+            self.type_names.append(type(stmt).__name__)
+            self._ev_counts[stmt_hash] = other_processor.get_ev_count(stmt)
+            self._source_counts[stmt_hash] = \
+                other_processor.get_source_count(stmt)
+
+
+class _SharedProcessor(object):
+    """A running processor shared by identical queries.
+
+    This is made before the query is sent, so that identical queries sent
+    meanwhile wait for it instead of sending their own. Once the processor
+    is seen to be done, its result is put in the cache, and is the `result`
+    of this, which the finders of the query keep rather than the processor.
+    """
+    def __init__(self, cache, key, params):
+        self._cache = cache
+        self._key = key
+        self.params = dict(params)
+        self.result = None
+        self._result_statements = None
+        self._processor = None
+        self._started = threading.Event()
+        self.created = time.monotonic()
+
+    def start(self, processor):
+        self._processor = processor
+        self._started.set()
+
+    def fail(self):
+        self._started.set()
+
+    def wait_started(self):
+        """Wait until the query is sent, returning False if it failed."""
+        self._started.wait()
+        return self._processor is not None
+
+    @property
+    def statements(self):
+        # Once the result is made, its statements are kept in memory by this
+        # until the finders using them have them.
+        if self._result_statements is not None:
+            return self._result_statements
+        return self._processor.statements
+
+    @property
+    def statements_sample(self):
+        return self._processor.statements_sample
+
+    def get_received_statements(self):
+        """Return the statements received so far, while the query runs.
+
+        The INDRA DB processors only fill their `statements` once they are
+        done, and their `statements_sample` with the first page. The
+        statements of all the pages received so far are made from the JSON
+        the processor keeps as each page comes in.
+        """
+        if not self._processor.is_working():
+            return self._processor.statements
+        get_stmts_by_hash = getattr(self._processor,
+                                    'get_hash_statements_dict', None)
+        if get_stmts_by_hash is not None:
+            try:
+                return list(get_stmts_by_hash().values())
+            except RuntimeError:
+                # A page was being merged by the thread of the processor.
+                pass
+        return self._processor.statements_sample or []
+
+    def is_working(self):
+        working = self._processor.is_working()
+        if not working:
+            self._cache._finish(self._key, self)
+        return working
+
+    def wait_until_done(self, timeout=None):
+        done = self._processor.wait_until_done(timeout)
+        self.is_working()
+        return done
+
+    def get_ev_count(self, stmt):
+        return self._processor.get_ev_count(stmt)
+
+    def get_source_count(self, stmt):
+        return self._processor.get_source_count(stmt)
+
+    def merge_results(self, other_processor):
+        raise TypeError('A shared processor must not be changed.')
+
+
+def get_query_key(params):
+    """Return a key identifying the statements a query gets.
+
+    The timeout of the query only affects how long the caller waits, so it
+    is not part of the key, and the order of the agents doesn't matter.
+    """
+    params = {k: v for k, v in params.items()
+              if k != 'timeout' and v is not None and v != []}
+    if 'agents' in params:
+        params['agents'] = sorted(key for key in params['agents']
+                                  if key is not None)
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+def _is_complete(params, num_stmts):
+    """Return True if a query with these parameters got all its statements.
+    """
+    max_stmts = params.get('max_stmts')
+    if max_stmts is not None:
+        return num_stmts < max_stmts
+    # Without persisting, only the first page of statements is got.
+    return params.get('persist', True)
+
+
+def _get_stmt_type_names(stmt_type, use_exact_type=False):
+    stmt_class = get_statement_by_name(stmt_type)
+    names = {stmt_class.__name__}
+    if not use_exact_type:
+        names |= {cls.__name__ for cls in get_all_descendants(stmt_class)}
+    return names
+
+
+class QueryCache(object):
+    """Cache the results of statement queries, sharing running queries.
+
+    The results returned are shared between callers, and must not be
+    changed.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of query results kept.
+    ttl : float or None
+        The number of seconds after which a result expires, so that changes
+        in the knowledge base are seen eventually.
+    max_statements : int or None
+        The maximum total number of statements in the cached results. Least
+        recently used results are evicted to stay below it.
+    """
+    def __init__(self, maxsize=128, ttl=1800, max_statements=50000):
+        self.results = LRUCache(
+            maxsize=maxsize, ttl=ttl, max_weight=max_statements,
+            get_weight=lambda result: len(result.hashes) + 1)
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def get_processor(self, params, get_statements):
+        """Return a processor for a query, from the cache if possible.
+
+        Parameters
+        ----------
+        params : dict
+            The keyword arguments of the query.
+        get_statements : callable
+            The function making the query if it is neither cached nor
+            running, e.g. `indra_db_rest.get_statements`.
+        """
+        key = get_query_key(params)
+        with self._lock:
+            result = self.results.get(key)
+            if result is None:
+                result = self._get_derived(params)
+                if result is not None:
+                    result.compact()
+                    self.results.put(key, result)
+            if result is not None:
+                logger.info('Using the cached result of query %s.' % key)
+                return result
+            shared = self._running.get(key)
+            # A query running for longer than the ttl is given up on.
+            if shared is not None and (self.results.ttl is None or
+                                       time.monotonic() - shared.created <
+                                       self.results.ttl):
+                is_new = False
+            else:
+                shared = _SharedProcessor(self, key, params)
+                self._running[key] = shared
+                is_new = True
+
+        if not is_new:
+            logger.info('Sharing the running query %s.' % key)
+            if shared.wait_started():
+                return shared
+            # The query failed, so it is sent again, to get its error.
+            return get_statements(**params)
+
+        try:
+            processor = get_statements(**params)
+        except Exception:
+            with self._lock:
+                if self._running.get(key) is shared:
+                    del self._running[key]
+            shared.fail()
+            raise
+        shared.start(processor)
+        # Queries that are already finished (e.g. ones that didn't persist)
+        # are cached now.
+        shared.is_working()
+        return shared
+
+    def _get_derived(self, params):
+        """Return the result of a query for a type of statement, made from
+        the complete result of the same query for all types, if cached."""
+        stmt_type = params.get('stmt_type')
+        if stmt_type is None:
+            return None
+        base_params = {k: v for k, v in params.items()
+                       if k not in ('stmt_type', 'use_exact_type')}
+        base_result = self.results.get(get_query_key(base_params))
+        if base_result is None or not base_result.complete:
+            return None
+        try:
+            type_names = _get_stmt_type_names(
+                stmt_type, params.get('use_exact_type', False))
+        except Exception:
+            return None
+        return base_result.get_subset(
+            [idx for idx, type_name in enumerate(base_result.type_names)
+             if type_name in type_names])
+
+    def _finish(self, key, shared):
+        with self._lock:
+            if self._running.get(key) is not shared:
+                return
+            del self._running[key]
+        result = StatementResult.from_processor(shared)
+        result.complete = _is_complete(shared.params, len(result.hashes))
+        shared._result_statements = result.statements
+        result.compact()
+        shared.result = result
+        self.results.put(key, result)
+
+    def clear(self):
+        with self._lock:
+            self._running.clear()
+            self.results.clear()
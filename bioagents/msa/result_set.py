@@ -0,0 +1,166 @@
+"""An array-backed set of the statements found by a finder.
+
+The finished result of a query is kept by the `query_cache` as the JSON of
+its statements, and the Statements are made from it while finders use them,
+shared by all the finders of the query. A StatementSet refers to that list
+rather than copying it: it keeps the indices of its statements in the list,
+and columns of the hash, type and evidence count of each, so that counting
+and sorting the statements is done on arrays. Finders hand out their set
+itself, which is read only, rather than a list, and iterating over a set
+looks up the statements one at a time. Once the last set referring to the
+statements of a query is gone, they are freed, and only their JSON is kept.
+
+There is no column of the groundings of the agents, since the other agents
+of a statement depend on the roles of the query; those are worked out from
+the statements (see `StatementFinder.get_other_agents`).
+"""
+__all__ = ['StatementSet']
+
+import threading
+from collections.abc import Sequence
+
+import numpy
+
+
+# The names of the types of statement, interned as small ints shared by all
+# the sets.
+_type_names = []
+_type_codes = {}
+_type_lock = threading.Lock()
+
+
+def _get_type_code(stmt_type):
+    code = _type_codes.get(stmt_type)
+    if code is None:
+        with _type_lock:
+            code = _type_codes.get(stmt_type)
+            if code is None:
+                code = len(_type_names)
+                _type_names.append(stmt_type)
+                _type_codes[stmt_type] = code
+    return code
+
+
+class StatementSet(Sequence):
+    """A read only sequence of statements, stored as rows of a shared list.
+
+    Parameters
+    ----------
+    source : list[indra.statements.Statement]
+        The list of statements the rows refer to, which must not change.
+    rows : numpy.ndarray
+        The index in `source` of each statement of the set.
+    hashes : numpy.ndarray
+        The (shallow) hash of each statement.
+    type_codes : numpy.ndarray
+        The code of the type of each statement (see `get_type_name`).
+    ev_counts : numpy.ndarray
+        The total evidence count of each statement, -1 where unknown.
+    source_counts : list[dict]
+        The evidence count per source of each statement.
+    """
+    def __init__(self, source, rows, hashes, type_codes, ev_counts,
+                 source_counts):
+        self.source = source
+        self.rows = rows
+        self.hashes = hashes
+        self.type_codes = type_codes
+        self.ev_counts = ev_counts
+        self.source_counts = source_counts
+
+    @classmethod
+    def from_statements(cls, stmts, processor=None):
+        """Make a set of statements, with the counts given by a processor.
+
+        If the statements are all in the `statements` of the processor, the
+        set refers to those rather than keeping a list of its own.
+        """
+        source = processor.statements if processor is not None else None
+        rows = None
+        if source is not None:
+            source_rows = {id(stmt): row for row, stmt in enumerate(source)}
+            rows = [source_rows.get(id(stmt)) for stmt in stmts]
+            if None in rows:
+                rows = None
+        if rows is None:
+            source = list(stmts)
+            rows = range(len(source))
+        hashes = numpy.empty(len(rows), dtype=numpy.int64)
+        type_codes = numpy.empty(len(rows), dtype=numpy.int16)
+        ev_counts = numpy.full(len(rows), -1, dtype=numpy.int64)
+        source_counts = []
+        for idx, stmt in enumerate(stmts):
+            hashes[idx] = stmt.get_hash()
+            type_codes[idx] = _get_type_code(type(stmt).__name__)
+            if processor is None:
+                source_counts.append(None)
+                continue
+            ev_count = processor.get_ev_count(stmt)
+            if ev_count is not None:
+                ev_counts[idx] = ev_count
+            source_counts.append(processor.get_source_count(stmt))
+        return cls(source, numpy.array(rows, dtype=numpy.int64), hashes,
+                   type_codes, ev_counts, source_counts)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.source[row] for row in self.rows[idx]]
+        return self.source[self.rows[idx]]
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.source[row]
+
+    def to_list(self):
+        """Return a new list of the statements."""
+        return [self.source[row] for row in self.rows]
+
+    def take(self, indices):
+        """Return the set of the statements at some indices of this one."""
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        return StatementSet(self.source, self.rows[indices],
+                            self.hashes[indices], self.type_codes[indices],
+                            self.ev_counts[indices],
+                            [self.source_counts[idx] for idx in indices])
+
+    def get_index(self):
+        """Return a dict of the index of the first statement with each hash.
+        """
+        index = {}
+        for idx, stmt_hash in enumerate(self.hashes.tolist()):
+            index.setdefault(stmt_hash, idx)
+        return index
+
+    def get_ev_totals(self):
+        """Return a dict of the evidence count of each statement, by hash.
+
+        Statements without a known count have None.
+        """
+        return {int(stmt_hash): (int(ev_count) if ev_count >= 0 else None)
+                for stmt_hash, ev_count in zip(self.hashes, self.ev_counts)}
+
+    def get_source_counts(self):
+        """Return a dict of the source counts of each statement, by hash."""
+        return {int(stmt_hash): counts for stmt_hash, counts
+                in zip(self.hashes, self.source_counts)}
+
+    def get_type_totals(self):
+        """Return the total evidence count of each type of statement.
+
+        The types are given by their names in lower case, in the order in
+        which they first appear, and only the types in the set are included.
+        """
+        totals = numpy.bincount(self.type_codes,
+                                weights=numpy.maximum(self.ev_counts, 0),
+                                minlength=len(_type_names))
+        codes, first_idx = numpy.unique(self.type_codes, return_index=True)
+        return {_type_names[code].lower(): int(totals[code])
+                for code in codes[numpy.argsort(first_idx)]}
+
+    @staticmethod
+    def get_type_name(code):
+        """Return the name of the type of statement with a code."""
+        return _type_names[code]
@@ -0,0 +1,122 @@
+"""The map from verbs to the types of statement they describe, for the MSA.
+
+The map is built from the names of the statement types with the verb forms
+of the English assembler, e.g. 'phosphorylate', 'phosphorylates' and
+'phosphorylated' for Phosphorylation. Building it walks all the statement
+types, so it is built ahead of time and stored in
+resources/msa_verb_map.json, with a digest of the INDRA sources it was built
+from (the statements and the English assembler). It is rebuilt when the
+package is built (see setup.py), or by running
+
+    python bioagents/msa/verbs.py
+
+If the stored map is missing, or was built from other sources, the map is
+built when it is first needed instead. Other versions of INDRA with the same
+sources, e.g. installed from git, use the stored map.
+
+This module only depends on INDRA, so that it can be run at build time.
+"""
+import os
+import json
+import hashlib
+import logging
+from types import MappingProxyType
+
+logger = logging.getLogger('MSA')
+
+
+VERB_MAP_PATH = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'resources',
+    'msa_verb_map.json'))
+
+# The version of the format of the stored map.
+VERB_MAP_VERSION = 2
+
+
+# These are statement types that aren't binary and therefore don't need
+# to be included in the verb map
+_non_binary = ('hasactivity', 'activeform', 'selfmodification',
+               'autophosphorylation', 'transphosphorylation',
+               'event', 'unresolved', 'association', 'complex')
+
+
+def build_verb_map():
+    """Return the verb map built from the statement types of INDRA."""
+    from indra.statements import Statement, get_all_descendants
+    from indra.assemblers.english.assembler import statement_base_verb, \
+        statement_present_verb, statement_passive_verb
+    # We first get all statement types
+    stmts = get_all_descendants(Statement)
+    verb_map = {}
+    for stmt in stmts:
+        # Get the class name
+        name = stmt.__name__
+        if name.lower() in _non_binary:
+            continue
+        # Get the base verb form of the statement, e.g., "phosphorylate"
+        base_verb = statement_base_verb(name.lower())
+        verb_map[base_verb] = {'stmt': name, 'type': 'base'}
+        # Get the present form of the statement, e.g., "inhibits"
+        present_verb = statement_present_verb(name.lower())
+        verb_map[present_verb] = {'stmt': name, 'type': 'present'}
+        # Get the passive / state form of the statement, e.g., "activated"
+        passive_verb = statement_passive_verb(name.lower())
+        verb_map[passive_verb] = {'stmt': name, 'type': 'passive'}
+    return verb_map
+
+
+def _get_source_digest():
+    """Return a digest of the INDRA sources the verb map is built from."""
+    from indra import __path__ as indra_path
+    statements_path = os.path.join(indra_path[0], 'statements')
+    fnames = [os.path.join(statements_path, fname)
+              for fname in sorted(os.listdir(statements_path))
+              if fname.endswith('.py')]
+    fnames.append(os.path.join(indra_path[0], 'assemblers', 'english',
+                               'assembler.py'))
+    source_digest = hashlib.sha1()
+    for fname in fnames:
+        with open(fname, 'rb') as fh:
+            source_digest.update(fh.read())
+    return source_digest.hexdigest()
+
+
+def write_verb_map(fname=VERB_MAP_PATH):
+    """Build the verb map and store it in a JSON file."""
+    verb_map = build_verb_map()
+    with open(fname, 'w') as fh:
+        json.dump({'version': VERB_MAP_VERSION,
+                   'source_digest': _get_source_digest(),
+                   'verb_map': verb_map}, fh, indent=1, sort_keys=True)
+    return fname
+
+
+def _freeze(verb_map):
+    return MappingProxyType({verb: MappingProxyType(entry)
+                             for verb, entry in verb_map.items()})
+
+
+def load_verb_map(fname=VERB_MAP_PATH):
+    """Return the stored verb map as a read only mapping.
+
+    The map is built instead if it was not stored, or was stored in another
+    format or from other sources.
+    """
+    try:
+        with open(fname, 'r') as fh:
+            stored = json.load(fh)
+        source_digest = _get_source_digest()
+    except (IOError, ValueError) as e:
+        logger.info('Could not load the verb map from %s (%s), building it.'
+                    % (fname, e))
+        return _freeze(build_verb_map())
+    if stored.get('version') != VERB_MAP_VERSION or \
+            stored.get('source_digest') != source_digest:
+        logger.info('The verb map in %s is out of date, building it.'
+                    % fname)
+        return _freeze(build_verb_map())
+    return _freeze(stored['verb_map'])
+
+
+if __name__ == '__main__':
+    print('Wrote the verb map to %s.' % write_verb_map())
@@ -0,0 +1,75 @@
+"""Building the provenance reports sent by the agents.
+
+Grouping and sorting a large list of statements is the main cost of a
+provenance report, and the same statements are often reported on more than
+once (e.g. the MSA sends provenance for a finder after each of several
+questions about it). The ProvenanceReportBuilder keeps the sorted groups of
+recent statement lists, keyed by a digest of the statements and their
+counts, and only renders the groups that are shown in the summary.
+"""
+__all__ = ['ProvenanceReportBuilder']
+
+import json
+import logging
+
+from indra.util.statement_presentation import group_and_sort_statements, \
+    make_string_from_sort_key
+
+from bioagents.cache import LRUCache, digest
+
+logger = logging.getLogger('Bioagents')
+
+
+class ProvenanceReportBuilder(object):
+    """Make the summaries of provenance reports, caching the sorted groups.
+
+    Parameters
+    ----------
+    maxsize : int
+        The number of statement lists for which the sorted groups are kept.
+    """
+    def __init__(self, maxsize=32):
+        self.groups = LRUCache(maxsize=maxsize)
+
+    @staticmethod
+    def get_key(stmts, ev_counts=None, source_counts=None):
+        """Return a digest identifying a list of statements and its counts."""
+        parts = [','.join(stmt.uuid for stmt in stmts)]
+        for counts in (ev_counts, source_counts):
+            parts.append(json.dumps(counts, sort_keys=True)
+                         if counts is not None else 'null')
+        return digest('|'.join(parts))
+
+    def get_sorted_groups(self, stmts, ev_counts=None, source_counts=None,
+                          key=None):
+        """Return the groups of the statements, sorted as in the report.
+
+        The result is shared between calls and must not be changed.
+        """
+        if key is None:
+            key = self.get_key(stmts, ev_counts, source_counts)
+        sorted_groups = self.groups.get(key)
+        if sorted_groups is None:
+            sorted_groups = group_and_sort_statements(
+                stmts, ev_totals=ev_counts, source_counts=source_counts)
+            self.groups.put(key, sorted_groups)
+        else:
+            logger.debug('Using cached groups of %d statements.' % len(stmts))
+        return sorted_groups
+
+    def make_summary_html(self, stmts, limit=5, ev_counts=None,
+                          source_counts=None, key=None):
+        """Return an html list of the top `limit` groups of statements."""
+        sorted_groups = self.get_sorted_groups(stmts, ev_counts,
+                                               source_counts, key)
+        lines = []
+        for group in sorted_groups[:limit]:
+            if source_counts is None:
+                key, verb, stmts = group
+            else:
+                key, verb, stmts, arg_counts, group_source_counts = group
+            count = key[2]
+            line = '<li>%s %s</li>' % (make_string_from_sort_key(key, verb),
+                                       '(%d)' % count)
+            lines.append(line)
+        return '<ul>%s</ul>' % ('\n'.join(lines))
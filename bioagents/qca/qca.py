@@ -5,9 +5,9 @@ import json
 import logging
 import requests
 import functools
-import ndex2.client as nc
 from enum import Enum
-from bioagents import BioagentException
+from bioagents import BioagentException, DeadlineExceeded, \
+    get_request_context
 
 
 logger = logging.getLogger('QCA')
@@ -19,6 +19,10 @@ class PathNotFoundException(BioagentException):
 
 
 class QCA(object):
+    # The number of seconds to wait for a path query, if the request being
+    # handled has no earlier deadline.
+    request_timeout = 60
+
     def __init__(self, path_host=None, network_uuid=None):
         logger.debug('Starting QCA')
 
@@ -102,6 +106,7 @@ class QCA(object):
         self.queries = []
 
         try:
+            import ndex2.client as nc
             self.ndex = nc.Ndex2(host=self.host)
         except Exception as e:
             logger.error('QCA could not connect to %s' % self.host)
@@ -130,11 +135,18 @@ class QCA(object):
         # Find paths in all available networks
         #==========================================
         for network in self.reference_networks:
-            pr = self.get_directed_paths_by_names(source_names, target_names,
-                                                  network.get("id"),
-                                                  network.get("server"),
-                                                  relation_types=relation_types,
-                                                  max_number_of_paths=50)
+            try:
+                pr = self.get_directed_paths_by_names(
+                    source_names, target_names, network.get("id"),
+                    network.get("server"), relation_types=relation_types,
+                    max_number_of_paths=50)
+            except DeadlineExceeded:
+                # Return the paths found in the networks searched so far.
+                if not results_list:
+                    raise
+                logger.warning('Deadline passed, returning the paths found '
+                               'so far.')
+                break
             prc = pr.content
             #==========================================
             # Process the data from this network
@@ -200,7 +212,14 @@ class QCA(object):
             rts = " ".join(relation_types)
             url += '&relationtypes=' + rts
 
-        r = requests.post(url)
+        context = get_request_context()
+        context.check()
+        try:
+            timeout = context.get_timeout(self.request_timeout)
+            r = requests.post(url, timeout=timeout)
+        except requests.Timeout:
+            context.check()
+            raise
         return r
 
     def get_path_node_names(self, query_result):
@@ -3,6 +3,7 @@ import sys
 import json
 import logging
 from bioagents import Bioagent, get_img_path
+from bioagents.startup import profile_startup
 from kqml import KQMLList, KQMLString
 from .qca import QCA
 from indra.statements import stmts_from_json
@@ -23,6 +24,9 @@ class QCA_Module(Bioagent):
     '''
     name = 'QCA'
     tasks = ['FIND-QCA-PATH', 'HAS-QCA-PATH']
+    # The networks are searched one after the other, and the paths found
+    # before the deadline are returned.
+    task_timeouts = {'FIND-QCA-PATH': 120, 'HAS-QCA-PATH': 120}
 
     def __init__(self, **kwargs):
         # For local testing use
@@ -177,4 +181,7 @@ def _fix_indra_edges(stmt_json_list):
 
 
 if __name__ == "__main__":
-    QCA_Module(argv=sys.argv[1:])
+    if '--profile-startup' in sys.argv:
+        profile_startup(QCA_Module)
+    else:
+        QCA_Module(argv=sys.argv[1:])
@@ -0,0 +1,219 @@
+"""Lazily initialized components and startup profiling for the bioagents.
+
+Resources that are expensive to load (tables read from disk, maps built by
+walking the INDRA class hierarchy, etc.) are wrapped in a LazyComponent so
+that they are only built the first time an agent actually needs them. All
+components register themselves here, which lets `profile_startup` report the
+time it takes to import an agent and to initialize each of its components.
+
+Every agent entry point accepts a `--profile-startup` flag, for instance:
+
+    python -m bioagents.msa.msa_module --profile-startup
+"""
+__all__ = ['LazyComponent', 'LazyMapping', 'profile_startup']
+
+import re
+import sys
+import time
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+from collections.abc import Mapping
+
+logger = logging.getLogger('Bioagents')
+
+
+_components = OrderedDict()
+
+
+class LazyComponent(object):
+    """A resource built by calling `factory` the first time it is needed.
+
+    Parameters
+    ----------
+    name : str
+        A name for the component, used when reporting startup times.
+    factory : callable
+        A function taking no arguments which builds the resource, called
+        by `load` the first time it is needed.
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self.init_time = None
+        self._factory = factory
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        _components[name] = self
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self):
+        """Return the resource, building it if this is the first call."""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    start = time.time()
+                    self._value = self._factory()
+                    self.init_time = time.time() - start
+                    self._loaded = True
+                    logger.debug('Initialized %s in %.3f seconds.'
+                                 % (self.name, self.init_time))
+        return self._value
+
+
+class LazyMapping(LazyComponent, Mapping):
+    """A LazyComponent for a dict, usable directly as a read only mapping."""
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __contains__(self, key):
+        return key in self.load()
+
+
+def get_components():
+    """Return the registered lazy components, in the order they were made."""
+    return list(_components.values())
+
+
+# Before Python 3.7 there is no `-X importtime`, so the imports are timed by
+# wrapping the function of the import system loading each module, and
+# reported in the same format.
+_TIME_IMPORTS = """
+import sys
+import time
+import importlib
+import _frozen_importlib as bootstrap
+
+load_unlocked = bootstrap._load_unlocked
+children = [0.0]
+
+
+def timed_load_unlocked(spec):
+    children.append(0.0)
+    start = time.perf_counter()
+    try:
+        return load_unlocked(spec)
+    finally:
+        cumul = time.perf_counter() - start
+        self_time = cumul - children.pop()
+        children[-1] += cumul
+        sys.stderr.write('import time: %d | %d | %s\\n'
+                         % (self_time * 1e6, cumul * 1e6, spec.name))
+
+
+bootstrap._load_unlocked = timed_load_unlocked
+importlib.import_module(sys.argv[1])
+"""
+
+
+def _get_import_times(module_name):
+    """Import a module in a fresh interpreter and time the imports.
+
+    Returns a list of (module, self seconds, cumulative seconds) tuples, as
+    reported by `python -X importtime`, or by an equivalent import hook on
+    versions of Python before 3.7.
+    """
+    if sys.version_info >= (3, 7):
+        args = ['-X', 'importtime', '-c', 'import %s' % module_name]
+    else:
+        args = ['-c', _TIME_IMPORTS, module_name]
+    res = subprocess.run([sys.executable] + args,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    patt = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+    times = []
+    for line in res.stderr.decode('utf-8', 'replace').splitlines():
+        m = patt.match(line)
+        if m is None:
+            continue
+        self_us, cumul_us, _, name = m.groups()
+        times.append((name, int(self_us) / 1e6, int(cumul_us) / 1e6))
+    return times
+
+
+def profile_startup(agent_class, out=None, top_n=15):
+    """Report the time spent importing and initializing an agent.
+
+    The agent's module is imported in a fresh interpreter to time the
+    imports, grouped by top-level package. The agent is then created in
+    testing mode (without connecting to a facilitator) and any of the
+    registered lazy components it did not need are initialized, so that
+    the cost of each is reported.
+
+    Parameters
+    ----------
+    agent_class : type
+        The Bioagent subclass to profile.
+    out : file or None
+        Where to write the report. Default is stdout.
+    top_n : int
+        The number of slowest packages and modules to list.
+    """
+    out = out if out is not None else sys.stdout
+    module_name = agent_class.__module__
+    if module_name == '__main__':
+        module_name = sys.modules['__main__'].__spec__.name
+
+    def write(line=''):
+        out.write(line + '\n')
+
+    write('Startup profile of %s (%s)' % (agent_class.name, module_name))
+    write('=' * 60)
+
+    import_times = _get_import_times(module_name)
+    if import_times:
+        total = [cumul for name, _, cumul in import_times
+                 if name == module_name]
+        write('Import of %s: %.3f s' % (module_name,
+                                        total[0] if total else
+                                        sum(t for _, t, _ in import_times)))
+        by_package = OrderedDict()
+        for name, self_time, _ in import_times:
+            package = name.split('.')[0]
+            by_package[package] = by_package.get(package, 0) + self_time
+        write()
+        write('Import time by package:')
+        for package, tm in sorted(by_package.items(),
+                                  key=lambda x: x[1], reverse=True)[:top_n]:
+            write('  %-40s %8.3f s' % (package, tm))
+        write()
+        write('Slowest modules (cumulative):')
+        for name, _, cumul in sorted(import_times, key=lambda x: x[2],
+                                     reverse=True)[:top_n]:
+            write('  %-40s %8.3f s' % (name, cumul))
+    else:
+        write('Could not get import times for %s.' % module_name)
+
+    write()
+    start = time.time()
+    try:
+        agent = agent_class(testing=True)
+        write('Agent initialization: %.3f s'
+              % (time.time() - start))
+        agent.shutdown_workers(wait=False)
+    except Exception as e:
+        write('Agent initialization failed after %.3f s: %s'
+              % (time.time() - start, e))
+
+    write()
+    write('Lazy components:')
+    for component in get_components():
+        when = 'on startup'
+        if not component.loaded:
+            when = 'on first use'
+            try:
+                component.load()
+            except Exception as e:
+                write('  %-40s   failed: %s' % (component.name, e))
+                continue
+        write('  %-40s %8.3f s (%s)' % (component.name, component.init_time,
+                                        when))
@@ -0,0 +1,357 @@
+"""Benchmark bioagents by replaying recorded transcripts of requests.
+
+A transcript is a JSON file giving the agent class, the KQML content of the
+requests sent to it in order, and the HTTP responses of the external
+services (the INDRA DB, cBioPortal, NDEx, etc.) it called, e.g.
+
+    {"agent": "bioagents.bionlg.bionlg_module.BioNLG_Module",
+     "requests": ["(INDRA-TO-NL :statements ...)", ...],
+     "http": [{"key": "GET http://... None", "method": "GET",
+               "url": "http://...", "status": 200, "headers": {...},
+               "content": "..."}, ...]}
+
+The requests are replayed against the agent in testing mode, with the calls
+made through `requests` answered from the recorded responses, so the
+benchmark runs offline and the timings don't depend on remote services.
+Requests to services that were not recorded fail with a ConnectionError.
+Transcripts are recorded by running the requests live with --record.
+
+The report gives the latency distribution and the failures of each task,
+the throughput and the peak RSS of the process, and can be compared with a
+stored baseline, for instance:
+
+    python -m bioagents.tests.benchmark bionlg.json --repeat 20 \\
+        --baseline bionlg_baseline.json
+
+Transcripts not found at the given path are looked for in the transcripts
+directory next to this file.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib
+from contextlib import contextmanager
+
+import requests
+from kqml import KQMLList, KQMLPerformative
+
+from bioagents.cache import digest
+
+logger = logging.getLogger('benchmark')
+
+transcript_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'transcripts')
+
+
+def _get_response_key(method, url, body):
+    if body is None:
+        body_key = None
+    elif isinstance(body, bytes):
+        body_key = digest(body)
+    elif isinstance(body, str):
+        body_key = digest(body.encode('utf-8'))
+    else:
+        body_key = digest(json.dumps(body, sort_keys=True))
+    return '%s %s %s' % (method.upper(), url, body_key)
+
+
+class RecordedResponses(object):
+    """Answer HTTP requests made with `requests` from recorded responses.
+
+    Parameters
+    ----------
+    records : list[dict]
+        The recorded responses, as found in a transcript.
+    record : bool
+        If True, requests are sent to the live services and their responses
+        recorded. Otherwise only recorded responses are given.
+    """
+    def __init__(self, records=None, record=False):
+        self.record = record
+        self.records = {}
+        self.num_replayed = 0
+        self.num_missing = 0
+        for rec in (records or []):
+            self.records[rec['key']] = rec
+
+    def to_json(self):
+        return [self.records[key] for key in sorted(self.records)]
+
+    @contextmanager
+    def patch(self):
+        """Patch `requests` to use the recorded responses within the context.
+        """
+        orig_request = requests.sessions.Session.request
+        responses = self
+
+        def request(session, method, url, *args, **kwargs):
+            body = kwargs.get('data', kwargs.get('json'))
+            if kwargs.get('params'):
+                url = requests.Request(method, url,
+                                       params=kwargs['params']).prepare().url
+            key = _get_response_key(method, url, body)
+            if responses.record:
+                kwargs.pop('params', None)
+                resp = orig_request(session, method, url, *args, **kwargs)
+                # The content is stored decoded, so it must not be decoded
+                # again when replayed.
+                headers = {k: v for k, v in resp.headers.items()
+                           if k.lower() not in ('content-encoding',
+                                                'content-length',
+                                                'transfer-encoding')}
+                responses.records[key] = {
+                    'key': key, 'method': method.upper(), 'url': url,
+                    'status': resp.status_code, 'headers': headers,
+                    'content': resp.content.decode('utf-8', 'replace')}
+                return resp
+            return responses._make_response(key, method, url)
+
+        requests.sessions.Session.request = request
+        try:
+            yield self
+        finally:
+            requests.sessions.Session.request = orig_request
+
+    def _make_response(self, key, method, url):
+        rec = self.records.get(key)
+        if rec is None:
+            self.num_missing += 1
+            raise requests.ConnectionError('No recorded response for %s %s'
+                                           % (method.upper(), url))
+        self.num_replayed += 1
+        resp = requests.models.Response()
+        resp.status_code = rec['status']
+        resp.headers.update(rec.get('headers', {}))
+        resp._content = rec['content'].encode('utf-8')
+        resp.encoding = 'utf-8'
+        resp.url = rec['url']
+        return resp
+
+
+def get_agent_class(path):
+    """Import an agent class given as module.path.ClassName."""
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process in MB."""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # This is in bytes on macOS, but in kilobytes on Linux.
+    if sys.platform == 'darwin':
+        return peak / 1024.0 ** 2
+    return peak / 1024.0
+
+
+def _get_quantile(durations, q):
+    return durations[min(int(q * len(durations)), len(durations) - 1)]
+
+
+def replay(agent_class, transcript, repeat=1, agent_kwargs=None):
+    """Replay the requests of a transcript, returning a report of timings.
+
+    Parameters
+    ----------
+    agent_class : type
+        The Bioagent subclass to benchmark.
+    transcript : dict
+        The transcript, with the KQML content of the requests under
+        'requests', and the recorded responses under 'http'.
+    repeat : int
+        The number of times the requests are sent.
+    agent_kwargs : dict or None
+        Keyword arguments used to create the agent, in addition to testing.
+
+    Returns
+    -------
+    report : dict
+        The latency, throughput, failures and peak RSS of the run.
+    """
+    responses = RecordedResponses(transcript.get('http'))
+    contents = [KQMLList.from_string(req) for req in transcript['requests']]
+    replies = []
+
+    with responses.patch():
+        start = time.time()
+        agent = agent_class(testing=True, **(agent_kwargs or {}))
+        startup_time = time.time() - start
+
+        def reply_with_content(msg, reply_content):
+            replies.append(reply_content)
+        agent.reply_with_content = reply_with_content
+
+        timings = {}
+        failures = {}
+        start = time.time()
+        for _ in range(repeat):
+            for content in contents:
+                msg = KQMLPerformative('REQUEST')
+                msg.set('content', content)
+                msg.set('reply-with', 'IO-1')
+                task = content.head().upper()
+                num_replies = len(replies)
+                req_start = time.time()
+                agent.receive_request(msg, content)
+                timings.setdefault(task, []).append(time.time() - req_start)
+                reply = replies[-1] if len(replies) > num_replies else None
+                if reply is None or reply.head().upper() == 'FAILURE':
+                    reason = reply.gets('reason') if reply is not None \
+                        else 'NO_REPLY'
+                    failures.setdefault(task, {})
+                    failures[task][reason] = \
+                        failures[task].get(reason, 0) + 1
+        total_time = time.time() - start
+
+    num_requests = sum(len(durs) for durs in timings.values())
+    report = {'agent': '%s.%s' % (agent_class.__module__,
+                                  agent_class.__name__),
+              'num_requests': num_requests,
+              'total_time': total_time,
+              'throughput': num_requests / total_time if total_time else None,
+              'startup_time': startup_time,
+              'peak_rss_mb': get_peak_rss(),
+              'http_replayed': responses.num_replayed,
+              'http_missing': responses.num_missing,
+              'tasks': {}}
+    for task, durations in sorted(timings.items()):
+        durations = sorted(durations)
+        report['tasks'][task] = {
+            'count': len(durations),
+            'mean': sum(durations) / len(durations),
+            'min': durations[0],
+            'p50': _get_quantile(durations, 0.5),
+            'p95': _get_quantile(durations, 0.95),
+            'p99': _get_quantile(durations, 0.99),
+            'max': durations[-1],
+            'failures': failures.get(task, {})}
+    return report
+
+
+def record(agent_class, transcript, agent_kwargs=None):
+    """Send the requests of a transcript live, recording the HTTP responses.
+
+    The transcript is updated in place with the recorded responses.
+    """
+    responses = RecordedResponses(transcript.get('http'), record=True)
+    with responses.patch():
+        agent = agent_class(testing=True, **(agent_kwargs or {}))
+        for req in transcript['requests']:
+            content = KQMLList.from_string(req)
+            msg = KQMLPerformative('REQUEST')
+            msg.set('content', content)
+            msg.set('reply-with', 'IO-1')
+            agent.receive_request(msg, content)
+    transcript['http'] = responses.to_json()
+    return transcript
+
+
+def compare(report, baseline, tolerance=0.2):
+    """Compare a report with a baseline, returning a list of regressions.
+
+    A task regresses if its median or 95th percentile latency is more than
+    `tolerance` (as a fraction) above that of the baseline. The throughput
+    and peak RSS are compared likewise.
+    """
+    regressions = []
+
+    def check(name, new, old, higher_is_worse=True):
+        if new is None or not old:
+            return
+        change = (new - old) / old
+        if not higher_is_worse:
+            change = -change
+        if change > tolerance:
+            regressions.append('%s: %.4g vs %.4g in the baseline (%+.0f%%)'
+                               % (name, new, old, 100 * (new - old) / old))
+
+    for task, stats in sorted(report['tasks'].items()):
+        base_stats = baseline['tasks'].get(task)
+        if base_stats is None:
+            continue
+        for stat in ('p50', 'p95'):
+            check('%s %s' % (task, stat), stats[stat], base_stats[stat])
+    check('throughput', report['throughput'], baseline.get('throughput'),
+          higher_is_worse=False)
+    check('peak RSS (MB)', report['peak_rss_mb'], baseline.get('peak_rss_mb'))
+    return regressions
+
+
+def format_report(report):
+    lines = ['Benchmark of %s' % report['agent'],
+             '%d requests in %.3f s (%.2f requests/s), startup %.3f s, '
+             'peak RSS %.1f MB' % (report['num_requests'],
+                                   report['total_time'],
+                                   report['throughput'] or 0,
+                                   report['startup_time'],
+                                   report['peak_rss_mb']),
+             'HTTP responses replayed: %d, missing: %d'
+             % (report['http_replayed'], report['http_missing']),
+             '',
+             '%-35s %6s %9s %9s %9s %9s  %s'
+             % ('task', 'count', 'mean', 'p50', 'p95', 'max', 'failures')]
+    for task, stats in sorted(report['tasks'].items()):
+        failures = ', '.join('%s=%d' % fail
+                             for fail in sorted(stats['failures'].items()))
+        lines.append('%-35s %6d %9.4f %9.4f %9.4f %9.4f  %s'
+                     % (task, stats['count'], stats['mean'], stats['p50'],
+                        stats['p95'], stats['max'], failures))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('transcript', help='The transcript JSON file.')
+    parser.add_argument('--agent', help='The agent class, as '
+                        'module.ClassName, if not given in the transcript.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='The number of times the requests are sent.')
+    parser.add_argument('--record', action='store_true',
+                        help='Send the requests live, and record the HTTP '
+                        'responses in the transcript.')
+    parser.add_argument('--baseline', help='A report to compare with.')
+    parser.add_argument('--save-baseline', help='Where to save the report '
+                        'as a baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='The fraction by which a measure may be worse '
+                        'than in the baseline.')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.transcript):
+        args.transcript = os.path.join(transcript_dir, args.transcript)
+    with open(args.transcript, 'r') as fh:
+        transcript = json.load(fh)
+    agent_class = get_agent_class(args.agent or transcript['agent'])
+
+    if args.record:
+        record(agent_class, transcript)
+        with open(args.transcript, 'w') as fh:
+            json.dump(transcript, fh, indent=1)
+        print('Recorded %d HTTP responses in %s.'
+              % (len(transcript['http']), args.transcript))
+        return 0
+
+    report = replay(agent_class, transcript, repeat=args.repeat)
+    print(format_report(report))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fh:
+            json.dump(report, fh, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)
+        regressions = compare(report, baseline, args.tolerance)
+        print()
+        if regressions:
+            print('Regressions compared with %s:' % args.baseline)
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('No regressions compared with %s.' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
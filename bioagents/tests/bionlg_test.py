@@ -64,3 +64,19 @@ class TestTwoSimpleStatements(_NlgTestBase):
 class TestSimpleStatement(_NlgTestBase):
     statements = [Activation(kras, braf)]
     sentences = ["KRAS activates BRAF"]
+
+
+def test_request_in_worker():
+    agent = BioNLG_Module(testing=True, default_workers=1)
+    replies = []
+    agent.reply_with_content = lambda msg, content: replies.append(content)
+    content = KQMLList('INDRA-TO-NL')
+    content.set('statements', agent.make_cljson([Activation(kras, braf)]))
+    agent.receive_request(get_request(content), content)
+    content = KQMLList('INDRA-TO-NL')
+    content.set('statements', 'none')
+    agent.receive_request(get_request(content), content)
+    # Wait for the worker to reply.
+    agent.shutdown_workers()
+    assert replies[0].get('nl')[0].string_value() == 'KRAS activates BRAF'
+    assert replies[1].gets('reason') == 'NL_GENERATION_ERROR', replies[1]
@@ -1,3 +1,4 @@
+from time import sleep
 from indra.statements import Agent, Phosphorylation, ModCondition, BoundCondition
 from bioagents.tests.integration import _IntegrationTest
 from bioagents import Bioagent, BioagentException
@@ -64,3 +65,708 @@ def test_cljson_stmt():
     cj = Bioagent.make_cljson(stmt)
     stmt2 = Bioagent.get_statement(cj)
     assert stmt.equals(stmt2)
+
+
+def test_concurrent_dispatch():
+    from threading import Event
+    release = Event()
+
+    class PoolAgent(Bioagent):
+        name = 'pool-test'
+        tasks = ['SLOW', 'FAST']
+        task_workers = {'SLOW': 1, 'FAST': 1}
+
+        def respond_slow(self, content):
+            assert release.wait(10)
+            return KQMLList('SLOW-DONE')
+
+        def respond_fast(self, content):
+            return KQMLList('FAST-DONE')
+
+    agent = PoolAgent(testing=True)
+    for task, reply_with in [('SLOW', 'IO-1'), ('FAST', 'IO-2')]:
+        msg = KQMLPerformative('REQUEST')
+        msg.set('content', KQMLList(task))
+        msg.set('reply-with', reply_with)
+        agent.receive_request(msg, msg.get('content'))
+
+    # The fast task must not be held up by the slow one.
+    for _ in range(100):
+        if b'FAST-DONE' in agent.out.getvalue():
+            break
+        sleep(0.05)
+    assert b'SLOW-DONE' not in agent.out.getvalue()
+    release.set()
+    agent.shutdown_workers(wait=True)
+
+    replies = [KQMLPerformative.from_string(line)
+               for line in agent.out.getvalue().decode().splitlines()
+               if line.startswith('(reply')]
+    in_reply_to = {r.get('content').head(): r.get('in-reply-to').to_string()
+                   for r in replies}
+    assert in_reply_to == {'FAST-DONE': 'IO-2', 'SLOW-DONE': 'IO-1'}, \
+        in_reply_to
+
+
+def test_task_metrics():
+    class MetricsAgent(Bioagent):
+        name = 'metrics-test'
+        tasks = ['GOOD', 'BAD']
+
+        def respond_good(self, content):
+            return KQMLList('SUCCESS')
+
+        def respond_bad(self, content):
+            return self.make_failure('MISSING_TARGET')
+
+    agent = MetricsAgent(testing=True)
+    for task in ['GOOD', 'GOOD', 'BAD', 'UGLY']:
+        msg = KQMLPerformative('REQUEST')
+        msg.set('content', KQMLList(task))
+        agent.receive_request(msg, msg.get('content'))
+
+    good = agent.metrics.get('metrics-test', 'GOOD').to_json()
+    assert good['count'] == 2, good
+    assert good['in_flight'] == 0, good
+    assert not good['failures'], good
+    bad = agent.metrics.get('metrics-test', 'BAD').to_json()
+    assert bad['failures'] == {'MISSING_TARGET': 1}, bad
+    assert bad['error_rate'] == 1.0, bad
+
+    prom = agent.metrics.to_prometheus()
+    assert ('bioagent_request_failures_total{agent="metrics-test",'
+            'task="UGLY",reason="UNKNOWN_TASK"} 1') in prom, prom
+    assert ('bioagent_request_duration_seconds_count{agent="metrics-test",'
+            'task="GOOD"} 2') in prom, prom
+
+
+def test_cljson_decode_cache():
+    ag = Agent('BRAF', db_refs={'HGNC': '1097'})
+    cj = Bioagent.make_cljson(ag)
+    hits = Bioagent.decode_cache.hits
+    ag1 = Bioagent.get_agent(cj)
+    ag2 = Bioagent.get_agent(cj)
+    assert Bioagent.decode_cache.hits == hits + 1
+    assert ag1.equals(ag2)
+    # We get back defensive copies that can be changed independently.
+    assert ag1 is not ag2
+    ag1.db_refs['HGNC'] = '0'
+    assert Bioagent.get_agent(cj).db_refs['HGNC'] == '1097'
+
+
+def test_lazy_component():
+    from bioagents.startup import LazyMapping
+    calls = []
+
+    def make_map():
+        calls.append(1)
+        return {'a': 1, 'b': 2}
+
+    lazy_map = LazyMapping('test.lazy_map', make_map)
+    assert not calls and not lazy_map.loaded
+    assert 'a' in lazy_map
+    assert lazy_map.get('c', 3) == 3
+    assert sorted(lazy_map.keys()) == ['a', 'b']
+    assert len(calls) == 1 and lazy_map.loaded
+    assert lazy_map.init_time is not None
+
+
+def test_import_times():
+    import sys
+    from unittest import mock
+    from bioagents import startup
+    # The imports are also timed on versions of Python without
+    # -X importtime.
+    for version in [sys.version_info, (3, 5, 0)]:
+        with mock.patch.object(startup.sys, 'version_info', version):
+            times = startup._get_import_times('json')
+        names = [name for name, _, _ in times]
+        assert 'json' in names and 'json.decoder' in names, times
+        assert all(cumul >= self_time for _, self_time, cumul in times)
+
+
+def test_stash_evidence_html():
+    import os
+    import tempfile
+    prov_dir = tempfile.mkdtemp()
+    os.environ['PROVENANCE_LOCATION'] = 'file:' + prov_dir
+    try:
+        agent = Bioagent(testing=True)
+        link1 = agent._stash_evidence_html('<html>BRAF</html>')
+        link2 = agent._stash_evidence_html('<html>BRAF</html>')
+        link3 = agent._stash_evidence_html('<html>KRAS</html>')
+    finally:
+        del os.environ['PROVENANCE_LOCATION']
+    # Identical pages are only stored once, under the same name.
+    assert link1 == link2
+    assert link1 != link3
+    from bioagents.artifacts import get_artifact_store
+    get_artifact_store('file:' + prov_dir).flush()
+    assert sorted(os.listdir(prov_dir)) == \
+        sorted([os.path.basename(link1), os.path.basename(link3)])
+    with open(link1, 'r') as fh:
+        assert fh.read() == '<html>BRAF</html>'
+
+
+def test_s3_artifact_store_exists():
+    from botocore.exceptions import ClientError
+    from bioagents.artifacts import S3ArtifactStore
+
+    class FakeClient(object):
+        def __init__(self):
+            self.objects = {}
+            self.num_puts = 0
+
+        def head_object(self, Bucket, Key):
+            if (Bucket, Key) not in self.objects:
+                raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            return {}
+
+        def put_object(self, Bucket, Key, Body, ContentType):
+            self.objects[(Bucket, Key)] = Body
+            self.num_puts += 1
+
+    # Only the last name stored is remembered.
+    store = S3ArtifactStore('bucket', 'prefix/', max_known=1)
+    store._client = FakeClient()
+    link = store.put('<html>BRAF</html>')
+    store.put('<html>KRAS</html>')
+    store.flush()
+    assert store._client.num_puts == 2
+    assert len(store._stored) == 1
+    # The forgotten page is found on S3, so it isn't written again.
+    assert store.put('<html>BRAF</html>') == link
+    store.flush()
+    assert store._client.num_puts == 2
+    assert store.exists(link.split('/prefix/')[1])
+    assert not store.exists('missing.html')
+
+
+def test_provenance_report_cache():
+    import os
+    import tempfile
+    from bioagents.artifacts import get_artifact_store
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    stmts = [Phosphorylation(braf, map2k1),
+             Phosphorylation(braf, map2k1, 'S', '218')]
+    prov_dir = tempfile.mkdtemp()
+    os.environ['PROVENANCE_LOCATION'] = 'file:' + prov_dir
+    try:
+        agent = Bioagent(testing=True)
+        groups = agent.provenance_builder.groups
+        misses = groups.misses
+        html1 = agent._make_report_cols_html(stmts, limit=1)
+        html2 = agent._make_report_cols_html(stmts, limit=1)
+    finally:
+        del os.environ['PROVENANCE_LOCATION']
+    assert html1 == html2
+    assert html1.count('<li>') == 1, html1
+    assert groups.misses == misses + 1
+    get_artifact_store('file:' + prov_dir).flush()
+    assert len(os.listdir(prov_dir)) == 1
+
+
+def test_response_cache():
+    class CacheAgent(Bioagent):
+        name = 'cache-test'
+        tasks = ['LOOKUP', 'OTHER']
+        cacheable_tasks = {'LOOKUP': None}
+        calls = []
+
+        def respond_lookup(self, content):
+            self.calls.append(content.to_string())
+            if content.gets('x') == 'bad':
+                return self.make_failure('BAD_INPUT')
+            reply = KQMLList('SUCCESS')
+            reply.sets('x', content.gets('x'))
+            return reply
+
+        def respond_other(self, content):
+            self.calls.append(content.to_string())
+            return KQMLList('SUCCESS')
+
+    agent = CacheAgent(testing=True)
+    for content in ['(LOOKUP :x "a" :y "b")', '(lookup :Y "b" :x "a")',
+                    '(LOOKUP :x "c" :y "b")', '(LOOKUP :x "bad")',
+                    '(LOOKUP :x "bad")', '(OTHER :x "a")', '(OTHER :x "a")']:
+        msg = KQMLPerformative('REQUEST')
+        msg.set('content', KQMLList.from_string(content))
+        agent.receive_request(msg, msg.get('content'))
+    # The second lookup has the same arguments in a different order, and
+    # failures and tasks that are not cacheable are not cached.
+    assert len(agent.calls) == 6, agent.calls
+    lookup = agent.metrics.get('cache-test', 'LOOKUP').to_json()
+    assert lookup['count'] == 5, lookup
+    assert lookup['cache_hits'] == 1, lookup
+    # Changing a reply doesn't change the cached one.
+    content = KQMLList.from_string('(LOOKUP :x "a" :y "b")')
+    reply = agent._get_reply('LOOKUP', content, agent.respond_lookup)
+    assert reply.gets('x') == 'a'
+    reply.sets('x', 'changed')
+    reply = agent._get_reply('LOOKUP', content, agent.respond_lookup)
+    assert reply.gets('x') == 'a', reply
+    assert len(agent.calls) == 6, agent.calls
+
+
+def test_lru_cache_ttl():
+    from bioagents.cache import LRUCache
+    cache = LRUCache(maxsize=2, ttl=0.05)
+    cache.put('a', 1)
+    cache.put('b', 2, ttl=10)
+    assert cache.get('a') == 1
+    sleep(0.1)
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    cache.put('c', 3)
+    cache.put('d', 4)
+    assert 'b' not in cache and len(cache) == 2
+
+
+def test_request_deadline():
+    from bioagents import get_request_context
+
+    class SlowAgent(Bioagent):
+        name = 'deadline-test'
+        tasks = ['SLOW', 'PARTIAL']
+        task_timeouts = {'SLOW': 0.05, 'PARTIAL': 0.05}
+        replies = []
+
+        def respond_slow(self, content):
+            while True:
+                sleep(0.01)
+                get_request_context().check()
+
+        def respond_partial(self, content):
+            context = get_request_context()
+            done = 0
+            while not context.expired():
+                sleep(0.01)
+                done += 1
+            reply = KQMLList('SUCCESS')
+            reply.set('done', str(done))
+            return reply
+
+        def reply_with_content(self, msg, reply_content):
+            self.replies.append(reply_content)
+
+    agent = SlowAgent(testing=True)
+    for task in ['SLOW', 'PARTIAL']:
+        msg = KQMLPerformative('REQUEST')
+        msg.set('content', KQMLList(task))
+        agent.receive_request(msg, msg.get('content'))
+    assert agent.replies[0].gets('reason') == 'TIMEOUT', agent.replies[0]
+    assert agent.replies[1].head() == 'SUCCESS', agent.replies[1]
+    slow = agent.metrics.get('deadline-test', 'SLOW').to_json()
+    assert slow['failures'] == {'TIMEOUT': 1}, slow
+    # Outside of a request there is no deadline.
+    assert get_request_context().remaining() is None
+
+
+def test_log_file_handlers():
+    import logging
+    from bioagents.logs import RateLimitedLogger
+
+    class LogAgent(Bioagent):
+        name = 'log-test'
+        tasks = []
+
+    bioagents_logger = logging.getLogger('Bioagents')
+    LogAgent(testing=True)
+    num_handlers = len(bioagents_logger.handlers)
+    LogAgent(testing=True)
+    # A second agent in the same process doesn't add another handler.
+    assert len(bioagents_logger.handlers) == num_handlers
+
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    test_logger = logging.getLogger('rate-limit-test')
+    test_logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    test_logger.addHandler(handler)
+    rl_logger = RateLimitedLogger(test_logger, interval=0.05)
+    for i in range(5):
+        rl_logger.info('Step %d', i)
+    sleep(0.1)
+    rl_logger.info('Step %d', 5)
+    assert handler.messages == \
+        ['Step 0', 'Step 5 (4 similar messages suppressed)'], handler.messages
+
+
+def test_benchmark_replay():
+    import requests
+    from bioagents.tests.benchmark import replay, compare
+
+    class WebAgent(Bioagent):
+        name = 'benchmark-test'
+        tasks = ['FETCH']
+
+        def respond_fetch(self, content):
+            res = requests.get('http://example.org/genes',
+                               params={'name': content.gets('name')})
+            reply = KQMLList('SUCCESS')
+            reply.sets('text', res.text)
+            return reply
+
+    url = 'http://example.org/genes?name=BRAF'
+    transcript = {
+        'requests': ['(FETCH :name "BRAF")', '(FETCH :name "KRAS")'],
+        'http': [{'key': 'GET %s None' % url, 'method': 'GET', 'url': url,
+                  'status': 200, 'headers': {}, 'content': 'B-Raf'}]}
+    report = replay(WebAgent, transcript, repeat=2)
+    assert report['num_requests'] == 4, report
+    assert report['http_replayed'] == 2, report
+    # The request without a recorded response fails rather than going out.
+    assert report['http_missing'] == 2, report
+    fetch = report['tasks']['FETCH']
+    assert fetch['failures'] == {'INTERNAL_FAILURE': 2}, fetch
+    assert report['peak_rss_mb'] > 0
+    assert not compare(report, report)
+
+
+def test_local_statement_index():
+    import os
+    import tempfile
+    from indra.statements import Evidence, Complex, Activation
+    from bioagents.msa.local_index import LocalStatementIndex
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    stmts = [Phosphorylation(braf, map2k1, evidence=[
+                 Evidence(source_api='reach'), Evidence(source_api='sparser'),
+                 Evidence(source_api='reach')]),
+             Activation(braf, mapk1, evidence=[Evidence(source_api='signor')]),
+             Complex([braf, map2k1], evidence=[Evidence(source_api='bel')]),
+             Phosphorylation(braf, map2k1,
+                             evidence=[Evidence(source_api='reach')])]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index = LocalStatementIndex(os.path.join(tmpdir, 'index.db'),
+                                    ev_limit=2)
+        index.add_statements(stmts)
+        assert index.count() == 3
+
+        proc = index.get_statements(subject='1097@HGNC')
+        assert not proc.is_working() and proc.wait_until_done()
+        # The statements are sorted by evidence count.
+        assert [type(s).__name__ for s in proc.statements] == \
+            ['Phosphorylation', 'Activation'], proc.statements
+        phos = proc.statements[0]
+        assert len(phos.evidence) == 2
+        assert proc.get_ev_count(phos) == 4
+        assert proc.get_source_count(phos) == {'reach': 3, 'sparser': 1}
+
+        proc = index.get_statements(agents=['6840@HGNC', 'BRAF@TEXT'])
+        assert len(proc.statements) == 2, proc.statements
+        proc = index.get_statements(object='6840@HGNC',
+                                    stmt_type='Modification')
+        assert len(proc.statements) == 1, proc.statements
+        assert not index.get_statements(object='1097@HGNC').statements
+
+        other = index.get_statements(agents=['6871@HGNC'], ev_limit=0)
+        assert not other.statements[0].evidence
+        proc.merge_results(other)
+        assert len(proc.statements) == 2
+        assert proc.get_ev_count(other.statements[0]) == 1
+
+
+def test_statement_query_cache():
+    import threading
+    from bioagents.msa.query_cache import QueryCache, StatementResult
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    stmt = Phosphorylation(braf, map2k1)
+    queries = []
+    release = threading.Event()
+
+    class SlowProcessor(object):
+        statements = [stmt]
+        statements_sample = [stmt]
+
+        def is_working(self):
+            return not release.is_set()
+
+        def wait_until_done(self, timeout=None):
+            return release.wait(timeout)
+
+        def get_ev_count(self, stmt):
+            return 3
+
+        def get_source_count(self, stmt):
+            return {'reach': 3}
+
+    def get_statements(**params):
+        queries.append(params)
+        return SlowProcessor()
+
+    cache = QueryCache(ttl=60)
+    params = {'agents': ['6840@HGNC', '1097@HGNC'], 'timeout': 1}
+    proc1 = cache.get_processor(params, get_statements)
+    # An identical running query is shared, whatever its timeout.
+    proc2 = cache.get_processor({'agents': ['1097@HGNC', '6840@HGNC'],
+                                 'timeout': 5}, get_statements)
+    assert proc1 is proc2
+    assert len(queries) == 1
+    release.set()
+    assert proc1.wait_until_done()
+    result = cache.get_processor(params, get_statements)
+    assert isinstance(result, StatementResult)
+    assert len(queries) == 1
+    assert result.statements == [stmt]
+    assert result.get_ev_count(stmt) == 3
+    assert result.get_source_count(stmt) == {'reach': 3}
+    # Once no one uses the statements, the cached result only keeps their
+    # JSON, and makes them again when needed. It can't be changed.
+    del proc1, proc2
+    stmts = result.statements
+    assert stmts[0] is not stmt
+    assert stmts[0].get_hash() == stmt.get_hash()
+    assert result.get_ev_count(stmts[0]) == 3
+    assert result.statements is stmts
+    try:
+        result.merge_results(SlowProcessor())
+        assert False, 'A cached result must not be changed.'
+    except TypeError:
+        pass
+    # The result for a type of statement is made from that for all types.
+    result = cache.get_processor(dict(params, stmt_type='Modification'),
+                                 get_statements)
+    assert [s.get_hash() for s in result.statements] == [stmt.get_hash()]
+    assert not cache.get_processor(dict(params, stmt_type='Activation'),
+                                   get_statements).statements
+    assert len(queries) == 1
+    # Other queries are made, and results too big are not cached.
+    cache.get_processor({'subject': '1097@HGNC'}, get_statements)
+    assert len(queries) == 2
+    small_cache = QueryCache(max_statements=1)
+    small_cache.get_processor(params, get_statements)
+    assert len(small_cache.results) == 0
+
+
+def test_statement_exporters():
+    import io
+    import os
+    import gzip
+    import json
+    import pickle
+    import tempfile
+    from indra.statements import Evidence, Activation
+    from bioagents.msa.exporters import export_statements, get_export_fname, \
+        load_pickled_statements
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    stmts = [Phosphorylation(braf, map2k1, evidence=[
+                 Evidence(source_api='reach', text='BRAF phosphorylates '
+                          'MAP2K1.', pmid='1234')]),
+             Activation(braf, map2k1)]
+
+    out = io.StringIO()
+    export_statements(stmts, out, 'tsv', chunk_size=1)
+    assert out.getvalue() == \
+        '%s\tBRAF phosphorylates MAP2K1.\t1234\n%s\t\t\n' % tuple(stmts)
+    out = io.BytesIO()
+    export_statements(stmts, out, 'jsonl')
+    lines = out.getvalue().decode('utf-8').splitlines()
+    assert [json.loads(line)['type'] for line in lines] == \
+        ['Phosphorylation', 'Activation']
+    out = io.StringIO()
+    export_statements(iter(stmts), out, 'json')
+    assert [js['type'] for js in json.loads(out.getvalue())] == \
+        ['Phosphorylation', 'Activation']
+    for indent_stmts in (stmts, []):
+        out = io.StringIO()
+        export_statements(indent_stmts, out, 'json', indent=1)
+        assert out.getvalue() == json.dumps(
+            [stmt.to_json() for stmt in indent_stmts], indent=1)
+    out = io.BytesIO()
+    export_statements(stmts, out, 'json', compress=True)
+    assert len(json.loads(gzip.decompress(out.getvalue()).decode())) == 2
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = get_export_fname('pickle', directory=tmpdir)
+        assert fname != get_export_fname('pickle', directory=tmpdir)
+        assert export_statements(stmts, fname, 'pickle', chunk_size=1) == \
+            fname
+        # Each chunk is pickled on its own.
+        with open(fname, 'rb') as fh:
+            assert len(pickle.load(fh)) == 1
+        assert [s.get_hash() for s in load_pickled_statements(fname)] == \
+            [s.get_hash() for s in stmts]
+        fname = os.path.join(tmpdir, 'stmts.pkl.gz')
+        export_statements(stmts, fname, 'pickle')
+        assert len(load_pickled_statements(fname)) == 2
+        fname = os.path.join(tmpdir, 'stmts.jsonl.gz')
+        export_statements(stmts, fname)
+        with gzip.open(fname, 'rt') as fh:
+            assert len(fh.readlines()) == 2
+        assert not [f for f in os.listdir(tmpdir) if f.endswith('.tmp')]
+
+
+def test_stored_verb_map():
+    import os
+    import json
+    import tempfile
+    from unittest import mock
+    import indra
+    from bioagents.msa import verbs
+    verb_map = verbs.load_verb_map()
+    # The stored map is that built from the current statement types.
+    assert dict((v, dict(e)) for v, e in verb_map.items()) == \
+        verbs.build_verb_map()
+    assert verb_map['phosphorylates']['stmt'] == 'Phosphorylation'
+    try:
+        verb_map['phosphorylates'] = {}
+        assert False, 'The verb map must be read only.'
+    except TypeError:
+        pass
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'verb_map.json')
+        assert 'inhibits' in verbs.load_verb_map(fname)
+        verbs.write_verb_map(fname)
+        with open(fname, 'r') as fh:
+            stored = json.load(fh)
+        # The stored map is used with any version of INDRA with the same
+        # sources.
+        stored['verb_map'] = {'foos': {'stmt': 'Foo', 'type': 'present'}}
+        with open(fname, 'w') as fh:
+            json.dump(stored, fh)
+        with mock.patch.object(indra, '__version__', 'other'):
+            assert list(verbs.load_verb_map(fname)) == ['foos']
+        stored['source_digest'] = 'other'
+        with open(fname, 'w') as fh:
+            json.dump(stored, fh)
+        assert 'inhibits' in verbs.load_verb_map(fname)
+
+
+def _get_stmt_names(stmts):
+    return [ag.name for stmt in stmts for ag in stmt.agent_list()]
+
+
+def test_paper_model_service():
+    import os
+    import time
+    import tempfile
+    from bioagents.msa.paper_models import PaperModelService, PaperModelCache
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    stmts = [Phosphorylation(braf, Agent('MAP2K%d' % idx))
+             for idx in range(1, 6)]
+    pmids = []
+
+    def get_statements(pmid):
+        pmids.append(pmid)
+        return []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        service = PaperModelService(get_statements, cache_dir=tmpdir,
+                                    num_procs=2, chunk_size=2,
+                                    map_function=_get_stmt_names)
+        try:
+            # The statements are mapped in chunks by the processes.
+            assert service.map_stmts(stmts) == \
+                _get_stmt_names(stmts), service.map_stmts(stmts)
+        finally:
+            service.shutdown()
+        assert service.get_model('123') == \
+            {'pmid': '123', 'stmts': [], 'diagrams': {}}
+        assert service.get_model('123')['pmid'] == '123'
+        assert pmids == ['123']
+        assert service.precompute(['456', '123']) == {'456': 0, '123': 0}
+        assert pmids == ['123', '456']
+
+        cache = PaperModelCache(os.path.join(tmpdir, 'small'),
+                                max_entries=2)
+        for pmid in ['1', '2', '3']:
+            cache.put(pmid, {'pmid': pmid})
+            time.sleep(0.01)
+        # The least recently used model is removed.
+        assert len(cache) == 2
+        assert cache.get('1') is None and cache.get('3')['pmid'] == '3'
+        assert cache.stats()['hits'] == 1
+
+
+def test_entity_type_index():
+    import os
+    import tempfile
+    from unittest import mock
+    import indra
+    from bioagents.biosense.entity_types import EntityTypeIndex, KINASE, \
+        PHOSPHATASE, TF, get_category_mask
+    index = EntityTypeIndex.load()
+    built = EntityTypeIndex.from_tables()
+    # The stored index is that built from the current tables.
+    assert index.by_name == built.by_name
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    dusp6 = Agent('DUSP6', db_refs={'HGNC': '3072'})
+    esr1 = Agent('ESR1', db_refs={'HGNC': '3467'})
+    # Agents are found by name, whatever their grounding.
+    raf_b = Agent('RAF-B', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1')
+    assert index.get_categories(braf) == KINASE
+    assert index.is_category(dusp6, get_category_mask('enzyme'))
+    assert index.classify([braf, dusp6, esr1, raf_b, map2k1, braf],
+                          KINASE) == [True, False, False, False, True, True]
+    assert index.classify([esr1, dusp6], TF | PHOSPHATASE) == [True, True]
+    assert 'BRAF' in index.get_names(KINASE)
+    assert get_category_mask('foo') is None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = index.save(os.path.join(tmpdir, 'entity_types.tsv'))
+        assert EntityTypeIndex.load(fname).by_name == index.by_name
+        with open(fname, 'w') as fh:
+            fh.write('# version=0\n')
+        assert EntityTypeIndex.load(fname).by_name == index.by_name
+        # The stored index is used with any version of INDRA with the same
+        # tables.
+        fname = EntityTypeIndex({'FOO': KINASE}).save(fname)
+        with mock.patch.object(indra, '__version__', 'other'):
+            assert EntityTypeIndex.load(fname).by_name == {'FOO': KINASE}
+        with open(fname, 'r') as fh:
+            lines = fh.readlines()
+        lines[0] = lines[0].split('tables=')[0] + 'tables=other\n'
+        with open(fname, 'w') as fh:
+            fh.writelines(lines)
+        assert EntityTypeIndex.load(fname).by_name == index.by_name
+
+
+def test_statement_set():
+    from indra.statements import Activation
+    from bioagents.msa.query_cache import StatementResult
+    from bioagents.msa.result_set import StatementSet
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    stmts = [Phosphorylation(braf, map2k1), Activation(braf, map2k1),
+             Phosphorylation(map2k1, mapk1)]
+    hashes = [stmt.get_hash() for stmt in stmts]
+    processor = StatementResult(stmts, dict(zip(hashes, [3, 2, None])),
+                                {hashes[0]: {'reach': 3}})
+
+    # The statements of the processor are referred to, not copied.
+    stmt_set = StatementSet.from_statements(stmts[1:], processor)
+    assert stmt_set.source is processor.statements
+    assert stmt_set.rows.tolist() == [1, 2]
+    assert list(stmt_set) == stmts[1:]
+    assert stmt_set[0] is stmts[1] and stmt_set[-1] is stmts[2]
+    assert stmt_set.to_list() == stmt_set[:] == stmts[1:]
+    assert stmt_set.get_ev_totals() == {hashes[1]: 2, hashes[2]: None}
+
+    stmt_set = StatementSet.from_statements(stmts, processor)
+    assert stmt_set.get_type_totals() == {'phosphorylation': 3,
+                                          'activation': 2}
+    assert stmt_set.get_source_counts()[hashes[0]] == {'reach': 3}
+    assert stmt_set.get_index() == {h: idx for idx, h in enumerate(hashes)}
+    subset = stmt_set.take([2, 0])
+    assert subset.to_list() == [stmts[2], stmts[0]]
+    assert subset.get_ev_totals() == {hashes[2]: None, hashes[0]: 3}
+
+    # Statements not all in the processor are kept in a list of the set's.
+    other = Activation(map2k1, mapk1)
+    stmt_set = StatementSet.from_statements([stmts[0], other], processor)
+    assert stmt_set.source is not processor.statements
+    assert stmt_set.to_list() == [stmts[0], other]
+    assert stmt_set.get_ev_totals() == {hashes[0]: 3, other.get_hash(): None}
@@ -244,6 +244,42 @@ def test_get_matching_statements():
         "Expected > 1 matching, got matching: %s" % matching
 
 
+def test_supporting_statements_without_db():
+    from bioagents.mra import mra_module
+    braf = sts.Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    stmts = [sts.Phosphorylation(braf, map2k1), sts.Complex([braf, map2k1])]
+    orig_can_check = mra_module.CAN_CHECK_STATEMENTS
+    mra_module.CAN_CHECK_STATEMENTS = False
+    try:
+        # Without the INDRA DB, no queries are made, and nothing is found.
+        assert mra_module._get_supporting_stmts(stmts) == [([], {}, {})] * 2
+    finally:
+        mra_module.CAN_CHECK_STATEMENTS = orig_can_check
+
+
+def test_support_queries():
+    from bioagents.mra.mra_module import _get_support_query
+    # The agents are grounded like in the queries of _get_matching_stmts,
+    # by the HGNC ID of their name first.
+    braf = sts.Agent('BRAF', db_refs={'FPLX': 'RAF'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = sts.Agent('MAPK1', db_refs={'HGNC': '6871'})
+    query = _get_support_query(sts.Phosphorylation(braf, map2k1))
+    assert query['verb'] == 'Phosphorylation'
+    assert query['subject'].db_refs == {'HGNC': '1097'}
+    assert query['object'].db_refs == {'HGNC': '6840'}
+    query = _get_support_query(sts.Complex([braf, map2k1]))
+    assert [ag.db_refs for ag in query['agents']] == \
+        [{'HGNC': '1097'}, {'HGNC': '6840'}]
+    # The other statements are looked up with _get_matching_stmts.
+    for stmt in [sts.Phosphorylation(None, map2k1),
+                 sts.Complex([braf, map2k1, mapk1]),
+                 sts.Autophosphorylation(braf),
+                 sts.ActiveForm(braf, 'activity', True)]:
+        assert _get_support_query(stmt) is None, stmt
+
+
 # #####################
 # MRA integration tests
 # #####################
@@ -0,0 +1,510 @@
+"""Tests of the MSA finders which use a stand-in for the INDRA DB, so
+that they run without access to it, unlike those in msa_test.
+"""
+from time import sleep
+from unittest import mock
+from contextlib import contextmanager
+
+from indra.statements import Agent
+from kqml import KQMLList
+
+from bioagents.msa import msa, msa_module
+
+
+# Processors and a backend standing in for the INDRA DB in the tests of the
+# MSA finders.
+class _CountingProcessor(object):
+    def __init__(self, stmts):
+        self.statements = stmts
+        self.statements_sample = stmts
+        self.num_counts = 0
+
+    def is_working(self):
+        return False
+
+    def wait_until_done(self, timeout=None):
+        return True
+
+    def get_ev_count(self, stmt):
+        self.num_counts += 1
+        return 2
+
+    def get_source_count(self, stmt):
+        return {'reach': 2}
+
+
+class _SlowProcessor(_CountingProcessor):
+    def is_working(self):
+        return True
+
+    def wait_until_done(self, timeout=None):
+        sleep(min(timeout, 0.1) if timeout is not None else 0.1)
+        return False
+
+
+class _FakeBackend(object):
+    def __init__(self, processor):
+        self.processor = processor
+
+    def get_statements(self, **params):
+        return self.processor
+
+
+@contextmanager
+def _statement_backend(backend):
+    """Make the MSA query a backend, starting with an empty query cache."""
+    orig_get_backend = msa.get_statement_backend
+    msa.get_statement_backend = lambda: backend
+    msa.query_cache.clear()
+    try:
+        yield backend
+    finally:
+        msa.get_statement_backend = orig_get_backend
+        msa.query_cache.clear()
+
+
+def _get_hashes(stmts):
+    return [stmt.get_hash() for stmt in stmts]
+
+
+def test_finder_stats_computed_once():
+    from indra.statements import Phosphorylation, Activation
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    proc = _CountingProcessor([Phosphorylation(braf, map2k1),
+                               Activation(braf, map2k1)])
+    with _statement_backend(_FakeBackend(proc)):
+        finder = msa.BinaryDirected(braf, map2k1)
+        ev_totals = finder.get_ev_totals()
+        assert set(ev_totals.values()) == {2}, ev_totals
+        num_counts = proc.num_counts
+        assert finder.get_ev_totals() is ev_totals
+        assert set(finder.get_stmt_types()) == {'phosphorylation',
+                                                'activation'}
+        assert len(finder.get_source_counts()) == 2
+        finder.get_other_agents()
+        finder.describe()
+        assert proc.num_counts == num_counts, proc.num_counts
+
+
+def test_finder_keeps_compact_result():
+    from indra.statements import Phosphorylation
+    from bioagents.msa.query_cache import StatementResult
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    stmts = [Phosphorylation(braf, map2k1)]
+    with _statement_backend(_FakeBackend(_CountingProcessor(stmts))):
+        finder = msa.BinaryDirected(braf, map2k1)
+        stmt_set = finder.get_statements()
+        # The set itself is handed out rather than a copy of it, and the
+        # finder keeps the cached result rather than the processor.
+        assert finder.get_statements() is stmt_set
+        assert list(stmt_set) == stmts
+        assert isinstance(finder._processor, StatementResult)
+        assert finder.get_ev_totals() == {stmts[0].get_hash(): 2}
+        # Finders of the same query share the statements.
+        other = msa.BinaryDirected(braf, map2k1)
+        assert other.get_statements()[0] is stmts[0]
+
+
+def test_agent_filter():
+    from indra.statements import Phosphorylation, Activation, Complex
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840', 'UP': 'Q02750'})
+    mapk1 = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    query = msa.StatementQuery(None, None, [braf], None, None,
+                               {'filter_agents': [map2k1]})
+    stmts = [Phosphorylation(braf, map2k1), Activation(braf, mapk1),
+             Complex([braf, map2k1, mapk1]), Activation(map2k1, mapk1)]
+    agent_filter = msa.AgentFilter(query)
+    assert agent_filter.filter(stmts) == [stmts[0], stmts[2], stmts[3]]
+    batches = list(agent_filter.iter_filter([stmts[:2], stmts[2:]]))
+    assert batches == [[stmts[0]], [stmts[2], stmts[3]]], batches
+
+
+def test_get_other_agents_order():
+    import io
+    from indra.statements import Phosphorylation, Activation, Inhibition
+    from bioagents.msa.result_set import StatementSet
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    map2k2 = Agent('MAP2K2', db_refs={'HGNC': '6842'})
+    mapk1 = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    # Each statement has 2 evidences, so MAP2K1 has 4, and the tie between
+    # MAPK1 and MAP2K2 is broken by their HGNC ids.
+    proc = _CountingProcessor([Phosphorylation(braf, map2k1),
+                               Activation(braf, map2k1),
+                               Inhibition(braf, mapk1),
+                               Activation(braf, map2k2)])
+    # The statements are iterated over without making lists of them.
+    no_lists = mock.patch.object(
+        StatementSet, 'to_list',
+        side_effect=AssertionError('A list of the statements was made.'))
+    with _statement_backend(_FakeBackend(proc)), no_lists:
+        finder = msa.FromSource(braf)
+        other_agents = finder.get_other_agents()
+        assert [ag.name for ag in other_agents] == \
+            ['MAP2K1', 'MAP2K2', 'MAPK1'], other_agents
+        assert other_agents[0].db_refs == {'HGNC': '6840'}
+        out = io.StringIO()
+        finder.export(out, 'jsonl')
+        assert len(out.getvalue().splitlines()) == 4
+
+
+def test_commons_parallel_adaptive():
+    from time import time
+    from indra.statements import Activation
+    mapk1 = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    mapk3 = Agent('MAPK3', db_refs={'HGNC': '6877'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    others = [Agent('GENE%d' % i, db_refs={'HGNC': str(100000 + i)})
+              for i in range(150)]
+    # MAP2K1 only shows up for MAPK3 past the first 100 statements.
+    stmts = {'6871@HGNC': [Activation(map2k1, mapk1)],
+             '6877@HGNC': [Activation(ag, mapk3) for ag in others] +
+             [Activation(map2k1, mapk3)]}
+    queries = []
+
+    class SlowBackend(object):
+        def get_statements(self, **params):
+            queries.append(params)
+            sleep(0.2)
+            return _CountingProcessor(
+                stmts[params['object']][:params['max_stmts']])
+
+    with _statement_backend(SlowBackend()):
+        start = time()
+        finder = msa.CommonUpstreams(mapk1, mapk3)
+        # The two first queries were made at the same time, and the
+        # truncated one was made again with a higher max_stmts.
+        assert time() - start < 0.55
+        assert [q['max_stmts'] for q in queries] == [100, 100, 400], queries
+        assert finder.get_common_entities() == ['MAP2K1']
+        assert len(finder.get_statements()) == 2
+
+
+def test_finder_snapshots():
+    import threading
+    from indra.statements import Phosphorylation, Activation
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    first_page = [Phosphorylation(braf, map2k1)]
+    done = threading.Event()
+
+    class PagingProcessor(_CountingProcessor):
+        def is_working(self):
+            return not done.is_set()
+
+        def wait_until_done(self, timeout=None):
+            return done.wait(timeout)
+
+    proc = PagingProcessor([])
+    proc.statements_sample = first_page
+    with _statement_backend(_FakeBackend(proc)):
+        finder = msa.FromSource(braf, max_stmts=4)
+        assert finder.get_statements(block=False) is None
+        snapshots = finder.iter_snapshots(interval=0.01, timeout=1)
+        snapshot = next(snapshots)
+        assert snapshot is not finder
+        assert snapshot.completeness == 0.25, snapshot.completeness
+        assert [ag.name for ag in snapshot.get_other_agents()] == ['MAP2K1']
+        assert 'MAP2K1' in snapshot.describe()
+
+        proc.statements = first_page + [Activation(braf, mapk1)]
+        done.set()
+        snapshot = next(snapshots)
+        assert snapshot is finder and snapshot.completeness == 1.0
+        assert len(snapshot.get_other_agents()) == 2
+        assert not list(snapshots)
+
+
+def test_find_relations_partial_result():
+    import threading
+    from indra.statements import Phosphorylation, Activation
+    from bioagents import RequestContext
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    pages = [Phosphorylation(braf, map2k1), Activation(braf, mapk1)]
+    done = threading.Event()
+
+    # Like the INDRA DB processors, this only has its statements once done,
+    # and its sample is the first page, but it keeps all the pages received.
+    class PagingProcessor(_CountingProcessor):
+        def is_working(self):
+            return not done.is_set()
+
+        def wait_until_done(self, timeout=None):
+            return done.wait(timeout)
+
+        def get_hash_statements_dict(self):
+            self.num_builds += 1
+            return {stmt.get_hash(): stmt for stmt in pages}
+
+    proc = PagingProcessor([])
+    proc.statements_sample = pages[:1]
+    proc.num_builds = 0
+    try:
+        with _statement_backend(_FakeBackend(proc)):
+            module = msa_module.MSA_Module(testing=True)
+            module._send_provenance_async = lambda finder, desc: None
+            content = KQMLList('FIND-RELATIONS-FROM-LITERATURE')
+            content.set('source', module.make_cljson(braf))
+            content.sets('type', 'unknown')
+            with RequestContext('FIND-RELATIONS-FROM-LITERATURE', 0.2):
+                resp = module.respond_find_relations_from_literature(content)
+            assert resp.gets('status') == 'WORKING', resp
+            assert resp.gets('num-relations-found') == '2', resp
+            # Without a maximum number of statements, the fraction
+            # received is not known, and the statements received are only
+            # built once.
+            assert resp.get('completeness') is None, resp
+            assert proc.num_builds == 1, proc.num_builds
+            agents = module.get_agent(resp.get('entities-found'))
+            assert {ag.name for ag in agents} == {'MAP2K1', 'MAPK1'}, agents
+    finally:
+        proc.statements = pages
+        done.set()
+
+
+def test_confirm_relation_deadline():
+    import time
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    queries = []
+
+    class Backend(object):
+        def get_statements(self, **params):
+            queries.append(params)
+            return _SlowProcessor([])
+
+    with _statement_backend(Backend()):
+        module = msa_module.MSA_Module(testing=True)
+        assert module.task_timeouts['CONFIRM-RELATION-FROM-LITERATURE']
+        module.task_timeouts = {'CONFIRM-RELATION-FROM-LITERATURE': 0.2}
+        module._send_provenance_async = lambda finder, desc: None
+        content = KQMLList('CONFIRM-RELATION-FROM-LITERATURE')
+        content.set('source', module.make_cljson(braf))
+        content.set('target', module.make_cljson(map2k1))
+        content.sets('type', 'phosphorylation')
+        start = time.monotonic()
+        resp = module._respond_to('CONFIRM-RELATION-FROM-LITERATURE',
+                                  content)
+        # The statements are only waited for until the deadline.
+        assert time.monotonic() - start < 2
+        assert resp.head() == 'FAILURE', resp
+        assert [q['timeout'] for q in queries] == [0], queries
+
+
+def test_find_mechanisms_batch():
+    from indra.statements import Phosphorylation, Activation, Complex
+    from bioagents import RequestContext, get_request_context
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    stmts = [Phosphorylation(braf, map2k1), Activation(braf, map2k1),
+             Phosphorylation(braf, mapk1), Complex([map2k1, mapk1]),
+             Phosphorylation(map2k1, mapk1)]
+    queries = []
+    contexts = []
+
+    def get_key(agent):
+        return '%s@HGNC' % agent.db_refs['HGNC']
+
+    class Backend(object):
+        def get_statements(self, **params):
+            queries.append(params)
+            contexts.append(get_request_context())
+            if params.get('agents'):
+                matched = [s for s in stmts
+                           if set(params['agents']) <=
+                           {get_key(ag) for ag in s.agent_list()}]
+            else:
+                matched = [s for s in stmts
+                           if [get_key(ag) for ag in s.agent_list()] ==
+                           [params['subject'], params['object']]]
+            return _CountingProcessor(
+                [s for s in matched
+                 if params.get('stmt_type') in (None, type(s).__name__)])
+
+    with _statement_backend(Backend()):
+        finders = msa.MSA().find_mechanisms_batch(
+            [{'subject': braf, 'object': map2k1, 'verb': 'Phosphorylation'},
+             {'subject': braf, 'object': map2k1, 'verb': 'Activation'},
+             {'subject': braf, 'object': map2k1, 'verb': 'Phosphorylation'},
+             {'subject': braf, 'object': mapk1, 'verb': 'Phosphorylation'},
+             {'subject': braf, 'object': map2k1, 'agents': [mapk1]}],
+            ev_limit=2)
+        assert finders[0] is finders[2]
+        # Statements derived from a cached result are made again from its
+        # JSON, so they are compared by hash.
+        assert [_get_hashes(f.get_statements()) for f in finders[:4]] == \
+            [_get_hashes(stmts[:1]), _get_hashes(stmts[1:2]),
+             _get_hashes(stmts[:1]), _get_hashes(stmts[2:3])]
+        assert isinstance(finders[4], ValueError), finders[4]
+        # The statements about BRAF and MAP2K1 were only got once.
+        assert sorted(q.get('stmt_type') or '' for q in queries) == \
+            ['', 'Phosphorylation'], queries
+
+        # Without persisting, the statements of all types may not all be
+        # got, so each verb is queried on its own. Complexes of two agents
+        # are looked for with the agents.
+        del queries[:]
+        del contexts[:]
+        msa.query_cache.clear()
+        with RequestContext('TEST', 10) as context:
+            finders = msa.MSA().find_mechanisms_batch(
+                [{'agents': [map2k1, mapk1], 'verb': 'Complex'},
+                 {'subject': braf, 'object': map2k1,
+                  'verb': 'Phosphorylation'},
+                 {'subject': braf, 'object': map2k1, 'verb': 'Activation'}],
+                ev_limit=2, persist=False)
+        assert [_get_hashes(f.get_statements()) for f in finders] == \
+            [_get_hashes(stmts[3:4]), _get_hashes(stmts[:1]),
+             _get_hashes(stmts[1:2])]
+        assert sorted(q['stmt_type'] for q in queries) == \
+            ['Activation', 'Complex', 'Phosphorylation'], queries
+        # The queries were made within the context of the request.
+        assert all(c is context for c in contexts), contexts
+        assert all(0 < q['timeout'] <= 10 for q in queries), queries
+
+
+def test_prefetch_follow_ups():
+    from indra.statements import Phosphorylation
+    from bioagents.msa.prefetch import Prefetcher
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    queries = []
+
+    class Backend(object):
+        def get_statements(self, **params):
+            queries.append(params)
+            return _CountingProcessor([Phosphorylation(braf, map2k1)])
+
+    with _statement_backend(Backend()):
+        prefetcher = Prefetcher(msa.MSA(), max_concurrent=1)
+        # Nothing is prefetched while a request is handled, and prefetches
+        # scheduled before a request are dropped.
+        prefetcher.begin_request()
+        prefetcher.schedule('to_target', map2k1, None, ev_limit=3)
+        prefetcher.begin_request()
+        prefetcher.schedule('from_source', braf, None, ev_limit=3)
+        assert not prefetcher.schedule('from_source', braf, None, ev_limit=3)
+        prefetcher.end_request()
+        sleep(0.2)
+        assert not queries, queries
+        prefetcher.end_request()
+        for _ in range(50):
+            if prefetcher.stats['done']:
+                break
+            sleep(0.1)
+        assert prefetcher.stats['done'] == 1, prefetcher.stats
+        assert [q['subject'] for q in queries] == ['1097@HGNC'], queries
+        # The follow-up query is answered from the cache.
+        finder = msa.MSA().find_from_source(braf, None, ev_limit=3,
+                                            timeout=5)
+        assert len(finder.get_statements()) == 1
+        assert len(queries) == 1, queries
+        # The prefetch of the active forms answers PHOSPHORYLATION-ACTIVATING
+        # whatever the site asked about.
+        prefetcher.schedule('activeforms', map2k1)
+        for _ in range(50):
+            if prefetcher.stats['done'] == 2:
+                break
+            sleep(0.1)
+        assert prefetcher.stats['done'] == 2, prefetcher.stats
+        finder = msa.MSA().find_phos_activeforms(map2k1, residue='S',
+                                                 position='218',
+                                                 action='phosphorylation',
+                                                 polarity='activating')
+        finder.get_statements()
+        assert len(queries) == 2, queries
+        # Prefetches don't wait for their queries to be made.
+        assert all(q['timeout'] == 0 for q in queries), queries
+
+
+def test_prefetch_skips_current_query():
+    scheduled = []
+
+    class Prefetcher(object):
+        def schedule(self, method, *args, **params):
+            scheduled.append((method, args[0].name))
+
+    mm = msa_module.MSA_Module(testing=True)
+    mm.prefetcher = Prefetcher()
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    mm._prefetch_follow_ups(braf, None, skip={'activeforms'})
+    assert [m for m, _ in scheduled] == \
+        ['from_source', 'to_target', 'neighborhood'], scheduled
+
+
+def test_prefetch_cancelled_while_running():
+    from bioagents.msa.prefetch import Prefetcher
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    with _statement_backend(_FakeBackend(_SlowProcessor([]))):
+        prefetcher = Prefetcher(msa.MSA(), max_concurrent=1, timeout=30)
+        prefetcher.schedule('neighborhood', braf)
+        sleep(0.2)
+        # A request coming in stops the wait for the running prefetch.
+        prefetcher.begin_request()
+        for _ in range(20):
+            if prefetcher.stats['cancelled']:
+                break
+            sleep(0.1)
+        assert prefetcher.stats['cancelled'] == 1, prefetcher.stats
+        assert not prefetcher.stats['done'], prefetcher.stats
+        prefetcher.end_request()
+
+
+def test_get_html_in_background():
+    import os
+    import tempfile
+    from indra.statements import Phosphorylation
+    from bioagents.artifacts import get_artifact_store
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    map2k1 = Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    proc = _CountingProcessor([Phosphorylation(braf, map2k1)])
+    results_dir = tempfile.mkdtemp()
+    with _statement_backend(_FakeBackend(proc)), \
+            mock.patch.object(msa, 'RESULTS_LOCATION', 'file:' + results_dir):
+        finder = msa.BinaryDirected(braf, map2k1)
+        link = finder.get_html()
+        assert link == finder.get_html()
+        get_artifact_store(msa.RESULTS_LOCATION, signed=True).flush()
+        assert os.listdir(results_dir) == [os.path.basename(link)]
+        with open(link, 'r') as fh:
+            assert 'MAP2K1' in fh.read()
+
+
+def test_finder_classes():
+    from indra.statements import get_all_descendants
+    # All the public finders are registered, and are methods of the MSA.
+    assert set(msa.finder_classes) == \
+        {msa.un_camel(cls.__name__)
+         for cls in get_all_descendants(msa.StatementFinder)
+         if not cls.__name__.startswith('_')}
+    for method, cls in msa.finder_classes.items():
+        assert getattr(msa.MSA, 'find_' + method) is cls
+    ag = Agent('MAPK1', db_refs={'HGNC': '6871'})
+    try:
+        msa.MSA().find_mechanisms('no_such_finder', ag)
+        assert False, 'An unknown method must be an error.'
+    except ValueError:
+        pass
+
+
+def test_filter_other_agent_type():
+    from indra.statements import Phosphorylation, Activation, Complex
+    mek = Agent('MEK', db_refs={'FPLX': 'MEK'})
+    erk = Agent('ERK', db_refs={'FPLX': 'ERK'})
+    braf = Agent('BRAF', db_refs={'HGNC': '1097'})
+    stmts = [Phosphorylation(mek, erk), Activation(mek, braf),
+             Complex([mek, braf, Agent('PTEN', db_refs={'HGNC': '9588'})]),
+             Activation(mek, Agent('apoptosis', db_refs={'GO': '0006915'}))]
+    with _statement_backend(_FakeBackend(_CountingProcessor(stmts))):
+        finder = msa.FromSource(mek)
+        assert finder.filter_other_agent_type(stmts, 'kinase') == stmts[1:2]
+        assert finder.filter_other_agent_type(stmts, 'enzyme') == stmts[1:3]
+        assert finder.filter_other_agent_type(stmts, 'protein') == stmts[:3]
+        assert finder.filter_other_agent_type(stmts, 'other') == stmts
@@ -13,23 +13,28 @@ import logging
 from time import sleep
 from copy import deepcopy
 from datetime import datetime
-import sympy.physics.units as units
 import indra.statements as ist
 import indra.assemblers.pysb.assembler as pa
 from indra.assemblers.english import assembler as english_assembler
 from pysb import Observable
-from pysb.integrate import Solver
-from pysb.export.kappa import KappaExporter
 from pysb.core import ComponentDuplicateNameError
 import bioagents.tra.model_checker as mc
-import matplotlib
-from bioagents import BioagentException, get_img_path
-
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from bioagents import BioagentException, DeadlineExceeded, get_img_path, \
+    get_request_context
+from bioagents.logs import RateLimitedLogger
 
 
 logger = logging.getLogger('TRA')
+rl_logger = RateLimitedLogger(logger, interval=2.0)
+
+
+def _get_pyplot():
+    # Matplotlib is slow to import and only needed to plot results, so it is
+    # imported on first use rather than when the TRA is started.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 
 class TRA(object):
@@ -85,6 +90,8 @@ class TRA(object):
         results = self.run_simulations(model, conditions, num_sim,
                                        min_time_idx, max_time,
                                        plot_period)
+        # Fewer simulations are done if the deadline of the request passed.
+        num_sim = len(results)
 
         results_copy = deepcopy(results)
         yobs_list = [yobs for _, yobs in results]
@@ -162,6 +169,7 @@ class TRA(object):
         return res, fig_path
 
     def plot_compare_conditions(self, ts, results, agent, obs_name):
+        plt = _get_pyplot()
         plt.figure()
         plt.ion()
         plt.plot(ts, results[0][:len(ts)], label='Without condition')
@@ -176,6 +184,8 @@ class TRA(object):
         return fig_path
 
     def plot_results(self, results, agent, obs_name, thresh=50):
+        plt = _get_pyplot()
+        import matplotlib.patches
         plt.figure()
         plt.ion()
         max_val_lim = max(max((numpy.max(results[0][1][obs_name]) + 0.25*numpy.max(results[0][1][obs_name])), 101.0),
@@ -206,9 +216,21 @@ class TRA(object):
 
     def run_simulations(self, model, conditions, num_sim, min_time_idx,
                         max_time, plot_period):
+        """Run simulations of the model, returning their results.
+
+        If the deadline of the request passes, the results of the
+        simulations finished so far are returned, or DeadlineExceeded is
+        raised if none were.
+        """
+        context = get_request_context()
         self.sol = None
         results = []
         for i in range(num_sim):
+            if results and context.expired():
+                logger.warning('Deadline passed after %d of %d simulations.'
+                               % (len(results), num_sim))
+                break
+            context.check()
             # Apply molecular condition to model
             try:
                 model_sim = self.condition_model(model, conditions)
@@ -224,6 +246,12 @@ class TRA(object):
                 try:
                     tspan, yobs = self.simulate_kappa(model_sim, max_time,
                                                       plot_period)
+                except DeadlineExceeded:
+                    if not results:
+                        raise
+                    logger.warning('Deadline passed after %d of %d '
+                                   'simulations.' % (len(results), num_sim))
+                    break
                 except Exception as e:
                     logger.exception(e)
                     raise SimulatorError('Kappa simulation failed.')
@@ -271,16 +299,20 @@ class TRA(object):
         self.kappa.compile(code_list=[kappa_model])
         self.kappa.start_sim(plot_period=plot_period,
                          pause_condition="[T] > %d" % max_time)
+        context = get_request_context()
         while True:
             sleep(0.2)
+            if context.expired():
+                self.kappa.reset_project()
+                context.check()
             status_json = self.kappa.sim_status()
             is_running = status_json.get('simulation_progress_is_running')
             if not is_running:
                 break
             else:
                 if status_json.get('time_percentage') is not None:
-                    logger.info(
-                        'Sim time percentage: %d' %
+                    rl_logger.info(
+                        'Sim time percentage: %d',
                         status_json.get('simulation_progress_time_percentage')
                         )
         tspan, yobs = get_sim_result(self.kappa.sim_plot())
@@ -290,6 +322,7 @@ class TRA(object):
     def simulate_odes(self, model_sim, max_time, plot_period):
         ts = numpy.linspace(0, max_time, int(1.0*max_time/plot_period) + 1)
         if self.sol is None:
+            from pysb.integrate import Solver
             self.sol = Solver(model_sim, ts)
         self.sol.run()
         return ts, self.sol.yobs
@@ -408,6 +441,7 @@ def get_create_observable(model, agent):
 
 
 def pysb_to_kappa(model):
+    from pysb.export.kappa import KappaExporter
     ke = KappaExporter(model)
     kappa_model = ke.export()
     return kappa_model
@@ -520,6 +554,7 @@ class InvalidTemporalPatternError(BioagentException):
 
 class TimeInterval(object):
     def __init__(self, lb, ub, unit):
+        import sympy.physics.units as units
         if unit == 'day':
             sym_unit = units.day
         elif unit == 'hour':
@@ -548,6 +583,7 @@ class TimeInterval(object):
             self.ub = None
 
     def _convert_to_sec(self, val):
+        import sympy.physics.units as units
         if val is not None:
             try:
                 # sympy >= 1.1
@@ -605,6 +641,7 @@ class MolecularCondition(object):
 class MolecularQuantity(object):
     def __init__(self, quant_type, value, unit=None):
         if quant_type == 'concentration':
+            import sympy.physics.units as units
             try:
                 val = float(value)
             except ValueError:
@@ -8,7 +8,8 @@ from indra.statements import stmts_from_json, Activation, Inhibition, \
     ActiveForm
 from indra.sources.trips import processor as trips_processor
 from bioagents.tra import tra
-from bioagents import Bioagent, BioagentException
+from bioagents import Bioagent, BioagentException, DeadlineExceeded
+from bioagents.startup import profile_startup
 
 # This version of logging is coming from tra...
 logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
@@ -30,6 +31,9 @@ def get_bool_arg(arg_name, kwargs, default=True):
 class TRA_Module(Bioagent):
     name = "TRA"
     tasks = ['SATISFIES-PATTERN', 'MODEL-COMPARE-CONDITIONS']
+    # The results of the simulations done before the deadline are used.
+    task_timeouts = {'SATISFIES-PATTERN': 300,
+                     'MODEL-COMPARE-CONDITIONS': 300}
 
     def __init__(self, **kwargs):
         use_kappa = get_bool_arg('use_kappa', kwargs, default=False)
@@ -102,6 +106,8 @@ class TRA_Module(Bioagent):
             logger.exception(e)
             reply_content = self.make_failure('KAPPA_FAILURE')
             return reply_content
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.exception(e)
             reply_content = self.make_failure('INVALID_PATTERN')
@@ -370,4 +376,7 @@ class InvalidModelDescriptionError(BioagentException):
 
 
 if __name__ == "__main__":
-    m = TRA_Module(argv=sys.argv[1:])
+    if '--profile-startup' in sys.argv:
+        profile_startup(TRA_Module)
+    else:
+        m = TRA_Module(argv=sys.argv[1:])
@@ -0,0 +1,30 @@
+"""Build a local statement index for the MSA from pickled statements.
+
+Usage:
+
+    python make_statement_index.py index.db /pmc/data/db_ndex/pa_stmts_*.pkl
+
+The pickles are lists of statements, e.g. as dumped by make_db_ndex.py. Set
+MSA_STATEMENT_INDEX to the path of the index to have the MSA use it.
+"""
+import sys
+import pickle
+from bioagents.msa.local_index import LocalStatementIndex
+
+
+def index_statement_files(index_path, fnames, ev_limit=10):
+    index = LocalStatementIndex(index_path, ev_limit=ev_limit)
+    for fname in fnames:
+        print('Loading %s' % fname)
+        with open(fname, 'rb') as fh:
+            stmts = pickle.load(fh)
+        index.add_statements(stmts)
+        print('%d statements in the index' % index.count())
+    return index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    index_statement_files(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,37 @@
+"""Make and cache the models of papers for GET-PAPER-MODEL ahead of time.
+
+Usage:
+
+    python precompute_paper_models.py 18388193 25043203 ...
+    python precompute_paper_models.py pmids.txt
+
+where pmids.txt has a PMID per line. The models are cached in the directory
+given by MSA_PAPER_MODEL_CACHE (by default ~/.bioagents/paper_models), where
+the MSA finds them.
+"""
+import os
+import sys
+from bioagents.msa.paper_models import PaperModelService
+
+
+def read_pmids(args):
+    pmids = []
+    for arg in args:
+        if os.path.exists(arg):
+            with open(arg, 'r') as fh:
+                pmids += [line.strip() for line in fh if line.strip()]
+        else:
+            pmids.append(arg)
+    return [pmid[len('PMID-'):] if pmid.startswith('PMID-') else pmid
+            for pmid in pmids]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    service = PaperModelService()
+    results = service.precompute(read_pmids(sys.argv[1:]))
+    service.shutdown()
+    for pmid, res in results.items():
+        print('%s\t%s' % (pmid, res))
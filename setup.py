@@ -1,4 +1,38 @@
+import os
+import runpy
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+
+
+class BuildPyWithResources(build_py):
+    """Rebuild the resources made from INDRA in the build directory.
+
+    These are the verb map of the MSA (see bioagents/msa/verbs.py) and the
+    entity type index of BioSense (see bioagents/biosense/entity_types.py).
+    The rebuilt resources replace the copies of the stored ones in the build
+    directory, so the source tree is left as it is. If INDRA is not
+    installed yet, the stored resources are kept, and they are rebuilt at
+    runtime if they are out of date.
+    """
+    def run(self):
+        build_py.run(self)
+        if self.dry_run:
+            return
+        resources = os.path.join(self.build_lib, 'bioagents', 'resources')
+        try:
+            verbs = runpy.run_path(os.path.join('bioagents', 'msa',
+                                                'verbs.py'))
+            fname = verbs['write_verb_map'](
+                os.path.join(resources, 'msa_verb_map.json'))
+            print('Wrote the MSA verb map to %s' % fname)
+            entity_types = runpy.run_path(
+                os.path.join('bioagents', 'biosense', 'entity_types.py'))
+            fname = entity_types['EntityTypeIndex'].from_tables().save(
+                os.path.join(resources, 'entity_types.tsv'))
+            print('Wrote the entity type index to %s' % fname)
+        except Exception as e:
+            print('Could not rebuild the resources: %s' % e)
+
 
 def main():
     setup(name='bioagents',
@@ -11,6 +45,9 @@ def main():
           packages=find_packages(),
           install_requires=['indra', 'pykqml>=1.2'],
           include_package_data=True,
+          package_data={'bioagents': ['resources/msa_verb_map.json',
+                                      'resources/entity_types.tsv']},
+          cmdclass={'build_py': BuildPyWithResources},
           keywords=['systems', 'biology', 'model', 'pathway', 'assembler',
                     'nlp', 'mechanism', 'biochemistry'],
           classifiers=[